@@ -1,45 +1,330 @@
 '''
 This file contains all api endpoints implemented on the TriviaAPI
 '''
-import random
+import base64
+import binascii
 import os
-from flask import Flask, request, abort, jsonify
+import secrets
+import tempfile
+from flask import Flask, Response, g, request, abort, jsonify, stream_with_context
 from flask_cors import CORS
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.exc import SQLAlchemyError
-
-from models import setup_db, Question, Category
+from decouple import Csv, config
+
+from models import (
+    setup_db, schema_is_current, db, pool_metrics, replica_reads,
+    Question, Category, QUESTION_FIELDS, DB_POOL_SIZE, DB_MAX_OVERFLOW, category_versions)
+from .serialization import json_response
+from .versions import VersionTracker, table_etag
+from .registry import CategoryRegistry
+from .search import SEARCH_LANGUAGE, SubstringSearchIndex, create_search_index
+from .quiz import QuizSelector, SeenSet, create_quiz_session_store, parse_previous_questions
+from .ratings import RatingBuffer
+from .export import EXPORT_FORMATS, export_questions
+from .loader import load_questions_command
+from .benchmark import benchmark_command
+from .generator import generate_questions_command
+from .migrations import migrate_command, run_migrations
+from .replicas import ReplicaSet
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestMetrics
+from .limits import (
+    AdmissionControl, RateLimiter, client_key, create_rate_limit_store, request_cost)
+from .cache import create_response_cache, database_namespace
+from .compression import CompressedBodyCache, compress_response, etag_variants
+from .bulk import (
+    delete_questions, ingest_questions, iter_ndjson, parse_rating, question_filter,
+    update_ratings, validate_new_question)
 
 QUESTIONS_PER_PAGE = 10
+# Settings read from the environment or .env by create_app, as (name, default, cast)
+SETTINGS = (
+    ('VERSION_CHECK_INTERVAL', 1.0, float),
+    ('SEARCH_SUBSTRING', False, bool),
+    ('QUIZ_SESSION_STORE', 'memory', str),
+    ('QUIZ_SESSION_BYTES', 16 * 1024 * 1024, int),
+    ('QUIZ_SESSION_TTL', 3600, float),
+    ('BULK_BATCH_SIZE', 1000, int),
+    ('BULK_CHUNK_SIZE', 500, int),
+    ('RATING_FLUSH_INTERVAL', 1.0, float),
+    ('RATING_FLUSH_SIZE', 1000, int),
+    ('EXPORT_CHUNK_SIZE', 1000, int),
+    ('COMPRESS_MIN_SIZE', 500, int),
+    ('COMPRESS_LEVEL', 6, int),
+    ('COMPRESS_CACHE_BYTES', 16 * 1024 * 1024, int),
+    ('AUTO_MIGRATE', True, bool),
+    ('DATABASE_REPLICA_URIS', '', Csv()),
+    ('REPLICA_CHECK_INTERVAL', 5.0, float),
+    ('REPLICA_CHECK_TIMEOUT', 2.0, float),
+    ('METRICS_DIR', '', str),
+    ('METRICS_FLUSH_INTERVAL', 1.0, float),
+    # Token buckets of the clients, RATE_LIMIT_RATE tokens per second up to RATE_LIMIT_BURST
+    ('RATE_LIMIT_ENABLED', True, bool),
+    ('RATE_LIMIT_RATE', 20.0, float),
+    ('RATE_LIMIT_BURST', 100, int),
+    ('RATE_LIMIT_STORE', 'memory', str),
+    ('RATE_LIMIT_CAPACITY', 100000, int),
+    ('RATE_LIMIT_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'trivia-rate-limits.db'), str),
+    # Requests handled at once by a worker, by default as many as the pool has connections
+    ('MAX_IN_FLIGHT', DB_POOL_SIZE + DB_MAX_OVERFLOW, int),
+    ('ADMISSION_TIMEOUT', 0.1, float),
+    ('ADMISSION_RETRY_AFTER', 1, int),
+    # Bodies of GET /categories/<id>/questions, kept until a question of the category is written
+    ('RESPONSE_CACHE_STORE', 'memory', str),
+    ('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024, int),
+    ('RESPONSE_CACHE_TTL', 60.0, float),
+    ('RESPONSE_CACHE_SQLITE_PATH',
+     os.path.join(tempfile.gettempdir(), 'trivia-response-cache.db'), str),
+)
+
+# Tables each cacheable GET endpoint reads, their versions make up its ETag
+ETAG_TABLES = {
+    'get_categories': ('categories',),
+    'get_questions': ('questions', 'categories'),
+    'get_by_category': ('questions',),
+}
+
+def encode_cursor(question_id):
+    '''
+    Returns an opaque cursor pointing after a question
+        Parameters:
+            question_id (int): id of the last question on a page
+        Returns:
+            cursor (str): url safe token for the next page
+    '''
+    token = base64.urlsafe_b64encode(f'id:{question_id}'.encode('ascii'))
+    return token.decode('ascii').rstrip('=')
 
-def paginate_questions(request_obj, selected_questions):
+def decode_cursor(cursor):
+    '''
+    Returns the question id a cursor points after, aborts with 400 if malformed
+        Parameters:
+            cursor (str): token returned as next_cursor
+        Returns:
+            question_id (int): id of the last question on the previous page
+    '''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        prefix, question_id = base64.urlsafe_b64decode(padded).decode('ascii').split(':')
+        if prefix != 'id':
+            raise ValueError(cursor)
+        return int(question_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        abort(400)
+
+def page_statement(request_obj, statement):
     '''
-    Returns a list questions in chunks of 10 questions per page
+    Returns the statement fetching a page of questions with LIMIT in the database.
+    A ?cursor= argument seeks past the last seen id (keyset pagination),
+    otherwise ?page= is translated to an OFFSET for compatibility.
         Parameters:
             request (flask.Request): A request object
-            selected_questions (Array): An array of questions
+            statement (sqlalchemy.sql.Select): A select of question rows ordered by Question.id
+        Returns:
+            statement (sqlalchemy.sql.Select): the page and one more row, None for no page
+    '''
+    cursor = request_obj.args.get('cursor')
+    if cursor:
+        statement = statement.where(Question.id > decode_cursor(cursor))
+    else:
+        page = request_obj.args.get('page', 1, type=int)
+        if page < 1:
+            return None
+        statement = statement.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    # Fetch one extra row to find out if there is a next page
+    return statement.limit(QUESTIONS_PER_PAGE + 1)
+
+def format_page(rows):
+    '''
+    Returns the questions of the rows fetched by page_statement()
+        Parameters:
+            rows (list): question rows, one more than a page if there is a next page
         Returns:
             current_questions (Array): An array of paginated questions
+            next_cursor (str): cursor of the next page or None on the last page
+    '''
+    next_cursor = None
+    if len(rows) > QUESTIONS_PER_PAGE:
+        rows = rows[:QUESTIONS_PER_PAGE]
+        next_cursor = encode_cursor(rows[-1].id)
+
+    return [Question.format_row(row) for row in rows], next_cursor
+
+def paginate_query(request_obj, statement):
+    '''
+    Returns a page of questions fetched with LIMIT in the database
+        Parameters:
+            request (flask.Request): A request object
+            statement (sqlalchemy.sql.Select): A select of question rows ordered by Question.id
+        Returns:
+            current_questions (Array): An array of paginated questions
+            next_cursor (str): cursor of the next page or None on the last page
+    '''
+    statement = page_statement(request_obj, statement)
+    if statement is None:
+        return [], None
+    return format_page(db.session.execute(statement).all())
+
+def search_window(request_obj):
+    '''
+    Returns the positions of the matches on the requested search page
+        Parameters:
+            request (flask.Request): A request object
+        Returns:
+            start (int): position of the match before the page
+            end (int): position of the last match of the page
     '''
     page = request_obj.args.get("page", 1, type=int)
     start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+    return start, start + QUESTIONS_PER_PAGE
 
-    questions = [question.format() for question in selected_questions]
-    current_questions = questions[start:end]
+def search_statement(matches, start, end):
+    '''
+    Returns the statement fetching a page of matched questions for every category.
+    ROW_NUMBER() numbers the matches of each category by relevance, so only the
+    requested page window is fetched, plus the first match of each category to
+    carry its total.
+        Parameters:
+            matches (sqlalchemy.sql.Subquery): rows of (id, score) of matched questions
+            start (int): position of the match before the page
+            end (int): position of the last match of the page
+        Returns:
+            statement (sqlalchemy.sql.Select): ranked matches ordered by category
+    '''
+    ranked = Question.select_rows().add_columns(
+        func.row_number().over(
+            partition_by=Question.category,
+            order_by=(matches.c.score.desc(), Question.id)
+            ).label('position'),
+        func.count().over(partition_by=Question.category).label('category_total')
+        ).join(matches, Question.id == matches.c.id).subquery()
+
+    return select(ranked).where(or_(
+        ranked.c.position == 1,
+        and_(ranked.c.position > start, ranked.c.position <= end)
+        )).order_by(ranked.c.category, ranked.c.position)
+
+def group_search_rows(rows, category_ids, start, end):
+    '''
+    Returns the rows fetched by search_statement() grouped by category
+        Parameters:
+            rows (list): ranked matches ordered by category
+            category_ids (Array): ids of the categories to group matches by
+            start (int): position of the match before the page
+            end (int): position of the last match of the page
+        Returns:
+            search_result (dict): a dictionary of paginated questions by category id,
+                None if no question matched
+    '''
+    if not rows:
+        return None
+
+    search_result = {
+        str(category_id): {
+            'questions': [],
+            'total_questions': 0,
+            'current_category': category_id
+            } for category_id in category_ids
+        }
+    for row in rows:
+        bucket = search_result.get(str(row.category))
+        if bucket is None:
+            continue
+        bucket['total_questions'] = row.category_total
+        if start < row.position <= end:
+            bucket['questions'].append({field: row[field] for field in QUESTION_FIELDS})
+
+    return search_result
+
+def paginate_search(request_obj, matches, category_ids):
+    '''
+    Returns a page of matched questions for every category in a single query
+        Parameters:
+            request (flask.Request): A request object
+            matches (sqlalchemy.sql.Subquery): rows of (id, score) of matched questions
+            category_ids (Array): ids of the categories to group matches by
+        Returns:
+            search_result (dict): a dictionary of paginated questions by category id,
+                None if no question matched
+    '''
+    start, end = search_window(request_obj)
+    rows = db.session.execute(search_statement(matches, start, end)).all()
+    return group_search_rows(rows, category_ids, start, end)
 
-    return current_questions
+def load_settings(overrides=None):
+    '''
+    Returns the SETTINGS of an app, read from the environment or .env when called
+        Parameters:
+            overrides (dict): settings used instead of the environment, e.g. by a test case
+        Returns:
+            settings (dict): the value of each setting by name
+    '''
+    settings = {
+        name: config(name, default=default, cast=cast) for name, default, cast in SETTINGS}
+    settings.update(overrides or {})
+    return settings
 
-def create_app():
+def create_app(database_path=None, settings=None):
     '''
     Returns an instance of Flask app
         Parameters:
-            None
+            database_path (str): database uri, DATABASE_URI by default
+            settings (dict): SETTINGS overriding the environment, kept in app.config
         Returns:
             app (flask.Flask): In instance of Flask
     '''
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    settings = load_settings(settings)
+    app.config.update(settings)
+    setup_db(app, database_path)
+    if settings['AUTO_MIGRATE'] and not schema_is_current(db.engine):
+        run_migrations(db.engine)
+
+    # Read replicas of GET requests and quiz draws, None reads everything from the primary
+    app.extensions['replicas'] = (
+        ReplicaSet(
+            settings['DATABASE_REPLICA_URIS'], settings['REPLICA_CHECK_INTERVAL'],
+            settings['REPLICA_CHECK_TIMEOUT'])
+        if settings['DATABASE_REPLICA_URIS'] else None
+        )
+
+    # In-process caches, kept consistent across workers through table_versions
+    table_versions = VersionTracker(settings['VERSION_CHECK_INTERVAL'])
+    category_registry = CategoryRegistry(table_versions)
+    app.extensions['table_versions'] = table_versions
+    app.extensions['category_registry'] = category_registry
+
+    # Full-text index for the searchTerm path of POST /questions, set up by migration 4
+    search_index = create_search_index(db.engine, SEARCH_LANGUAGE)
+    app.extensions['search_index'] = search_index
+    substring_index = SubstringSearchIndex()
+
+    quiz_selector = QuizSelector(table_versions)
+    app.extensions['quiz_selector'] = quiz_selector
+    quiz_sessions = create_quiz_session_store(
+        settings['QUIZ_SESSION_STORE'], settings['QUIZ_SESSION_BYTES'],
+        settings['QUIZ_SESSION_TTL'])
+    app.extensions['quiz_sessions'] = quiz_sessions
+
+    rating_buffer = RatingBuffer(
+        app, settings['RATING_FLUSH_INTERVAL'], settings['RATING_FLUSH_SIZE'])
+    app.extensions['rating_buffer'] = rating_buffer
+
+    app.cli.add_command(load_questions_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(benchmark_command)
+    app.cli.add_command(generate_questions_command)
+
+    compressed_bodies = CompressedBodyCache(settings['COMPRESS_CACHE_BYTES'])
+    app.extensions['compressed_bodies'] = compressed_bodies
+    # The SQLite file may be shared by apps on other databases
+    category_pages = create_response_cache(
+        settings['RESPONSE_CACHE_STORE'], settings['RESPONSE_CACHE_BYTES'],
+        settings['RESPONSE_CACHE_TTL'],
+        settings['RESPONSE_CACHE_SQLITE_PATH'], database_namespace(db.engine.url))
+    app.extensions['category_pages'] = category_pages
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -47,6 +332,93 @@ def create_app():
     """
     CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+    # Installed before the other hooks so it times the whole request
+    request_metrics = RequestMetrics(settings['METRICS_DIR'], settings['METRICS_FLUSH_INTERVAL'])
+    request_metrics.install(app)
+    app.extensions['request_metrics'] = request_metrics
+
+    rate_limiter = RateLimiter(
+        create_rate_limit_store(
+            settings['RATE_LIMIT_STORE'], settings['RATE_LIMIT_CAPACITY'],
+            settings['RATE_LIMIT_SQLITE_PATH']),
+        settings['RATE_LIMIT_RATE'], settings['RATE_LIMIT_BURST'],
+        enabled=settings['RATE_LIMIT_ENABLED'])
+    app.extensions['rate_limiter'] = rate_limiter
+    admission = AdmissionControl(
+        settings['MAX_IN_FLIGHT'], settings['ADMISSION_TIMEOUT'], settings['ADMISSION_RETRY_AFTER'])
+    app.extensions['admission'] = admission
+
+    @app.before_request
+    def limit_requests():
+        '''
+        Refuses a request with 503 when the worker already handles MAX_IN_FLIGHT
+        requests, and with 429 when its client has used up its tokens
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        # Only POST /questions is priced by its body, a search costs more than a creation
+        body = request.get_json(silent=True) if request.endpoint == 'create_question' else None
+        cost = request_cost(request.endpoint, body, rate_limiter.costs)
+        if cost == 0:
+            return
+        # Admitted first, so a shed request does not spend the tokens of its client
+        if not admission.enter():
+            abort(503, retry_after=admission.retry_after)
+        g.admitted = True
+        key = client_key(request.remote_addr, request.headers.get('X-API-Key'))
+        retry_after = rate_limiter.check(key, cost)
+        if retry_after:
+            abort(429, retry_after=retry_after)
+
+    @app.before_request
+    def route_reads():
+        '''
+        Reads GET requests from the read replicas until they write
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        session_info = db.session().info
+        session_info['replica_reads'] = request.method in ('GET', 'HEAD')
+        session_info['wrote'] = False
+
+    @app.before_request
+    def check_etag():
+        '''
+        Answers a conditional GET with 304 Not Modified when none of the tables
+        the endpoint reads was written since the ETag was sent
+            Parameters:
+                None
+            Returns:
+                response (Object): a 304 response or None to handle the request
+        '''
+        if request.method != 'GET' or request.endpoint not in ETAG_TABLES:
+            return None
+
+        g.etag = table_etag(table_versions, ETAG_TABLES[request.endpoint])
+        # The client may hold the ETag of the plain or of a compressed body
+        for etag in etag_variants(g.etag):
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag, weak=True)
+                return response
+        return None
+
+    @app.teardown_request
+    def release_admission(error):
+        '''
+        Makes room for another request once a request admitted by limit_requests is done
+            Parameters:
+                error (Exception): the unhandled error of the request, if any
+            Returns:
+                None
+        '''
+        if g.pop('admitted', False):
+            admission.leave()
+
     """
     @TODO: Use the after_request decorator to set Access-Control-Allow
     """
@@ -65,7 +437,11 @@ def create_app():
         response.headers.add(
             'Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE'
         )
-        return response
+        if response.status_code == 200 and 'etag' in g:
+            response.set_etag(g.etag, weak=True)
+        return compress_response(
+            request, response, compressed_bodies,
+            settings['COMPRESS_MIN_SIZE'], settings['COMPRESS_LEVEL'])
 
     """
     @TODO:
@@ -83,19 +459,9 @@ def create_app():
                 <categories> dict: a dictionary of categories with keys:<id> values: <type>
         '''
 
-        # Fetch an array of categories
-        category_arr = [
-            category.format() for category in
-            Category.query.order_by(Category.type).all()
-            ]
-
-        # Convert an array of categories to a dictionary object
-        category_dict = {}
-        for category in category_arr:
-            category_dict[str(category['id'])] = category['type']
+        category_dict = category_registry.get_map()
 
-
-        if len(category_arr) == 0:
+        if len(category_dict) == 0:
             abort(404)
 
         return jsonify(
@@ -127,34 +493,25 @@ def create_app():
                 <success> bool: successful transaction
                 <questions> array: list of all paginated questions
                 <total_questions> int: count of all questions in the database
+                <next_cursor> str: cursor of the next page, null on the last page
                 <categories> dict: a dictionary of categories with keys:<id> values: <type>
                 <current_category> str: category of selected question
         '''
-        # Fetch an array of categories
-        category_arr = [
-            category.format() for category in
-            Category.query.order_by(Category.type).all()
-            ]
-
-        # Convert an array of categories to a dictionary object
-        category_dict = {}
-        for category in category_arr:
-            category_dict[str(category['id'])] = category['type']
-
-        # Fetch all questions ordered by the category
-        questions = Question.query.order_by(Question.id).all()
+        category_dict = category_registry.get_map()
 
-        # Paginate fetched questions in group of 10's
-        selected_questions = paginate_questions(request, questions)
+        # Fetch a single page of questions ordered by id
+        selected_questions, next_cursor = paginate_query(
+            request, Question.select_rows().order_by(Question.id))
 
-        if len(questions) == 0 or not selected_questions:
+        if not selected_questions:
             abort(404)
 
-        return jsonify(
+        return json_response(
             {
                 'success': True,
                 'questions': selected_questions,
-                'total_questions': len(questions),
+                'total_questions': Question.count(table_versions.version('question_ids')),
+                'next_cursor': next_cursor,
                 'categories': category_dict
             }
         )
@@ -225,18 +582,21 @@ def create_app():
                 <success> bool: successful transaction
                 <message> str: response message on successful creation
                 <search_result> dict: a dictionary of questions that matches the search item
-                    this is returned by category to the user
+                    this is returned by category to the user, best matches first.
+                    Sending "substring": true matches the term anywhere in a question
         '''
 
         body = request.get_json()
 
         if 'searchTerm' in  body.keys():
 
-            search_term = body['searchTerm']
-            matched_questions = Question.query.order_by(Question.id).filter(
-                Question.question.ilike(f'%{search_term}%'))
+            substring = body.get('substring', settings['SEARCH_SUBSTRING'])
+            index = substring_index if substring else search_index
+            matches = index.matches(body['searchTerm'])
+            category_ids = sorted(int(key) for key in category_registry.get_map())
+            search_result = paginate_search(request, matches.subquery(), category_ids)
 
-            if len(matched_questions.all()) == 0:
+            if search_result is None:
                 return (
                     jsonify({
                         'success': False,
@@ -245,27 +605,19 @@ def create_app():
                     404
                 )
 
-            categories = [category.id for category in Category.query.order_by(Category.id).all()]
-
-            search_result = {}
-            for category_id in categories:
-                questions = [
-                    question for question in matched_questions if (question.category==category_id)
-                    ]
-                current_questions = paginate_questions(request, questions)
-                search_result[str(category_id)] = {
-                    'questions': current_questions,
-                    'total_questions': len(questions),
-                    'current_category': category_id
-                    }
-
-            return search_result
+            return json_response(search_result)
 
         if not all(body.values()):
             abort(400)
 
+        # Shared with the async app so both accept the same questions
+        category_ids = {int(key) for key in category_registry.get_map()}
+        values, error = validate_new_question(body, category_ids)
+        if error is not None:
+            abort(400)
+
         try:
-            question = Question(**body)
+            question = Question(*values)
             question.insert()
 
             return jsonify({
@@ -276,6 +628,164 @@ def create_app():
         except SQLAlchemyError:
             abort(400)
 
+    @app.route('/questions/export')
+    def export_all_questions():
+        '''
+        An endpoint that streams questions ordered by id as NDJSON or CSV
+            Parameters:
+                format (str): "ndjson" (default) or "csv"
+                category (int): only export questions of this category
+                after_id (int): only export questions with a greater id, to resume an export
+                max_id (int): only export questions up to this id
+            Returns:
+                A streamed body with one question per line
+        '''
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            abort(400)
+
+        filters = []
+        category_id = request.args.get('category', type=int)
+        after_id = request.args.get('after_id', type=int)
+        max_id = request.args.get('max_id', type=int)
+        if category_id is not None:
+            filters.append(Question.category == category_id)
+        if after_id is not None:
+            filters.append(Question.id > after_id)
+        if max_id is not None:
+            filters.append(Question.id <= max_id)
+
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        return Response(
+            stream_with_context(
+                export_questions(filters, export_format, settings['EXPORT_CHUNK_SIZE'])),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=questions.{extension}'}
+        )
+
+    @app.route('/questions/bulk', methods=['POST'])
+    def bulk_create_questions():
+        '''
+        An endpoint that creates many questions from a JSON array or a NDJSON body
+            Parameters:
+                batch_size (int): number of questions inserted per transaction
+            Returns:
+                <success> bool: successful transaction
+                <inserted> int: number of questions created
+                <failed> int: number of invalid questions
+                <errors> array: row number and reason of the first invalid questions
+                <rows_per_second> int: ingestion throughput
+        '''
+        batch_size = request.args.get('batch_size', settings['BULK_BATCH_SIZE'], type=int)
+        if batch_size < 1:
+            abort(400)
+
+        # NDJSON bodies are validated line by line as they are read
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            rows = iter_ndjson(request.stream)
+        else:
+            body = request.get_json()
+            if not isinstance(body, list):
+                abort(400)
+            rows = enumerate(body, 1)
+
+        category_ids = {int(key) for key in category_registry.get_map()}
+
+        try:
+            report = ingest_questions(rows, category_ids, batch_size)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(500)
+
+        if report['inserted'] == 0:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'No question could be created',
+                **report
+                }), 422
+
+        return jsonify({'success': True, **report}), 201
+
+    @app.route('/questions/bulk', methods=['DELETE'])
+    def bulk_delete_questions():
+        '''
+        An endpoint that deletes many questions by id or by filter
+            Parameters:
+                <ids> array: ids of questions to be deleted, or
+                <filter> dict: category and/or rating_below of questions to be deleted
+            Returns:
+                <success> bool: successful transaction
+                <ids> array: ids of deleted questions
+                <total_deleted> int: number of deleted questions
+        '''
+        body = request.get_json()
+        ids, clauses = None, None
+
+        if isinstance(body.get('ids'), list) and body['ids']:
+            if not all(isinstance(question_id, int) for question_id in body['ids']):
+                abort(400)
+            ids = body['ids']
+        elif isinstance(body.get('filter'), dict):
+            clauses = question_filter(body['filter'])
+
+        if ids is None and clauses is None:
+            abort(400)
+
+        try:
+            deleted_ids = delete_questions(ids, clauses, settings['BULK_CHUNK_SIZE'])
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(500)
+
+        return jsonify({
+            'success': True,
+            'ids': deleted_ids,
+            'total_deleted': len(deleted_ids)
+        })
+
+    @app.route('/questions/bulk', methods=['PATCH'])
+    def bulk_update_ratings():
+        '''
+        An endpoint that updates the rating of many questions
+            Parameters:
+                <ratings> array: objects with the id and new rating of a question, or
+                <filter> dict: category and/or rating_below of questions to be updated
+                <rating> float: new rating of the filtered questions
+            Returns:
+                <success> bool: successful transaction
+                <ids> array: ids of updated questions
+                <total_updated> int: number of updated questions
+        '''
+        body = request.get_json()
+        ratings, clauses, rating = None, None, None
+
+        try:
+            if isinstance(body.get('ratings'), list) and body['ratings']:
+                ratings = {
+                    int(item['id']): parse_rating(item['rating']) for item in body['ratings']
+                    }
+            elif isinstance(body.get('filter'), dict) and 'rating' in body:
+                clauses = question_filter(body['filter'])
+                rating = parse_rating(body['rating'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+
+        if ratings is None and clauses is None:
+            abort(400)
+
+        try:
+            updated_ids = update_ratings(ratings, clauses, rating, settings['BULK_CHUNK_SIZE'])
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(500)
+
+        return jsonify({
+            'success': True,
+            'ids': updated_ids,
+            'total_updated': len(updated_ids)
+        })
+
     """
     @TODO:
     Create a GET endpoint to get questions based on category.
@@ -296,15 +806,23 @@ def create_app():
                 <total_questions> int: total number of returned questions
                 <current_category> int: category id of question object
         '''
+        # Read before the questions, a write committed in between leaves the
+        # body under the older version, where it is never served
+        version = table_versions.version(category_versions([category_id])[0])
+        # The endpoint reads no query parameters, any ?x= is served the same body
+        key = str(category_id)
+        data = category_pages.get(key, version)
+        if data is not None:
+            return app.response_class(data, mimetype=app.config['JSONIFY_MIMETYPE'])
 
         # Get an array of questions by their category from questions table
-        questions = [question.format() for question in
-                     Question.query.filter(Question.category==category_id).all()]
+        questions = [Question.format_row(row) for row in db.session.execute(
+            Question.select_rows().where(Question.category==category_id))]
 
         if len(questions)==0:
             abort(404)
 
-        return jsonify(
+        response = json_response(
             {
                 'success': True,
                 'questions': questions,
@@ -312,6 +830,8 @@ def create_app():
                 'current_category': category_id
             }
         )
+        category_pages.set(key, version, response.get_data())
+        return response
 
     """
     @TODO:
@@ -333,24 +853,38 @@ def create_app():
             Returns:
                 <success> bool: successful transaction
                 <question> dict: a question returned at random of selected category
+                <quiz_session> str: token of the server side quiz session, only
+                    returned when the request has a quiz_session key
         '''
         body = request.get_json()
-        previous_questions = body['previous_questions']
-        quiz_category = body['quiz_category']['id']
-
-        try:
-            questions = Question.query.filter(Question.category==quiz_category)
 
-            # This makes all questions available to a user when All is selected under quiz
-            if quiz_category==0:
-                questions = Question.query
+        # A quiz_session key keeps the seen questions on the server, a null
+        # token starts a new session in quiz_category
+        token = None
+        if 'quiz_session' in body:
+            token = body['quiz_session']
+            if token:
+                quiz_session = quiz_sessions.load(token)
+                if quiz_session is None:
+                    abort(404)
+                quiz_category, seen = quiz_session
+            else:
+                token = secrets.token_urlsafe(16)
+                quiz_category, seen = body['quiz_category']['id'], SeenSet()
+        else:
+            quiz_category = body['quiz_category']['id']
+            try:
+                seen = parse_previous_questions(body['previous_questions'])
+            except (KeyError, ValueError):
+                abort(400)
 
-            # Get questions that has not been sent to client during quiz
-            remaining_questions = list(filter(
-                lambda  question: question.format()['id'] not in previous_questions, questions))
+        try:
+            # Category 0 makes all questions available to a user when All is selected
+            with replica_reads():
+                choice_question = quiz_selector.choose(quiz_category, seen)
 
             # Return Questions no longer exist if all questions in the category have been answered
-            if not remaining_questions:
+            if choice_question is None:
                 return (
                     jsonify({
                         'success': False,
@@ -358,11 +892,19 @@ def create_app():
                         'message': 'Questions no longer exist in this category'}),
                     404
                 )
-            choice_question = random.choice(remaining_questions)
 
+            if token is None:
+                return jsonify({
+                    'success': True,
+                    'question': choice_question.format()
+                })
+
+            seen.add(choice_question.id)
+            quiz_sessions.save(token, quiz_category, seen)
             return jsonify({
                 'success': True,
-                'question': choice_question.format()
+                'question': choice_question.format(),
+                'quiz_session': token
             })
         except SQLAlchemyError:
             abort(404)
@@ -373,29 +915,34 @@ def create_app():
     @app.route('/questions/<int:question_id>', methods=['PATCH'])
     def update_rating(question_id):
         '''
-        An endpoint that updates a question rating
+        An endpoint that records a rating vote for a question.
+        Votes are buffered and written in batches, the returned rating
+        already includes the buffered votes.
             Parameters:
-                question_id (int): id of question to be deleted
+                question_id (int): id of question to be rated
             Returns:
                 <success> bool: successful transaction
+                <question> dict: the question with the mean of its rating votes
         '''
         body = request.get_json()
 
         try:
-            question = Question.query.filter(Question.id==question_id).one_or_none()
+            rating = parse_rating(body['rating'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+
+        try:
+            question, mean = rating_buffer.vote(question_id, rating)
 
             if question is None:
                 abort(404)
 
-            if 'rating' in body:
-                question.rating = float(body['rating'])
-                question.update()
-
-                result = Question.query.filter(Question.id==question_id).one_or_none()
-                return jsonify({
-                    'success': True,
-                    'question': result.format()
-                    })
+            result = question.format()
+            result['rating'] = mean
+            return jsonify({
+                'success': True,
+                'question': result
+                })
 
         except SQLAlchemyError :
             abort(400)
@@ -420,27 +967,45 @@ def create_app():
         try:
             category = Category(**body)
             category.insert()
-
-            # Fetch an array of categories
-            category_arr = [
-                category.format() for category in
-                Category.query.order_by(Category.type).all()
-                ]
-
-            # Convert an array of categories to a dictionary object
-            category_dict = {}
-            for category in category_arr:
-                category_dict[str(category['id'])] = category['type']
+            category_registry.invalidate()
 
             return jsonify({
                 'success': True,
                 'message': 'Category was successfully created',
-                'categories': category_dict
+                'categories': category_registry.get_map()
                 }), 201
 
         except SQLAlchemyError:
             abort(400)
 
+    @app.route('/metrics/pool')
+    def get_pool_metrics():
+        '''
+        An endpoint that reports the state of the database connection pool
+            Parameters:
+                None
+            Returns:
+                <success> bool: successful transaction
+                <pool> dict: pool class, sizes, checkouts, wait times and timeouts
+        '''
+        return jsonify({
+            'success': True,
+            'pool': pool_metrics(db.engine.pool)
+            })
+
+    @app.route('/metrics')
+    def get_metrics():
+        '''
+        An endpoint that reports request latencies, response sizes, status codes,
+        SQL queries and the connection pool in Prometheus text format
+            Parameters:
+                None
+            Returns:
+                metrics (str): the metrics of every worker process
+        '''
+        return app.response_class(
+            request_metrics.render(db.engine.pool), mimetype=METRICS_CONTENT_TYPE)
+
     """
     @TODO:
     Create error handlers for all expected errors
@@ -476,6 +1041,28 @@ def create_app():
             422
         )
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return (
+            jsonify({
+                'success': False,
+                'error': 429,
+                'message': 'Too many requests'}),
+            429,
+            {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+        )
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return (
+            jsonify({
+                'success': False,
+                'error': 503,
+                'message': 'Service unavailable'}),
+            503,
+            {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+        )
+
     @app.errorhandler(500)
     def server_error(error):
         return (
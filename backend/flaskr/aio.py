@@ -0,0 +1,651 @@
+'''
+This file contains the async (ASGI) variant of the TriviaAPI endpoints,
+served by Quart on SQLAlchemy's async engine.
+
+    hypercorn "flaskr.aio:create_async_app()"
+'''
+import secrets
+from array import array
+
+from quart import Quart, g, request, abort, jsonify
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine
+from decouple import config
+
+from models import (
+    DB_STATEMENT_TIMEOUT, PGBOUNCER_MODE, Category, Question, TableVersion,
+    category_versions, engine_options, local_versions, set_local_statement_timeout)
+from . import (
+    ETAG_TABLES, SEARCH_LANGUAGE, format_page, group_search_rows, load_settings,
+    page_statement, search_statement, search_window)
+from .bulk import QUESTION_COLUMNS, parse_rating, validate_new_question, with_rating_votes
+from .compression import etag_variants
+from .quiz import MemoryQuizSessionStore, QuizSelector, SeenSet, parse_previous_questions
+from .registry import CategoryRegistry
+from .search import SubstringSearchIndex, create_search_index
+from .versions import VersionTracker, table_etag
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_database_uri(database_path):
+    '''
+    Returns the uri of a database for its async driver
+        Parameters:
+            database_path (str): database uri, e.g. postgresql://... or sqlite:///...
+        Returns:
+            uri (str): the uri with the asyncpg or aiosqlite driver
+    '''
+    url = make_url(database_path)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        return database_path
+    url = url.set(drivername=driver)
+    if PGBOUNCER_MODE and url.get_backend_name() == 'postgresql':
+        # asyncpg prepares statements on the server connection, which PgBouncer
+        # swaps between transactions
+        url = url.update_query_dict({'prepared_statement_cache_size': '0'})
+    return url.render_as_string(hide_password=False)
+
+
+def async_engine_options(database_path):
+    '''
+    Returns the create_async_engine options matching the DB_* settings of setup_db
+        Parameters:
+            database_path (str): database uri
+        Returns:
+            options (dict): keyword arguments of create_async_engine
+    '''
+    options = engine_options(database_path)
+    # Async engines bring their own queue pool
+    options.pop('poolclass', None)
+    connect_args = {}
+    if 'connect_args' in options:
+        options.pop('connect_args')
+        connect_args['server_settings'] = {'statement_timeout': str(DB_STATEMENT_TIMEOUT)}
+    if PGBOUNCER_MODE and make_url(database_path).get_backend_name() == 'postgresql':
+        connect_args['statement_cache_size'] = 0
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+class AsyncVersionTracker(VersionTracker):
+    '''
+    A VersionTracker whose versions are read by refresh_from() on an async
+    connection, version() only returns the versions already read
+    '''
+
+    def refresh(self, force=False):
+        pass
+
+    async def refresh_from(self, connection, force=False):
+        '''
+        Reads the table versions on an async connection if they may be stale
+            Parameters:
+                connection (AsyncConnection): a connection to the database
+                force (bool): read the versions regardless of their age
+            Returns:
+                None
+        '''
+        if not self.is_stale(force):
+            return
+
+        seen_local = dict(local_versions)
+        result = await connection.execute(select(TableVersion.name, TableVersion.version))
+        self.store(dict(result.all()), seen_local)
+
+
+class AsyncCategoryRegistry(CategoryRegistry):
+    '''
+    A CategoryRegistry loading the category map on an async connection
+    '''
+
+    async def load(self, connection):
+        '''
+        Returns the category map, loading it if it is stale
+            Parameters:
+                connection (AsyncConnection): a connection to the database
+            Returns:
+                category_dict (dict): a dictionary of categories with keys:<id> values: <type>
+        '''
+        version = self.tracker.version('categories')
+        if self._map is not None and version == self._version:
+            return self._map
+
+        result = await connection.execute(
+            select(Category.id, Category.type).order_by(Category.type))
+        self._map = {str(category_id): category_type for category_id, category_type in result}
+        self._version = version
+        return self._map
+
+
+class AsyncQuizSelector(QuizSelector):
+    '''
+    A QuizSelector drawing questions on an async connection
+    '''
+
+    async def choose_from(self, connection, category_id, seen):
+        '''
+        Returns a random question of a category that has not been seen
+            Parameters:
+                connection (AsyncConnection): a connection to the database
+                category_id (int): id of the quiz category, 0 for all categories
+                seen (Container): ids of questions already sent to the player
+            Returns:
+                question (dict): a random unseen question or None if none is left
+        '''
+        for _ in range(2):
+            question_id = self._draw(await self._load_ids(connection, category_id), seen)
+            if question_id is None:
+                return None
+
+            result = await connection.execute(
+                Question.select_rows().where(Question.id == question_id))
+            row = result.first()
+            if row is not None:
+                return Question.format_row(row)
+
+            # The question was deleted by another process since the ids were loaded
+            self.invalidate()
+        return None
+
+    async def _load_ids(self, connection, category_id):
+        '''
+        Returns the ids of the questions in a category, loading them if they are stale
+            Parameters:
+                connection (AsyncConnection): a connection to the database
+                category_id (int): id of the quiz category, 0 for all categories
+            Returns:
+                ids (array): ids of the questions in the category
+        '''
+        version, ids = self._cached_ids(category_id)
+        if ids is None:
+            statement = select(Question.id)
+            if category_id != 0:
+                statement = statement.where(Question.category == category_id)
+            ids = array('q', (await connection.execute(statement)).scalars())
+            self._ids[category_id] = (version, ids)
+        return ids
+
+
+async def json_body():
+    '''
+    Returns the JSON body of the request, aborts with 400 like Flask if there is none
+        Parameters:
+            None
+        Returns:
+            body (dict): the decoded JSON body
+    '''
+    body = await request.get_json()
+    if body is None:
+        abort(400)
+    return body
+
+
+async def bump_versions(connection, *names):
+    '''
+    Increments the versions of tables within the transaction of a connection
+        Parameters:
+            connection (AsyncConnection): a connection in a transaction
+            names (str): names of the versioned tables
+        Returns:
+            None
+    '''
+    table = TableVersion.__table__
+    for name in names:
+        result = await connection.execute(
+            update(table).where(table.c.name == name).values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            await connection.execute(insert(table).values(name=name, version=1))
+
+
+def create_async_app(database_path=None, settings=None):
+    '''
+    Returns an instance of the async Quart app, with the endpoints of create_app()
+        Parameters:
+            database_path (str): database uri, ASYNC_DATABASE_URI or DATABASE_URI by default
+            settings (dict): SETTINGS overriding the environment, kept in app.config
+        Returns:
+            app (quart.Quart): an instance of Quart
+    '''
+    database_path = (
+        database_path
+        or config('ASYNC_DATABASE_URI', default='')
+        or async_database_uri(config('DATABASE_URI')))
+    app = Quart(__name__)
+    settings = load_settings(settings)
+    app.config.update(settings)
+
+    engine = create_async_engine(database_path, **async_engine_options(database_path))
+    if (PGBOUNCER_MODE and DB_STATEMENT_TIMEOUT
+            and engine.dialect.name == 'postgresql'):
+        event.listen(engine.sync_engine, 'begin', set_local_statement_timeout)
+    app.extensions['engine'] = engine
+
+    table_versions = AsyncVersionTracker(settings['VERSION_CHECK_INTERVAL'])
+    category_registry = AsyncCategoryRegistry(table_versions)
+    quiz_selector = AsyncQuizSelector(table_versions)
+    quiz_sessions = MemoryQuizSessionStore(
+        settings['QUIZ_SESSION_BYTES'], settings['QUIZ_SESSION_TTL'])
+    app.extensions['table_versions'] = table_versions
+    app.extensions['quiz_sessions'] = quiz_sessions
+
+    # The search structures are installed by create_app() or flask migrate
+    search_index = create_search_index(engine.sync_engine, SEARCH_LANGUAGE)
+    substring_index = SubstringSearchIndex()
+
+    def committed(*names):
+        # Lets the caches of this process see their own writes
+        TableVersion.mark_committed(*names)
+        if 'question_ids' in names:
+            Question.reset_count()
+
+    @app.after_serving
+    async def dispose_engine():
+        await engine.dispose()
+
+    @app.before_request
+    async def check_etag():
+        '''
+        Reads the table versions if they are stale and answers a conditional GET
+        with 304 Not Modified when none of the tables the endpoint reads was written
+            Parameters:
+                None
+            Returns:
+                response (Object): a 304 response or None to handle the request
+        '''
+        # Fresh versions are answered without checking out a connection
+        if table_versions.is_stale():
+            async with engine.connect() as connection:
+                await table_versions.refresh_from(connection)
+
+        if request.method != 'GET' or request.endpoint not in ETAG_TABLES:
+            return None
+
+        g.etag = table_etag(table_versions, ETAG_TABLES[request.endpoint])
+        for etag in etag_variants(g.etag):
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class('', status=304)
+                response.set_etag(etag, weak=True)
+                return response
+        return None
+
+    @app.after_request
+    async def after_request(response):
+        '''
+        Returns a response object
+            Parameters:
+                response (Object): A response object
+            Returns:
+                response (Object): A response object
+        '''
+        response.headers.add(
+            'Access-Control-Allow-Headers', 'Content-Type,Authorization,true'
+        )
+        response.headers.add(
+            'Access-Control-Allow-Methods', 'GET, POST, PUT, PATCH, DELETE'
+        )
+        if response.status_code == 200 and 'etag' in g:
+            response.set_etag(g.etag, weak=True)
+        return response
+
+    @app.route('/categories')
+    async def get_categories():
+        '''
+        An endpoint that fetches all available question categories
+            Parameters:
+                None
+            Returns:
+                <success> bool: successful transaction
+                <categories> dict: a dictionary of categories with keys:<id> values: <type>
+        '''
+        async with engine.connect() as connection:
+            category_dict = await category_registry.load(connection)
+
+        if len(category_dict) == 0:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'categories': category_dict
+            })
+
+    @app.route('/questions')
+    async def get_questions():
+        '''
+        An endpoint that fetches all available questions in pages
+            Parameters:
+                None
+            Returns:
+                <success> bool: successful transaction
+                <questions> array: list of all paginated questions
+                <total_questions> int: count of all questions in the database
+                <next_cursor> str: cursor of the next page, null on the last page
+                <categories> dict: a dictionary of categories with keys:<id> values: <type>
+        '''
+        statement = page_statement(request, Question.select_rows().order_by(Question.id))
+        if statement is None:
+            abort(404)
+
+        async with engine.connect() as connection:
+            category_dict = await category_registry.load(connection)
+            selected_questions, next_cursor = format_page(
+                (await connection.execute(statement)).all())
+            if not selected_questions:
+                abort(404)
+
+            version = table_versions.version('question_ids')
+            total = Question.cached_count(version)
+            if total is None:
+                total = await connection.scalar(select(func.count(Question.id)))
+                Question.store_count(total, version)
+
+        return jsonify({
+            'success': True,
+            'questions': selected_questions,
+            'total_questions': total,
+            'next_cursor': next_cursor,
+            'categories': category_dict
+            })
+
+    @app.route('/questions/<int:question_id>', methods=['DELETE'])
+    async def delete_question(question_id):
+        '''
+        An endpoint that deletes a question
+            Parameters:
+                question_id (int): id of question to be deleted
+            Returns:
+                <success> bool: successful transaction
+                <message> str: response message on successful delete
+                <id> int: id of deleted question
+        '''
+        table = Question.__table__
+        try:
+            async with engine.begin() as connection:
+                category = await connection.scalar(
+                    select(table.c.category).where(table.c.id == question_id))
+                result = await connection.execute(
+                    table.delete().where(table.c.id == question_id))
+                if result.rowcount == 0:
+                    abort(404)
+                names = ('questions', 'question_ids') + category_versions([category])
+                await bump_versions(connection, *names)
+        except SQLAlchemyError:
+            abort(500)
+
+        committed(*names)
+        return jsonify({
+            'success': True,
+            'id': question_id,
+            'message': f'Question ID: {question_id} deleted successfully'
+            })
+
+    @app.route('/questions', methods=['POST'])
+    async def create_question():
+        '''
+        An endpoint that creates a question, or searches questions by searchTerm
+            Parameters:
+                None
+            Returns:
+                <success> bool: successful transaction
+                <message> str: response message on successful creation
+                <search_result> dict: a dictionary of questions that matches the search item
+                    this is returned by category to the user, best matches first.
+                    Sending "substring": true matches the term anywhere in a question
+        '''
+        body = await json_body()
+
+        if 'searchTerm' in body.keys():
+            substring = body.get('substring', settings['SEARCH_SUBSTRING'])
+            index = substring_index if substring else search_index
+            matches = index.matches(body['searchTerm'])
+            start, end = search_window(request)
+            async with engine.connect() as connection:
+                category_ids = sorted(
+                    int(key) for key in await category_registry.load(connection))
+                rows = (await connection.execute(
+                    search_statement(matches.subquery(), start, end))).all()
+            search_result = group_search_rows(rows, category_ids, start, end)
+
+            if search_result is None:
+                return (
+                    jsonify({
+                        'success': False,
+                        'error': 404,
+                        'message': 'Question with this term does not exist'}),
+                    404
+                )
+
+            return jsonify(search_result)
+
+        if not all(body.values()):
+            abort(400)
+
+        try:
+            async with engine.begin() as connection:
+                category_ids = {
+                    int(key) for key in await category_registry.load(connection)}
+                values, error = validate_new_question(body, category_ids)
+                if error is not None:
+                    abort(400)
+                columns, rows = with_rating_votes(QUESTION_COLUMNS, [values])
+                await connection.execute(
+                    insert(Question.__table__).values(dict(zip(columns, rows[0]))))
+                names = ('questions', 'question_ids') + category_versions([values[2]])
+                await bump_versions(connection, *names)
+        except SQLAlchemyError:
+            abort(400)
+
+        committed(*names)
+        return jsonify({
+            'success': True,
+            'message': 'Question was successfully created'
+            }), 201
+
+    @app.route('/categories/<int:category_id>/questions')
+    async def get_by_category(category_id):
+        '''
+        An endpoint that gets questions by category
+            Parameters:
+                category_id (int) : category id of questions to be fetched
+            Returns:
+                <success> bool: successful transaction
+                <questions> array: an array of questions
+                <total_questions> int: total number of returned questions
+                <current_category> int: category id of question object
+        '''
+        async with engine.connect() as connection:
+            questions = [Question.format_row(row) for row in await connection.execute(
+                Question.select_rows().where(Question.category == category_id))]
+
+        if len(questions) == 0:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'questions': questions,
+            'total_questions': len(questions),
+            'current_category': category_id
+            })
+
+    @app.route('/quizzes', methods=['POST'])
+    async def play_quizzes():
+        '''
+        An endpoint that enables user to answer questions from series of available questions
+            Parameters:
+                None
+            Returns:
+                <success> bool: successful transaction
+                <question> dict: a question returned at random of selected category
+                <quiz_session> str: token of the server side quiz session, only
+                    returned when the request has a quiz_session key
+        '''
+        body = await json_body()
+
+        token = None
+        if 'quiz_session' in body:
+            token = body['quiz_session']
+            if token:
+                quiz_session = quiz_sessions.load(token)
+                if quiz_session is None:
+                    abort(404)
+                quiz_category, seen = quiz_session
+            else:
+                token = secrets.token_urlsafe(16)
+                quiz_category, seen = body['quiz_category']['id'], SeenSet()
+        else:
+            quiz_category = body['quiz_category']['id']
+            try:
+                seen = parse_previous_questions(body['previous_questions'])
+            except (KeyError, ValueError):
+                abort(400)
+
+        try:
+            async with engine.connect() as connection:
+                choice_question = await quiz_selector.choose_from(
+                    connection, quiz_category, seen)
+        except SQLAlchemyError:
+            abort(404)
+
+        if choice_question is None:
+            return (
+                jsonify({
+                    'success': False,
+                    'error': 404,
+                    'message': 'Questions no longer exist in this category'}),
+                404
+            )
+
+        if token is None:
+            return jsonify({
+                'success': True,
+                'question': choice_question
+                })
+
+        seen.add(choice_question['id'])
+        quiz_sessions.save(token, quiz_category, seen)
+        return jsonify({
+            'success': True,
+            'question': choice_question,
+            'quiz_session': token
+            })
+
+    @app.route('/questions/<int:question_id>', methods=['PATCH'])
+    async def update_rating(question_id):
+        '''
+        An endpoint that records a rating vote for a question, the rating is
+        the mean of its votes
+            Parameters:
+                question_id (int): id of question to be rated
+            Returns:
+                <success> bool: successful transaction
+                <question> dict: the question with the mean of its rating votes
+        '''
+        body = await json_body()
+
+        try:
+            rating = parse_rating(body['rating'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+
+        table = Question.__table__
+        try:
+            async with engine.begin() as connection:
+                result = await connection.execute(
+                    update(table).where(table.c.id == question_id).values(
+                        rating_count=table.c.rating_count + 1,
+                        rating_sum=table.c.rating_sum + rating,
+                        rating=(table.c.rating_sum + rating) / (table.c.rating_count + 1)))
+                if result.rowcount == 0:
+                    abort(404)
+                row = (await connection.execute(
+                    Question.select_rows().where(table.c.id == question_id))).first()
+                names = ('questions',) + category_versions([row.category])
+                await bump_versions(connection, *names)
+        except SQLAlchemyError:
+            abort(400)
+
+        committed(*names)
+        return jsonify({
+            'success': True,
+            'question': Question.format_row(row)
+            })
+
+    @app.route('/categories', methods=['POST'])
+    async def create_category():
+        '''
+        An endpoint that creates a category
+            Parameters:
+                None
+            Returns:
+                <success> bool: successful transaction
+                <message> str: response message on successful creation
+                <categories> dict: a dictionary of category types
+        '''
+        body = await json_body()
+
+        if not all(body.values()) or 'type' not in body.keys():
+            abort(400)
+
+        try:
+            async with engine.begin() as connection:
+                await connection.execute(insert(Category.__table__).values(type=body['type']))
+                await bump_versions(connection, 'categories')
+        except SQLAlchemyError:
+            abort(400)
+
+        committed('categories')
+        category_registry.invalidate()
+        async with engine.connect() as connection:
+            category_dict = await category_registry.load(connection)
+
+        return jsonify({
+            'success': True,
+            'message': 'Category was successfully created',
+            'categories': category_dict
+            }), 201
+
+    @app.errorhandler(400)
+    async def bad_request(error):
+        return (
+            jsonify({
+                'success': False,
+                'error': 400,
+                'message': 'Bad request'}),
+            400
+        )
+
+    @app.errorhandler(404)
+    async def not_found(error):
+        return (
+            jsonify({
+                'success': False,
+                'error': 404,
+                'message': 'Resource not found'}),
+            404
+        )
+
+    @app.errorhandler(422)
+    async def unprocessable_entity(error):
+        return (
+            jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'Unprocessable entity'}),
+            422
+        )
+
+    @app.errorhandler(500)
+    async def server_error(error):
+        return (
+            jsonify({
+                'success': False,
+                'error': 500,
+                'message': 'Server error'}),
+            500
+        )
+
+    return app
@@ -0,0 +1,354 @@
+'''
+This file contains the flask benchmark command measuring the latency of every endpoint
+'''
+import json
+import math
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from models import db, Question
+from .bulk import QUESTION_COLUMNS
+from .generator import QuestionGenerator, ensure_categories, write_questions
+
+SEED_CHUNK_SIZE = 5000
+PERCENTILES = (50, 95, 99)
+
+
+def seed_dataset(questions, categories, seed):
+    '''
+    Adds generated categories and questions until the database holds at least
+    the requested numbers, rows already there are kept
+        Parameters:
+            questions (int): number of questions to reach
+            categories (int): number of categories to reach
+            seed (int): seed of the generator, the same seed gives the same rows
+        Returns:
+            generator (QuestionGenerator): the generator of the dataset
+            dataset (dict): numbers of questions and categories and the rows added
+    '''
+    generator = QuestionGenerator(seed, ensure_categories(categories))
+    question_count = db.session.scalar(select(func.count(Question.id)))
+    added = write_questions(
+        generator.rows(max(questions - question_count, 0)), SEED_CHUNK_SIZE)
+
+    return generator, {
+        'questions': question_count + added,
+        'categories': len(generator.category_ids),
+        'added': added,
+        'seed': seed,
+    }
+
+
+def new_question(generator, rng):
+    '''
+    Returns the body of a POST /questions creating a generated question
+        Parameters:
+            generator (QuestionGenerator): the generator of the dataset
+            rng (random.Random): the generator of the requests
+        Returns:
+            question (dict): a question with every field, rated so creation also writes a vote
+    '''
+    question = dict(zip(QUESTION_COLUMNS, generator.row(rng)))
+    if question['rating'] is None:
+        question['rating'] = rng.randint(1, 5)
+    return question
+
+
+def build_scenarios(generator, dataset, question_ids):
+    '''
+    Returns the request generators of the benchmarked endpoints
+        Parameters:
+            generator (QuestionGenerator): the generator of the dataset
+            dataset (dict): numbers of questions and categories
+            question_ids (list): ids of questions to rate
+        Returns:
+            scenarios (dict): functions of a random generator returning
+                (method, path, JSON body) by scenario name
+    '''
+    # Imported here, flaskr imports this module before defining the page size
+    from . import QUESTIONS_PER_PAGE
+
+    category_ids = generator.category_ids
+    pages = max(math.ceil(dataset['questions'] / QUESTIONS_PER_PAGE), 1)
+    return {
+        'questions_page': lambda rng: (
+            'GET', f'/questions?page={rng.randint(1, pages)}', None),
+        'search': lambda rng: (
+            # Words are drawn by frequency, like the words of the questions
+            'POST', '/questions', {'searchTerm': generator.words(rng, 1)[0]}),
+        # The endpoint is not paginated, it returns every question of the category
+        'category_questions': lambda rng: (
+            'GET', f'/categories/{rng.choice(category_ids)}/questions', None),
+        'quizzes': lambda rng: (
+            'POST', '/quizzes', {
+                'previous_questions': [],
+                'quiz_category': {'id': rng.choice(category_ids + [0]), 'type': 'Benchmark'}
+            }),
+        'create_question': lambda rng: (
+            'POST', '/questions', new_question(generator, rng)),
+        'rate_question': lambda rng: (
+            'PATCH', f'/questions/{rng.choice(question_ids)}', {'rating': rng.randint(1, 5)}),
+    }
+
+
+class Driver:
+    '''
+    A class to send benchmark requests from several threads, to the app in
+    process or to a running server
+    ...
+
+    Attributes
+    ----------
+    app : flask.Flask
+        the app requests are sent to when url is None
+    url : str
+        base URL of a running server, None to call the app in process
+
+    Methods
+    -------
+    send(self, method, path, body):
+        send a request and get its status code
+    '''
+
+    def __init__(self, app, url=None):
+        self.app = app
+        self.url = url.rstrip('/') if url else None
+        self._local = threading.local()
+
+    def send(self, method, path, body):
+        '''
+        Sends a request and waits for the whole response
+            Parameters:
+                method (str): HTTP method
+                path (str): path and query string
+                body (dict): JSON body, None for no body
+            Returns:
+                status (int): status code of the response, 0 for a connection error
+        '''
+        if self.url is None:
+            # Test clients are not shared between threads
+            client = getattr(self._local, 'client', None)
+            if client is None:
+                client = self._local.client = self.app.test_client()
+            response = client.open(path, method=method, json=body)
+            response.get_data()
+            return response.status_code
+
+        data = json.dumps(body).encode() if body is not None else None
+        outgoing = urllib.request.Request(
+            self.url + path, data=data, method=method,
+            headers={'Content-Type': 'application/json'} if data else {})
+        try:
+            with urllib.request.urlopen(outgoing) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+        except urllib.error.URLError:
+            return 0
+
+
+def percentile(ordered, rank):
+    '''
+    Returns a percentile of sorted values, by the nearest-rank method
+        Parameters:
+            ordered (list): values in increasing order
+            rank (float): the percentile, between 0 and 100
+        Returns:
+            value (float): the smallest value above rank percent of the values
+    '''
+    return ordered[max(math.ceil(rank / 100 * len(ordered)) - 1, 0)]
+
+
+def run_scenario(driver, make_request, requests, concurrency, seed):
+    '''
+    Sends requests of a scenario from concurrency threads and measures them
+        Parameters:
+            driver (Driver): sends the requests
+            make_request (function): returns (method, path, JSON body) of a random request
+            requests (int): number of requests to send
+            concurrency (int): number of requests in flight at once
+            seed (int): seed of the random generator of the requests
+        Returns:
+            result (dict): latency percentiles and mean in milliseconds,
+                throughput in requests per second, the requests by status code
+                and the failed requests
+    '''
+    # Drawn up front so the same seed sends the same requests whatever the timing
+    rng = random.Random(seed)
+    planned = [make_request(rng) for _ in range(requests)]
+
+    def timed(request):
+        started_at = time.perf_counter()
+        status = driver.send(*request)
+        return time.perf_counter() - started_at, status
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(timed, planned))
+    seconds = time.perf_counter() - started_at
+
+    latencies = sorted(latency for latency, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    result = {
+        f'p{rank}_ms': percentile(latencies, rank) * 1000 for rank in PERCENTILES
+    }
+    result.update({
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'requests': requests,
+        'statuses': statuses,
+        # 404 is the answer of a search or a category without questions, not a failure
+        'errors': sum(1 for _, status in samples if status == 0 or status >= 500),
+        'throughput_rps': requests / max(seconds, 1e-9),
+    })
+    return result
+
+
+def current_commit(path):
+    '''
+    Returns the commit of the working tree, to label the results
+        Parameters:
+            path (str): a directory of the working tree
+        Returns:
+            commit (str): abbreviated hash, None outside a git checkout
+    '''
+    try:
+        return subprocess.run(
+            ['git', '-C', path, 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous, current):
+    '''
+    Returns the lines comparing the scenarios of two result files
+        Parameters:
+            previous (dict): results of the baseline
+            current (dict): results of this run
+        Returns:
+            lines (list): the change of each measure in percent by scenario
+    '''
+    lines = [f"Compared to {previous.get('commit') or 'previous run'}:"]
+    for name, result in current['scenarios'].items():
+        before = previous.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        changes = []
+        for measure in [f'p{rank}_ms' for rank in PERCENTILES] + ['throughput_rps']:
+            if before.get(measure):
+                change = (result[measure] - before[measure]) / before[measure] * 100
+                changes.append(f'{measure} {change:+.1f}%')
+        lines.append(f"{name:<20} {', '.join(changes)}")
+    return lines
+
+
+@click.command('benchmark')
+@click.option('--questions', default=10000, show_default=True, type=click.IntRange(min=0),
+              help='Questions the database is seeded up to.')
+@click.option('--categories', default=50, show_default=True, type=click.IntRange(min=0),
+              help='Categories the database is seeded up to.')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed of the dataset and of the requests.')
+@click.option('--requests', default=1000, show_default=True, type=click.IntRange(min=1),
+              help='Requests sent per scenario.')
+@click.option('--concurrency', default=8, show_default=True, type=click.IntRange(min=1),
+              help='Requests in flight at once.')
+@click.option('--warmup', default=50, show_default=True, type=click.IntRange(min=0),
+              help='Unmeasured requests sent per scenario first.')
+@click.option('--scenario', 'scenarios', multiple=True,
+              help='Scenario to run, all of them by default.')
+@click.option('--url', default=None,
+              help='Base URL of a running server, the app is called in process by default.')
+@click.option('--output', default='benchmark.json', show_default=True,
+              type=click.Path(dir_okay=False), help='File the results are written to.')
+@click.option('--compare', default=None, type=click.Path(exists=True, dir_okay=False),
+              help='Result file of an earlier run to compare with.')
+@with_appcontext
+def benchmark_command(questions, categories, seed, requests, concurrency, warmup,
+                      scenarios, url, output, compare):
+    '''
+    Seeds the database and measures the latency and throughput of the endpoints.
+    Connection errors and 5xx responses are counted as errors, so requests
+    shed by the admission control are errors. The rate limiter is off in process.
+    The seeded rows and the questions created by the write scenarios stay in
+    the database, run it against a database kept for benchmarks.
+    '''
+    generator, dataset = seed_dataset(questions, categories, seed)
+    click.echo(
+        f"Dataset: {dataset['questions']} questions in {dataset['categories']} categories "
+        f"({dataset['added']} added)")
+
+    question_ids = list(db.session.scalars(select(Question.id).order_by(Question.id).limit(10000)))
+    db.session.remove()
+    available = build_scenarios(generator, dataset, question_ids)
+    unknown = set(scenarios) - set(available)
+    if unknown:
+        raise click.BadParameter(
+            f"Unknown scenario: {', '.join(sorted(unknown))}, "
+            f"choose from {', '.join(available)}")
+    # Scenarios drawing ids from rows the database may not have
+    no_categories = 'categories' if not generator.category_ids else None
+    missing = {
+        'category_questions': no_categories,
+        'create_question': no_categories,
+        'rate_question': 'questions' if not question_ids else None,
+    }
+    selected = list(scenarios or available)
+    for name in [name for name in selected if missing.get(name)]:
+        if scenarios:
+            raise click.UsageError(
+                f'The {name} scenario needs {missing[name]}, seed some with --{missing[name]}')
+        selected.remove(name)
+        click.echo(f'Skipping {name}, the database has no {missing[name]}')
+
+    driver = Driver(current_app._get_current_object(), url)
+    rate_limiter = current_app.extensions['rate_limiter']
+    limited = rate_limiter.enabled
+    # In process every request comes from the same address, the limiter
+    # would refuse most of them, a server run with --url keeps its own settings
+    rate_limiter.enabled = limited and url is not None
+    results = {}
+    try:
+        for offset, name in enumerate(selected):
+            if warmup:
+                run_scenario(driver, available[name], warmup, concurrency, seed - offset - 1)
+            result = run_scenario(driver, available[name], requests, concurrency, seed + offset)
+            results[name] = result
+            click.echo(
+                f"{name:<20} p50 {result['p50_ms']:8.2f}ms  p95 {result['p95_ms']:8.2f}ms  "
+                f"p99 {result['p99_ms']:8.2f}ms  {result['throughput_rps']:8.1f} req/s  "
+                f"{result['errors']} errors")
+    finally:
+        rate_limiter.enabled = limited
+
+    report = {
+        'commit': current_commit(current_app.root_path),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'database': db.engine.dialect.name,
+        'target': url or 'in-process',
+        'dataset': dataset,
+        'requests': requests,
+        'concurrency': concurrency,
+        'scenarios': results,
+    }
+    with open(output, 'w', encoding='utf-8') as results_file:
+        json.dump(report, results_file, indent=2)
+    click.echo(f'Results written to {output}')
+
+    if compare:
+        with open(compare, encoding='utf-8') as previous_file:
+            for line in compare_results(json.load(previous_file), report):
+                click.echo(line)
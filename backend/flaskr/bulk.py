@@ -0,0 +1,350 @@
+'''
+This file contains the batched question writes used by the /questions/bulk endpoints
+'''
+import csv
+import io
+import json
+import math
+import time
+
+from sqlalchemy import (
+    Float, Integer, any_, bindparam, case, column, delete, select, update, values)
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from models import db, Question, TableVersion, category_versions
+
+QUESTION_COLUMNS = ('question', 'answer', 'category', 'difficulty', 'rating')
+MAX_REPORTED_ERRORS = 100
+# Ratings are stars, a vote outside them would skew the mean of every later vote
+MIN_RATING = 0
+MAX_RATING = 5
+
+
+def parse_rating(value):
+    '''
+    Returns a rating sent by the user as a float
+        Parameters:
+            value (object): the rating of a JSON body, a number or a numeric string
+        Returns:
+            rating (float): a finite rating between MIN_RATING and MAX_RATING
+    '''
+    rating = float(value)
+    # "nan" and "inf" parse as floats but are not valid JSON nor a mean of votes
+    if not math.isfinite(rating) or not MIN_RATING <= rating <= MAX_RATING:
+        raise ValueError(f'Rating must be between {MIN_RATING} and {MAX_RATING}')
+    return rating
+
+
+def validate_question(row, category_ids):
+    '''
+    Returns the column values of a question row or the reason it is invalid
+        Parameters:
+            row (dict): a question sent by the user
+            category_ids (set): ids of the existing categories
+        Returns:
+            values (tuple): values ordered as QUESTION_COLUMNS, None if invalid
+            error (str): reason the row is invalid, None if valid
+    '''
+    if not isinstance(row, dict):
+        return None, 'Question must be an object'
+
+    missing = [
+        field for field in ('question', 'answer', 'category', 'difficulty')
+        if row.get(field) in (None, '')
+        ]
+    if missing:
+        return None, f"Missing {', '.join(missing)}"
+
+    try:
+        category = int(row['category'])
+        difficulty = int(row['difficulty'])
+        rating = None if row.get('rating') in (None, '') else parse_rating(row['rating'])
+    except (TypeError, ValueError):
+        return None, (
+            'category and difficulty must be integers and rating a number '
+            f'between {MIN_RATING} and {MAX_RATING}')
+
+    if category not in category_ids:
+        return None, f'Category {category} does not exist'
+
+    return (str(row['question']), str(row['answer']), category, difficulty, rating), None
+
+
+def validate_new_question(body, category_ids):
+    '''
+    Returns the column values of a question sent to POST /questions or the reason
+    it is invalid, unlike a bulk row it may not have keys other than QUESTION_COLUMNS
+        Parameters:
+            body (dict): the JSON body of the request
+            category_ids (set): ids of the existing categories
+        Returns:
+            values (tuple): values ordered as QUESTION_COLUMNS, None if invalid
+            error (str): reason the question is invalid, None if valid
+    '''
+    unknown = sorted(set(body) - set(QUESTION_COLUMNS)) if isinstance(body, dict) else []
+    if unknown:
+        return None, f"Unknown {', '.join(unknown)}"
+    return validate_question(body, category_ids)
+
+
+def iter_ndjson(stream):
+    '''
+    Yields the numbered rows of a NDJSON stream one line at a time
+        Parameters:
+            stream (file): a binary stream of JSON objects separated by newlines
+        Returns:
+            rows (generator): (row number, row) pairs, row is None if the line is not JSON
+    '''
+    number = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def with_rating_votes(columns, rows):
+    '''
+    Returns question columns and rows counting a supplied rating as one vote,
+    as migration 1 counts existing ratings
+        Parameters:
+            columns (tuple): names of the inserted columns
+            rows (list): tuples of values ordered as columns
+        Returns:
+            columns (tuple): the columns followed by rating_count and rating_sum
+            rows (list): the rows followed by their vote count and sum
+    '''
+    if 'rating' not in columns or 'rating_count' in columns:
+        return columns, rows
+    rating = columns.index('rating')
+    return tuple(columns) + ('rating_count', 'rating_sum'), [
+        tuple(row) + ((0, 0) if row[rating] is None else (1, row[rating])) for row in rows]
+
+
+def insert_rows(table, columns, rows):
+    '''
+    Inserts rows in the current transaction with COPY on PostgreSQL and
+    a single executemany on other databases
+        Parameters:
+            table (sqlalchemy.Table): table to insert into
+            columns (tuple): names of the inserted columns
+            rows (list): tuples of values ordered as columns
+        Returns:
+            None
+    '''
+    if table is Question.__table__:
+        columns, rows = with_rating_votes(columns, rows)
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        return
+
+    connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def insert_questions(rows):
+    '''
+    Inserts and commits a batch of questions
+        Parameters:
+            rows (list): tuples of values ordered as QUESTION_COLUMNS
+        Returns:
+            None
+    '''
+    insert_rows(Question.__table__, QUESTION_COLUMNS, rows)
+    category = QUESTION_COLUMNS.index('category')
+    names = ('questions', 'question_ids') + category_versions(row[category] for row in rows)
+    TableVersion.bump(*names)
+    db.session.commit()
+    TableVersion.mark_committed(*names)
+    Question.reset_count()
+
+
+def ingest_questions(numbered_rows, category_ids, batch_size):
+    '''
+    Validates questions one at a time and inserts the valid ones in batches
+        Parameters:
+            numbered_rows (iterable): (row number, row) pairs
+            category_ids (set): ids of the existing categories
+            batch_size (int): number of questions inserted per transaction
+        Returns:
+            report (dict): inserted and failed counts, the first errors by row
+                number and the ingestion throughput
+    '''
+    started_at = time.perf_counter()
+    inserted = 0
+    failed = 0
+    errors = []
+    batch = []
+
+    for number, row in numbered_rows:
+        question_values, error = validate_question(row, category_ids)
+        if error is not None:
+            failed += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'row': number, 'error': error})
+            continue
+
+        batch.append(question_values)
+        if len(batch) >= batch_size:
+            insert_questions(batch)
+            inserted += len(batch)
+            batch = []
+
+    if batch:
+        insert_questions(batch)
+        inserted += len(batch)
+
+    seconds = time.perf_counter() - started_at
+    return {
+        'inserted': inserted,
+        'failed': failed,
+        'errors': errors,
+        'rows_per_second': round((inserted + failed) / seconds) if seconds else 0
+        }
+
+
+def chunked(values, size):
+    '''
+    Yields consecutive slices of a list
+        Parameters:
+            values (list): values to split
+            size (int): maximum length of a slice
+        Returns:
+            chunks (generator): slices of values
+    '''
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def question_filter(filters):
+    '''
+    Returns the WHERE clauses of a bulk filter or None if it is invalid or empty
+        Parameters:
+            filters (dict): optional category (int) and rating_below (float) keys
+        Returns:
+            clauses (list): clauses selecting the filtered questions
+    '''
+    clauses = []
+    try:
+        if filters.get('category') is not None:
+            clauses.append(Question.category == int(filters['category']))
+        if filters.get('rating_below') is not None:
+            clauses.append(Question.rating < float(filters['rating_below']))
+    except (TypeError, ValueError):
+        return None
+    return clauses or None
+
+
+def delete_questions(ids=None, clauses=None, chunk_size=500):
+    '''
+    Deletes questions by id or by filter with set based statements and commits
+        Parameters:
+            ids (list): ids of the questions to delete
+            clauses (list): WHERE clauses used when ids is None
+            chunk_size (int): maximum number of ids per statement
+        Returns:
+            deleted_ids (list): ids of the deleted questions
+    '''
+    table = Question.__table__
+    postgresql = db.session.connection().dialect.name == 'postgresql'
+    # (id, category) of the deleted questions, the categories are invalidated
+    deleted = []
+
+    if ids is None:
+        if postgresql:
+            deleted = db.session.execute(
+                delete(table).where(*clauses).returning(table.c.id, table.c.category)).all()
+        else:
+            deleted = db.session.execute(
+                select(table.c.id, table.c.category).where(*clauses)).all()
+            for chunk in chunked([row.id for row in deleted], chunk_size):
+                db.session.execute(delete(table).where(table.c.id.in_(chunk)))
+    else:
+        for chunk in chunked(ids, chunk_size):
+            if postgresql:
+                statement = delete(table).where(
+                    table.c.id == any_(bindparam('ids', chunk, type_=ARRAY(Integer)))
+                    ).returning(table.c.id, table.c.category)
+                deleted.extend(db.session.execute(statement).all())
+            else:
+                found = db.session.execute(
+                    select(table.c.id, table.c.category).where(table.c.id.in_(chunk))).all()
+                db.session.execute(
+                    delete(table).where(table.c.id.in_([row.id for row in found])))
+                deleted.extend(found)
+
+    names = ('questions', 'question_ids') + category_versions(row.category for row in deleted)
+    TableVersion.bump(*names)
+    db.session.commit()
+    TableVersion.mark_committed(*names)
+    Question.reset_count()
+    deleted_ids = [row.id for row in deleted]
+    return deleted_ids
+
+
+def update_ratings(ratings=None, clauses=None, rating=None, chunk_size=500):
+    '''
+    Sets the rating of questions by id or by filter with set based statements and commits.
+    The sum of votes is rebased on the new rating so later votes average from it.
+        Parameters:
+            ratings (dict): new ratings by question id
+            clauses (list): WHERE clauses used when ratings is None
+            rating (float): rating given to the filtered questions
+            chunk_size (int): maximum number of questions per statement
+        Returns:
+            updated_ids (list): ids of the updated questions
+    '''
+    table = Question.__table__
+    postgresql = db.session.connection().dialect.name == 'postgresql'
+    # (id, category) of the updated questions, the categories are invalidated
+    updated = []
+    # A question without votes gets the new rating as its first vote
+    votes = case((table.c.rating_count > 0, table.c.rating_count), else_=1)
+
+    if ratings is None:
+        statement = update(table).where(*clauses).values(
+            rating=rating, rating_count=votes, rating_sum=rating * votes)
+        if postgresql:
+            updated = db.session.execute(
+                statement.returning(table.c.id, table.c.category)).all()
+        else:
+            updated = db.session.execute(
+                select(table.c.id, table.c.category).where(*clauses)).all()
+            db.session.execute(statement)
+    else:
+        for chunk in chunked(list(ratings.items()), chunk_size):
+            if postgresql:
+                # UPDATE questions SET rating = v.rating FROM (VALUES ...) AS v WHERE id = v.id
+                new_ratings = values(
+                    column('id', Integer), column('rating', Float), name='new_ratings'
+                    ).data(chunk)
+                statement = update(table).where(table.c.id == new_ratings.c.id).values(
+                    rating=new_ratings.c.rating,
+                    rating_count=votes,
+                    rating_sum=new_ratings.c.rating * votes
+                    ).returning(table.c.id, table.c.category)
+                updated.extend(db.session.execute(statement).all())
+            else:
+                chunk_ids = [question_id for question_id, _ in chunk]
+                found = db.session.execute(
+                    select(table.c.id, table.c.category).where(table.c.id.in_(chunk_ids))).all()
+                new_rating = case(dict(chunk), value=table.c.id)
+                db.session.execute(
+                    update(table).where(table.c.id.in_([row.id for row in found])).values(
+                        rating=new_rating, rating_count=votes, rating_sum=new_rating * votes))
+                updated.extend(found)
+
+    names = ('questions',) + category_versions(row.category for row in updated)
+    TableVersion.bump(*names)
+    db.session.commit()
+    TableVersion.mark_committed(*names)
+    updated_ids = [row.id for row in updated]
+    return updated_ids
@@ -0,0 +1,246 @@
+'''
+This file contains the response cache of GET /categories/<id>/questions
+'''
+import hashlib
+import sqlite3
+import time
+
+from .storage import ByteCappedLRU, SQLiteFile
+
+# Entries written to the SQLite cache between two evictions beyond max_bytes
+SQLITE_EVICT_EVERY = 100
+
+
+class MemoryResponseCache:
+    '''
+    A class to keep response bodies in process memory with the version of the
+    data they were built from. An entry is served while the version is current
+    and for at most ttl seconds, the least recently used entries are evicted
+    beyond max_bytes.
+    ...
+
+    Attributes
+    ----------
+    max_bytes : int
+        maximum total size of the cached bodies
+    ttl : float
+        seconds an entry is served, 0 to serve it until its version changes
+
+    Methods
+    -------
+    get(self, key, version):
+        get a cached body built from a version
+    set(self, key, version, data):
+        cache a body built from a version
+    clear(self):
+        drop every cached body
+    '''
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = ByteCappedLRU(max_bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        '''
+        Returns a cached body if it was built from version and has not expired
+            Parameters:
+                key (str): category of the request
+                version (int): current version of the data of the response
+            Returns:
+                data (bytes): the cached body or None if it must be built again
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        entry_version, expires_at, data = entry
+        if entry_version != version or (self.ttl and expires_at < time.monotonic()):
+            self._entries.discard(key, entry)
+            return None
+        return data
+
+    def set(self, key, version, data):
+        '''
+        Caches a body built from a version
+            Parameters:
+                key (str): category of the request
+                version (int): version of the data read before building the body
+                data (bytes): the response body
+            Returns:
+                None
+        '''
+        self._entries.set(key, (version, time.monotonic() + self.ttl, data), len(data))
+
+    def clear(self):
+        '''
+        Drops every cached body
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        self._entries.clear()
+
+
+class SQLiteResponseCache:
+    '''
+    A class to keep response bodies in a SQLite file shared by the workers of a
+    host, so a page built by one worker is served by all of them. Entries are
+    checked against the version of their data like MemoryResponseCache, and the
+    least recently used are evicted beyond max_bytes. Keys are prefixed with
+    namespace, so apps on different databases can share the file.
+    ...
+
+    Attributes
+    ----------
+    file : SQLiteFile
+        the SQLite file of the cache
+    max_bytes : int
+        maximum total size of the cached bodies
+    ttl : float
+        seconds an entry is served, 0 to serve it until its version changes
+    namespace : str
+        prefix of the keys of this cache in the file
+
+    Methods
+    -------
+    get(self, key, version):
+        get a cached body built from a version
+    set(self, key, version, data):
+        cache a body built from a version
+    clear(self):
+        drop every cached body
+    '''
+
+    def __init__(self, path, max_bytes, ttl, namespace='', timeout=1.0):
+        self.file = SQLiteFile(path, timeout)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.namespace = namespace
+        self._writes = 0
+        self.file.connection().execute(
+            'CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, '
+            'version INTEGER NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL, '
+            'body BLOB NOT NULL)')
+
+    def get(self, key, version):
+        '''
+        Returns a cached body if it was built from version and has not expired
+            Parameters:
+                key (str): category of the request
+                version (int): current version of the data of the response
+            Returns:
+                data (bytes): the cached body or None if it must be built again
+        '''
+        now = time.time()
+        key = self.namespace + key
+        connection = self.file.connection()
+        try:
+            row = connection.execute(
+                'SELECT version, expires_at, body FROM response_cache WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            entry_version, expires_at, data = row
+            if entry_version != version or (self.ttl and expires_at < now):
+                # Another worker may have written the current version meanwhile
+                connection.execute(
+                    'DELETE FROM response_cache WHERE key = ? AND version = ?',
+                    (key, entry_version))
+                return None
+            connection.execute('UPDATE response_cache SET used_at = ? WHERE key = ?', (now, key))
+        except sqlite3.Error:
+            # A locked or broken cache file is a cache miss, not a failed request
+            return None
+        return data
+
+    def set(self, key, version, data):
+        '''
+        Caches a body built from a version
+            Parameters:
+                key (str): category of the request
+                version (int): version of the data read before building the body
+                data (bytes): the response body
+            Returns:
+                None
+        '''
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        key = self.namespace + key
+        try:
+            self.file.connection().execute(
+                'INSERT OR REPLACE INTO response_cache (key, version, expires_at, used_at, body) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, version, now + self.ttl, now, data))
+            self._writes += 1
+            if self._writes % SQLITE_EVICT_EVERY == 0:
+                self._evict()
+        except sqlite3.Error:
+            # The body is built again by the next request
+            return
+
+    def _evict(self):
+        '''
+        Deletes the least recently used entries until the bodies fit in max_bytes
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        with self.file.transaction() as connection:
+            size = connection.execute(
+                'SELECT coalesce(sum(length(body)), 0) FROM response_cache').fetchone()[0]
+            if size > self.max_bytes:
+                # The running total keeps the entries up to the last one that fits
+                connection.execute(
+                    'DELETE FROM response_cache WHERE key IN (SELECT key FROM ('
+                    'SELECT key, sum(length(body)) OVER (ORDER BY used_at DESC) AS total '
+                    'FROM response_cache) WHERE total > ?)',
+                    (self.max_bytes,))
+
+    def clear(self):
+        '''
+        Drops every cached body of this namespace
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        self.file.connection().execute(
+            'DELETE FROM response_cache WHERE substr(key, 1, ?) = ?',
+            (len(self.namespace), self.namespace))
+
+
+def database_namespace(url):
+    '''
+    Returns the key prefix of the responses read from a database
+        Parameters:
+            url (sqlalchemy.engine.URL): url of the database
+        Returns:
+            namespace (str): a hash of the url without its password
+    '''
+    identity = url.render_as_string(hide_password=True)
+    return hashlib.sha256(identity.encode()).hexdigest()[:16] + ':'
+
+
+def create_response_cache(kind, max_bytes, ttl, path, namespace=''):
+    '''
+    Returns the response cache selected by configuration
+        Parameters:
+            kind (str): "memory" or "sqlite"
+            max_bytes (int): maximum total size of the cached bodies
+            ttl (float): seconds an entry is served, 0 to serve it until its version changes
+            path (str): path of the SQLite file
+            namespace (str): prefix of the keys in the SQLite file
+        Returns:
+            cache (MemoryResponseCache or SQLiteResponseCache): a response cache
+    '''
+    if kind == 'sqlite':
+        return SQLiteResponseCache(path, max_bytes, ttl, namespace)
+    if kind == 'memory':
+        return MemoryResponseCache(max_bytes, ttl)
+    raise ValueError(f'Unknown response cache: {kind}')
@@ -0,0 +1,151 @@
+'''
+This file contains the negotiated compression of responses
+'''
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .storage import ByteCappedLRU
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+
+def supported_encodings():
+    '''
+    Returns the content codings this server can produce, preferred first
+        Parameters:
+            None
+        Returns:
+            encodings (list): "br" when the brotli package is installed and "gzip"
+    '''
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def etag_variants(etag):
+    '''
+    Returns the entity tags of every representation of a response
+        Parameters:
+            etag (str): entity tag of the uncompressed response
+        Returns:
+            etags (list): the entity tag and the tags of its compressed bodies
+    '''
+    return [etag] + [f'{etag}+{encoding}' for encoding in supported_encodings()]
+
+
+def compress(data, encoding, level):
+    '''
+    Returns a compressed body
+        Parameters:
+            data (bytes): the uncompressed body
+            encoding (str): "br" or "gzip"
+            level (int): compression level from 1 to 9
+        Returns:
+            data (bytes): the compressed body
+    '''
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+class CompressedBodyCache:
+    '''
+    A class to keep compressed bodies of cacheable responses, keyed by URL,
+    ETag and encoding, evicting the least recently used beyond max_bytes
+    ...
+
+    Attributes
+    ----------
+    max_bytes : int
+        maximum total size of the cached bodies
+
+    Methods
+    -------
+    get(self, key):
+        get a cached compressed body
+    set(self, key, data):
+        cache a compressed body
+    clear(self):
+        drop every cached body
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._bodies = ByteCappedLRU(max_bytes)
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def get(self, key):
+        '''
+        Returns a cached compressed body
+            Parameters:
+                key (tuple): URL, ETag and encoding of the response
+            Returns:
+                data (bytes): the compressed body or None if it is not cached
+        '''
+        return self._bodies.get(key)
+
+    def set(self, key, data):
+        '''
+        Caches a compressed body
+            Parameters:
+                key (tuple): URL, ETag and encoding of the response
+                data (bytes): the compressed body
+            Returns:
+                None
+        '''
+        self._bodies.set(key, data, len(data))
+
+    def clear(self):
+        '''
+        Drops every cached body
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        self._bodies.clear()
+
+
+def compress_response(request_obj, response, cache, min_size, level):
+    '''
+    Compresses a response body with the best encoding accepted by the client.
+    Bodies of responses with an ETag are compressed once and then served from cache.
+        Parameters:
+            request (flask.Request): A request object
+            response (flask.Response): A response object
+            cache (CompressedBodyCache): compressed bodies of responses with an ETag
+            min_size (int): bodies smaller than this are sent uncompressed
+            level (int): compression level from 1 to 9
+        Returns:
+            response (flask.Response): the response, compressed if worth it
+    '''
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if response.content_length is not None and response.content_length < min_size:
+        return response
+
+    encoding = request_obj.accept_encodings.best_match(supported_encodings())
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (request_obj.full_path, etag, encoding)
+    data = cache.get(key) if etag else None
+    if data is None:
+        data = compress(response.get_data(), encoding, level)
+        if etag:
+            cache.set(key, data)
+
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(f'{etag}+{encoding}', weak)
+    return response
@@ -0,0 +1,47 @@
+'''
+This file contains the streamed export of the question bank
+'''
+import csv
+import io
+
+from models import db, Question, QUESTION_FIELDS
+from .serialization import dumps_lines
+
+# Mimetype and file extension of each export format
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+
+
+def export_questions(filters, export_format, chunk_size):
+    '''
+    Yields the filtered questions ordered by id, chunk_size rows at a time.
+    Rows are read through a server side cursor so memory use does not grow
+    with the number of exported questions.
+        Parameters:
+            filters (list): WHERE clauses selecting the exported questions
+            export_format (str): a key of EXPORT_FORMATS
+            chunk_size (int): number of rows fetched and written at a time
+        Returns:
+            chunks (generator): encoded lines of chunk_size questions
+    '''
+    statement = Question.select_rows().where(*filters).order_by(Question.id)
+    result = db.session.execute(statement, execution_options={'stream_results': True})
+
+    try:
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(QUESTION_FIELDS)
+            for rows in result.partitions(chunk_size):
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            for rows in result.partitions(chunk_size):
+                yield dumps_lines(Question.format_row(row) for row in rows)
+    finally:
+        result.close()
@@ -0,0 +1,277 @@
+'''
+This file contains the synthetic question generator and the flask generate-questions command
+'''
+import csv
+import itertools
+import os
+import random
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from models import db, Category
+from .bulk import QUESTION_COLUMNS, insert_questions
+from .loader import write_chunk
+from .serialization import dumps_lines
+
+VOCABULARY_SIZE = 5000
+CATEGORY_SKEW = 1.1
+WORD_SKEW = 1.0
+WORD_TABLE_SIZE = 1 << 18
+CONSONANTS = 'bcdfghklmnprstvz'
+VOWELS = 'aeiou'
+OPENINGS = (
+    'What is', 'Which', 'Who wrote', 'Where is', 'When did', 'How many',
+    'In which year was', 'What was the name of', 'Which country has',
+)
+ANSWER_LENGTHS = (1, 1, 1, 2, 2, 3)
+DIFFICULTIES = (1, 2, 3, 4, 5)
+# Half of the questions are unrated
+RATINGS = (None, None, None, None, None, 1, 2, 3, 4, 5)
+GENERATOR_BATCH_SIZE = 1000
+OUTPUT_FORMATS = ('.ndjson', '.jsonl', '.csv')
+
+
+def build_vocabulary(rng, size):
+    '''
+    Returns distinct pronounceable words of one to four syllables
+        Parameters:
+            rng (random.Random): the generator of the dataset
+            size (int): number of words
+        Returns:
+            vocabulary (list): the words, in the order of their frequency rank
+    '''
+    words = set()
+    vocabulary = []
+    while len(vocabulary) < size:
+        word = ''.join(
+            rng.choice(CONSONANTS) + rng.choice(VOWELS)
+            for _ in range(rng.randint(1, 4)))
+        if word not in words:
+            words.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+
+def zipf_weights(count, exponent):
+    '''
+    Returns the cumulative weights of a Zipf distribution over count ranks
+        Parameters:
+            count (int): number of ranks
+            exponent (float): skew, 0 for uniform, the first rank is the most frequent
+        Returns:
+            weights (list): cumulative weights for random.choices
+    '''
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+class QuestionGenerator:
+    '''
+    A class to generate realistic question rows from a seed.
+    Categories and words follow Zipf distributions, so a few categories hold
+    most questions and a few words appear in most texts, and question lengths
+    follow a lognormal distribution. The same seed gives the same rows.
+    ...
+
+    Attributes
+    ----------
+    category_ids : list
+        ids of the categories questions belong to, the first is the largest
+    vocabulary : list
+        the words of the questions, the first is the most frequent
+    rng : random.Random
+        the generator of the rows
+
+    Methods
+    -------
+    batch(self, rng, count):
+        get count question rows drawn from rng
+    row(self, rng=None):
+        get the column values of a question
+    rows(self, count):
+        get count question rows
+    '''
+
+    def __init__(self, seed, category_ids, category_skew=CATEGORY_SKEW,
+                 vocabulary_size=VOCABULARY_SIZE):
+        self.rng = random.Random(seed)
+        self.category_ids = list(category_ids)
+        self.vocabulary = build_vocabulary(random.Random(seed), vocabulary_size)
+        self._category_weights = zipf_weights(len(self.category_ids), category_skew)
+        # Words repeated by frequency, an unweighted draw from the table is
+        # several times faster than a weighted draw from the vocabulary
+        weights = zipf_weights(len(self.vocabulary), WORD_SKEW)
+        scale = WORD_TABLE_SIZE / weights[-1]
+        self._word_table = [
+            word
+            for word, weight, previous in zip(self.vocabulary, weights, [0] + weights)
+            for _ in range(max(round((weight - previous) * scale), 1))
+        ]
+
+    def words(self, rng, count):
+        '''
+        Returns words drawn by frequency
+            Parameters:
+                rng (random.Random): the generator to draw from
+                count (int): number of words
+            Returns:
+                words (list): the drawn words
+        '''
+        return rng.choices(self._word_table, k=count)
+
+    def batch(self, rng, count):
+        '''
+        Returns question rows, every column is drawn for the whole batch at once
+            Parameters:
+                rng (random.Random): the generator to draw from
+                count (int): number of rows
+            Returns:
+                rows (list): tuples ordered as QUESTION_COLUMNS
+        '''
+        lognormal = rng.lognormvariate
+        # Mostly short questions with a long tail, between 3 and 60 words
+        lengths = [min(max(int(lognormal(2.0, 0.6)), 3), 60) for _ in range(count)]
+        answer_lengths = rng.choices(ANSWER_LENGTHS, k=count)
+        words = self.words(rng, sum(lengths) + sum(answer_lengths))
+        openings = rng.choices(OPENINGS, k=count)
+        categories = rng.choices(self.category_ids, cum_weights=self._category_weights, k=count)
+        difficulties = rng.choices(DIFFICULTIES, k=count)
+        ratings = rng.choices(RATINGS, k=count)
+
+        rows = []
+        position = 0
+        for index, length in enumerate(lengths):
+            question = f"{openings[index]} {' '.join(words[position:position + length])}?"
+            position += length
+            answer_end = position + answer_lengths[index]
+            answer = ' '.join(words[position:answer_end]).title()
+            position = answer_end
+            rows.append((question, answer, categories[index], difficulties[index], ratings[index]))
+        return rows
+
+    def row(self, rng=None):
+        '''
+        Returns the column values of a question
+            Parameters:
+                rng (random.Random): the generator to draw from, the one of the dataset by default
+            Returns:
+                values (tuple): values ordered as QUESTION_COLUMNS
+        '''
+        return self.batch(rng or self.rng, 1)[0]
+
+    def rows(self, count):
+        '''
+        Yields question rows
+            Parameters:
+                count (int): number of rows
+            Returns:
+                rows (generator): tuples ordered as QUESTION_COLUMNS
+        '''
+        while count > 0:
+            size = min(count, GENERATOR_BATCH_SIZE)
+            yield from self.batch(self.rng, size)
+            count -= size
+
+
+def ensure_categories(count):
+    '''
+    Creates categories until the database holds at least count of them
+        Parameters:
+            count (int): number of categories to reach
+        Returns:
+            category_ids (list): ids of every category, in increasing order
+    '''
+    existing = db.session.scalar(select(func.count(Category.id)))
+    if existing < count:
+        write_chunk('categories', [
+            {'type': f'Generated {number}'} for number in range(existing + 1, count + 1)])
+    return list(db.session.scalars(select(Category.id).order_by(Category.id)))
+
+
+def write_questions(rows, chunk_size):
+    '''
+    Inserts rows into the database in transactions of chunk_size rows,
+    the search index is updated once at the end
+        Parameters:
+            rows (iterable): tuples ordered as QUESTION_COLUMNS
+            chunk_size (int): number of rows inserted per transaction
+        Returns:
+            written (int): number of rows inserted
+    '''
+    rows = iter(rows)
+    written = 0
+    with current_app.extensions['search_index'].deferred(db.engine):
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return written
+            insert_questions(chunk)
+            written += len(chunk)
+
+
+def write_file(path, rows):
+    '''
+    Writes rows to a NDJSON or CSV file that flask load-questions can load
+        Parameters:
+            path (str): path of a .ndjson, .jsonl or .csv file
+            rows (iterable): tuples ordered as QUESTION_COLUMNS
+        Returns:
+            written (int): number of rows written
+    '''
+    rows = iter(rows)
+    written = 0
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, 'w', newline='', encoding='utf-8') as output:
+            writer = csv.writer(output)
+            writer.writerow(QUESTION_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+        return written
+
+    with open(path, 'wb') as output:
+        while True:
+            chunk = list(itertools.islice(rows, GENERATOR_BATCH_SIZE))
+            if not chunk:
+                return written
+            output.write(dumps_lines(dict(zip(QUESTION_COLUMNS, row)) for row in chunk))
+            written += len(chunk)
+
+
+@click.command('generate-questions')
+@click.option('--count', default=100000, show_default=True, help='Questions generated.')
+@click.option('--categories', default=50, show_default=True,
+              help='Categories the database is filled up to.')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed of the generator, the same seed gives the same questions.')
+@click.option('--skew', default=CATEGORY_SKEW, show_default=True,
+              help='Zipf exponent of the category sizes, 0 for even categories.')
+@click.option('--output', default=None, type=click.Path(dir_okay=False),
+              help='A .ndjson, .jsonl or .csv file to write instead of the database.')
+@click.option('--chunk-size', default=5000, show_default=True,
+              help='Rows inserted per transaction.')
+@with_appcontext
+def generate_questions_command(count, categories, seed, skew, output, chunk_size):
+    '''
+    Generates synthetic questions into the database or a file.
+    Missing categories are always created in the database, the questions
+    of a file reference them.
+    '''
+    if output and os.path.splitext(output)[1].lower() not in OUTPUT_FORMATS:
+        raise click.BadParameter(f"Unsupported file type: {output}")
+
+    started_at = time.perf_counter()
+    generator = QuestionGenerator(seed, ensure_categories(categories), skew)
+    rows = generator.rows(count)
+    if output:
+        written = write_file(output, rows)
+    else:
+        written = write_questions(rows, chunk_size)
+    seconds = time.perf_counter() - started_at
+    click.echo(
+        f"Generated {written} questions in {len(generator.category_ids)} categories "
+        f"to {output or 'the database'} in {seconds:.2f}s "
+        f"({written / max(seconds, 1e-9):.0f} rows/s)")
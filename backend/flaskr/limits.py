@@ -0,0 +1,307 @@
+'''
+This file contains the per-client rate limiter and the admission control of the API
+'''
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .storage import SQLiteFile
+
+# Tokens taken by a request to each endpoint, the other endpoints take DEFAULT_COST.
+# The metrics endpoints are free so a scraper is never limited or shed
+DEFAULT_COST = 1
+ROUTE_COSTS = {
+    'get_categories': 1,
+    'get_questions': 1,
+    'get_by_category': 1,
+    'play_quizzes': 2,
+    'search_questions': 5,
+    'bulk_create_questions': 10,
+    'bulk_delete_questions': 10,
+    'bulk_update_ratings': 10,
+    'export_all_questions': 20,
+    'get_pool_metrics': 0,
+    'get_metrics': 0,
+}
+# Buckets not updated for this many refill periods are removed from the SQLite store
+SQLITE_CLEANUP_EVERY = 1000
+
+
+def request_cost(endpoint, body, costs=None):
+    '''
+    Returns the tokens a request takes
+        Parameters:
+            endpoint (str): the flask endpoint of the request, None when no route matched
+            body (dict): the JSON body of the request, None without one
+            costs (dict): tokens by endpoint, ROUTE_COSTS by default
+        Returns:
+            cost (int): number of tokens, 0 for a request that is never limited
+    '''
+    costs = ROUTE_COSTS if costs is None else costs
+    # A search shares POST /questions with question creation
+    if endpoint == 'create_question' and isinstance(body, dict) and body.get('searchTerm') is not None:
+        endpoint = 'search_questions'
+    return costs.get(endpoint, DEFAULT_COST)
+
+
+def client_key(remote_addr, api_key=None):
+    '''
+    Returns the key of the bucket of a client
+        Parameters:
+            remote_addr (str): address of the client
+            api_key (str): the X-API-Key header, clients sending one share its bucket
+        Returns:
+            key (str): the bucket key, API keys are hashed so the store never holds them
+    '''
+    if api_key:
+        return 'key:' + hashlib.sha256(api_key.encode()).hexdigest()[:32]
+    return f'ip:{remote_addr}'
+
+
+def take_tokens(tokens, updated, now, cost, rate, burst):
+    '''
+    Refills a token bucket and takes the tokens of a request from it
+        Parameters:
+            tokens (float): tokens left at the last update, None for a new bucket
+            updated (float): time of the last update in seconds
+            now (float): the current time in seconds
+            cost (int): tokens taken by the request
+            rate (float): tokens added per second
+            burst (int): size of the bucket
+        Returns:
+            tokens (float): tokens left in the bucket
+            retry_after (float): seconds until the request could be served, 0 if it is served
+    '''
+    if tokens is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + max(now - updated, 0) * rate)
+    # A request costing more than the bucket holds is served from a full bucket
+    cost = min(cost, burst)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryRateLimitStore:
+    '''
+    A class to keep the token buckets in process memory, evicting the least
+    recently used bucket beyond capacity, an evicted client starts with a full bucket
+    ...
+
+    Attributes
+    ----------
+    capacity : int
+        maximum number of buckets kept
+
+    Methods
+    -------
+    take(self, key, cost, rate, burst):
+        take the tokens of a request from the bucket of a client
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, rate, burst):
+        '''
+        Takes the tokens of a request from the bucket of a client
+            Parameters:
+                key (str): the bucket key of the client
+                cost (int): tokens taken by the request
+                rate (float): tokens added per second
+                burst (int): size of the bucket
+            Returns:
+                retry_after (float): seconds until the request could be served, 0 if it is served
+        '''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (None, now))
+            tokens, retry_after = take_tokens(tokens, updated, now, cost, rate, burst)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.capacity:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class SQLiteRateLimitStore:
+    '''
+    A class to keep the token buckets in a SQLite file, shared by the workers of a host.
+    Each bucket is read and written in one immediate transaction, so concurrent
+    workers take tokens one after the other.
+    ...
+
+    Attributes
+    ----------
+    file : SQLiteFile
+        the SQLite file of the buckets
+
+    Methods
+    -------
+    take(self, key, cost, rate, burst):
+        take the tokens of a request from the bucket of a client
+    '''
+
+    def __init__(self, path, timeout=1.0):
+        self.file = SQLiteFile(path, timeout)
+        self._takes = 0
+        self.file.connection().execute(
+            'CREATE TABLE IF NOT EXISTS rate_buckets '
+            '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def take(self, key, cost, rate, burst):
+        '''
+        Takes the tokens of a request from the bucket of a client
+            Parameters:
+                key (str): the bucket key of the client
+                cost (int): tokens taken by the request
+                rate (float): tokens added per second
+                burst (int): size of the bucket
+            Returns:
+                retry_after (float): seconds until the request could be served, 0 if it is served
+        '''
+        now = time.time()
+        with self.file.transaction() as connection:
+            row = connection.execute(
+                'SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (None, now)
+            tokens, retry_after = take_tokens(tokens, updated, now, cost, rate, burst)
+            connection.execute(
+                'INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, '
+                'updated = excluded.updated',
+                (key, tokens, now))
+            self._takes += 1
+            if self._takes % SQLITE_CLEANUP_EVERY == 0:
+                # A bucket idle for a whole refill is full, the same as no bucket
+                connection.execute(
+                    'DELETE FROM rate_buckets WHERE updated < ?', (now - burst / rate,))
+        return retry_after
+
+
+def create_rate_limit_store(kind, capacity, path):
+    '''
+    Returns the token bucket store selected by configuration
+        Parameters:
+            kind (str): "memory" or "sqlite"
+            capacity (int): maximum number of buckets kept in memory
+            path (str): path of the SQLite file
+        Returns:
+            store (MemoryRateLimitStore or SQLiteRateLimitStore): a token bucket store
+    '''
+    if kind == 'sqlite':
+        return SQLiteRateLimitStore(path)
+    if kind == 'memory':
+        return MemoryRateLimitStore(capacity)
+    raise ValueError(f'Unknown rate limit store: {kind}')
+
+
+class RateLimiter:
+    '''
+    A class to limit the requests of each client with a token bucket.
+    A bucket holds burst tokens and gains rate tokens per second, each request
+    takes the tokens of its endpoint and is refused when the bucket holds too few.
+    ...
+
+    Attributes
+    ----------
+    store : MemoryRateLimitStore or SQLiteRateLimitStore
+        the token buckets of the clients
+    rate : float
+        tokens added to a bucket per second
+    burst : int
+        size of a bucket
+    costs : dict
+        tokens taken by a request by endpoint
+    enabled : bool
+        False lets every request through
+
+    Methods
+    -------
+    check(self, key, cost):
+        take the tokens of a request and get the seconds to wait before retrying
+    '''
+
+    def __init__(self, store, rate, burst, costs=None, enabled=True):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.costs = ROUTE_COSTS if costs is None else costs
+        self.enabled = enabled
+
+    def check(self, key, cost):
+        '''
+        Takes the tokens of a request from the bucket of a client
+            Parameters:
+                key (str): the bucket key of the client
+                cost (int): tokens taken by the request
+            Returns:
+                retry_after (int): whole seconds to wait before retrying, 0 if the request is served
+        '''
+        if not self.enabled or cost <= 0:
+            return 0
+        try:
+            retry_after = self.store.take(key, cost, self.rate, self.burst)
+        except sqlite3.Error:
+            # A locked or broken store must not take the API down with it
+            return 0
+        return math.ceil(retry_after)
+
+
+class AdmissionControl:
+    '''
+    A class to shed requests beyond a number handled at once, so requests are
+    refused quickly instead of queueing for a database connection
+    ...
+
+    Attributes
+    ----------
+    max_in_flight : int
+        requests handled at once, 0 for no limit
+    timeout : float
+        seconds a request waits for another one to finish before it is shed
+    retry_after : int
+        seconds a shed client is asked to wait
+
+    Methods
+    -------
+    enter(self):
+        start handling a request if there is room for it
+    leave(self):
+        finish handling a request admitted by enter
+    '''
+
+    def __init__(self, max_in_flight, timeout=0.0, retry_after=1):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+
+    def enter(self):
+        '''
+        Starts handling a request if fewer than max_in_flight are handled
+            Parameters:
+                None
+            Returns:
+                admitted (bool): True if the request must be handled and then passed to leave
+        '''
+        if self._slots is None:
+            return True
+        return self._slots.acquire(timeout=self.timeout)
+
+    def leave(self):
+        '''
+        Finishes handling a request admitted by enter
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        if self._slots is not None:
+            self._slots.release()
@@ -0,0 +1,230 @@
+'''
+This file contains the flask load-questions command used to seed large question banks
+'''
+import csv
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from models import db, Category, Question, TableVersion, category_versions
+from .bulk import QUESTION_COLUMNS, insert_rows, validate_question
+
+COPY_START = re.compile(r'^COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;$')
+COPY_ESCAPE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+TABLES = {'questions': Question.__table__, 'categories': Category.__table__}
+
+
+def unescape_copy_value(value):
+    '''
+    Returns a column value of a COPY text row
+        Parameters:
+            value (str): a tab separated field of a COPY row
+        Returns:
+            value (str): the field with escapes replaced, None for \\N
+    '''
+    if value == '\\N':
+        return None
+
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] == 'x' and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        if escape.isdigit():
+            return chr(int(escape, 8))
+        return COPY_ESCAPES.get(escape, escape)
+
+    return COPY_ESCAPE.sub(replace, value)
+
+
+def read_psql(path):
+    '''
+    Yields the rows of the COPY blocks of a pg_dump file, one line at a time
+        Parameters:
+            path (str): path of the dump
+        Returns:
+            rows (generator): (table name, row) pairs, None marks the end of a block
+    '''
+    with open(path, encoding='utf-8') as dump:
+        table, columns = None, None
+        for line in dump:
+            line = line.rstrip('\n')
+            if table is None:
+                match = COPY_START.match(line)
+                if match and match.group(1) in TABLES:
+                    table = match.group(1)
+                    columns = [column.strip() for column in match.group(2).split(',')]
+            elif line == '\\.':
+                yield table, None
+                table = None
+            else:
+                values = [unescape_copy_value(value) for value in line.split('\t')]
+                yield table, dict(zip(columns, values))
+
+
+def read_csv(path):
+    '''
+    Yields the questions of a CSV file with a header row
+        Parameters:
+            path (str): path of the file
+        Returns:
+            rows (generator): ('questions', row) pairs
+    '''
+    with open(path, newline='', encoding='utf-8') as questions:
+        for row in csv.DictReader(questions):
+            yield 'questions', row
+
+
+def read_ndjson(path):
+    '''
+    Yields the questions of a NDJSON file
+        Parameters:
+            path (str): path of the file
+        Returns:
+            rows (generator): ('questions', row) pairs, row is empty if a line is not JSON
+    '''
+    with open(path, encoding='utf-8') as questions:
+        for line in questions:
+            if not line.strip():
+                continue
+            try:
+                yield 'questions', json.loads(line)
+            except ValueError:
+                yield 'questions', {}
+
+
+READERS = {
+    '.psql': read_psql,
+    '.sql': read_psql,
+    '.csv': read_csv,
+    '.ndjson': read_ndjson,
+    '.jsonl': read_ndjson,
+}
+
+
+def write_chunk(table, rows):
+    '''
+    Inserts and commits a chunk of rows of one table
+        Parameters:
+            table (str): name of the table
+            rows (list): dictionaries with the same keys
+        Returns:
+            None
+    '''
+    columns = tuple(rows[0])
+    insert_rows(TABLES[table], columns, [tuple(row[column] for column in columns) for row in rows])
+    if table == 'categories':
+        names = ('categories',)
+    else:
+        names = ('questions', 'question_ids') + category_versions(row['category'] for row in rows)
+    TableVersion.bump(*names)
+    db.session.commit()
+    TableVersion.mark_committed(*names)
+
+
+def load_file(path, chunk_size):
+    '''
+    Loads a file in chunks of chunk_size rows
+        Parameters:
+            path (str): path of a .psql, .sql, .csv, .ndjson or .jsonl file
+            chunk_size (int): number of rows inserted per transaction
+        Returns:
+            report (dict): loaded and skipped rows and the load time
+    '''
+    reader = READERS[os.path.splitext(path)[1].lower()]
+    started_at = time.perf_counter()
+    category_ids = {category_id for (category_id,) in db.session.query(Category.id)}
+    loaded, skipped = 0, 0
+    chunks = {'questions': [], 'categories': []}
+
+    for table, row in reader(path):
+        chunk = chunks[table]
+        if row is None:
+            # End of a dump block, categories must exist before their questions
+            if chunk:
+                write_chunk(table, chunk)
+                loaded += len(chunk)
+                chunks[table] = []
+            if table == 'categories':
+                category_ids = {category_id for (category_id,) in db.session.query(Category.id)}
+            continue
+
+        if reader is not read_psql:
+            values, error = validate_question(row, category_ids)
+            if error is not None:
+                skipped += 1
+                continue
+            row = dict(zip(QUESTION_COLUMNS, values))
+
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            write_chunk(table, chunk)
+            loaded += len(chunk)
+            chunks[table] = []
+
+    for table, chunk in chunks.items():
+        if chunk:
+            write_chunk(table, chunk)
+            loaded += len(chunk)
+
+    if reader is read_psql and db.engine.dialect.name == 'postgresql':
+        # Rows of a dump keep their ids, move the sequences past them
+        for table in TABLES:
+            db.session.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"coalesce(max(id), 1)) FROM {table}"
+            ))
+        db.session.commit()
+
+    Question.reset_count()
+    return {
+        'path': path,
+        'loaded': loaded,
+        'skipped': skipped,
+        'seconds': time.perf_counter() - started_at
+        }
+
+
+@click.command('load-questions')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=5000, show_default=True,
+              help='Rows inserted per transaction.')
+@click.option('--workers', default=1, show_default=True,
+              help='Files loaded in parallel, each file being one shard.')
+@with_appcontext
+def load_questions_command(paths, chunk_size, workers):
+    '''
+    Loads questions from .psql/.sql dumps, CSV and NDJSON files.
+    Rows are streamed in chunks and written with COPY on PostgreSQL
+    and batched executemany on other databases.
+    '''
+    unknown = [path for path in paths if os.path.splitext(path)[1].lower() not in READERS]
+    if unknown:
+        raise click.BadParameter(f"Unsupported file type: {', '.join(unknown)}")
+
+    app = current_app._get_current_object()
+
+    def load_shard(path):
+        with app.app_context():
+            return load_file(path, chunk_size)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        reports = list(executor.map(load_shard, paths))
+    seconds = time.perf_counter() - started_at
+
+    for report in reports:
+        click.echo(
+            f"{report['path']}: {report['loaded']} rows loaded, {report['skipped']} skipped "
+            f"in {report['seconds']:.2f}s "
+            f"({report['loaded'] / max(report['seconds'], 1e-9):.0f} rows/s)"
+        )
+    total = sum(report['loaded'] for report in reports)
+    click.echo(f'Total: {total} rows in {seconds:.2f}s ({total / max(seconds, 1e-9):.0f} rows/s)')
@@ -0,0 +1,462 @@
+'''
+This file contains the request and database metrics exposed in Prometheus text format
+'''
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import pool_metrics
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+# pool_metrics() keys exported as gauges, the others are totals
+POOL_GAUGES = ('size', 'checked_in', 'checked_out', 'overflow')
+POOL_COUNTERS = ('checkouts', 'wait_seconds', 'timeouts')
+
+
+def escape_label(value):
+    '''
+    Returns a label value escaped for the Prometheus text format
+        Parameters:
+            value (str): a label value
+        Returns:
+            value (str): the value with backslashes, quotes and newlines escaped
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    '''
+    Returns the label set of a sample
+        Parameters:
+            names (tuple): label names
+            values (tuple): label values in the order of names
+        Returns:
+            labels (str): {name="value",...}, empty without labels
+    '''
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def format_value(value):
+    '''
+    Returns a sample value in the Prometheus text format
+        Parameters:
+            value (float): a sample value
+        Returns:
+            value (str): the value, without a decimal part when it is whole
+    '''
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    '''
+    A base class for metrics, holding one value per label set
+    ...
+
+    Attributes
+    ----------
+    name : str
+        name of the metric
+    documentation : str
+        HELP text of the metric
+    labelnames : tuple
+        names of the labels of the metric
+
+    Methods
+    -------
+    merge(self, values, other):
+        add the values of another process to values
+    render(self, values):
+        get the lines of the metric in the Prometheus text format
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def merge(self, values, other):
+        '''
+        Adds the values of another process to values
+            Parameters:
+                values (dict): values by label set, updated in place
+                other (dict): values by label set of another process
+            Returns:
+                None
+        '''
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def samples(self, labels, value):
+        '''
+        Yields the samples of a label set
+            Parameters:
+                labels (tuple): label values
+                value (object): value of the label set
+            Returns:
+                samples (generator): (name, label names, label values, value) tuples
+        '''
+        yield self.name, self.labelnames, labels, value
+
+    def render(self, values):
+        '''
+        Returns the lines of the metric in the Prometheus text format
+            Parameters:
+                values (dict): values by label set
+            Returns:
+                lines (list): HELP, TYPE and sample lines
+        '''
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labels in sorted(values):
+            for name, names, label_values, value in self.samples(labels, values[labels]):
+                lines.append(
+                    f'{name}{format_labels(names, label_values)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    '''
+    A metric holding a total that only goes up
+    '''
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    '''
+    A metric holding a current value, the values of several processes are summed
+    '''
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    '''
+    A metric counting observations in cumulative buckets, with their sum and count.
+    A label set holds the count of each bucket, the observations above the last
+    bucket, their sum and their count.
+    ...
+
+    Attributes
+    ----------
+    buckets : tuple
+        upper bounds of the buckets, increasing
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_value(self):
+        '''
+        Returns the value of a label set without observations
+            Parameters:
+                None
+            Returns:
+                value (list): zero counts, then the sum and the count
+        '''
+        return [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+    def observe(self, value, observation):
+        '''
+        Records an observation in the value of a label set
+            Parameters:
+                value (list): value of the label set, updated in place
+                observation (float): the observed value
+            Returns:
+                None
+        '''
+        index = len(self.buckets)
+        for position, bound in enumerate(self.buckets):
+            if observation <= bound:
+                index = position
+                break
+        value[index] += 1
+        value[-2] += observation
+        value[-1] += 1
+
+    def merge(self, values, other):
+        for labels, value in other.items():
+            merged = values.setdefault(labels, self.new_value())
+            for position, count in enumerate(value):
+                merged[position] += count
+
+    def samples(self, labels, value):
+        names = self.labelnames + ('le',)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value):
+            cumulative += count
+            yield f'{self.name}_bucket', names, labels + (format_value(bound),), cumulative
+        yield f'{self.name}_sum', self.labelnames, labels, value[-2]
+        yield f'{self.name}_count', self.labelnames, labels, value[-1]
+
+
+class RequestMetrics:
+    '''
+    A class to record the latency, size and status of every request, and the
+    SQL queries run and the database time spent by each request.
+    With a metrics directory each process writes its values to a file of the
+    directory, at most once per flush interval, and a scrape of any process
+    reports the sum of all the files.
+    ...
+
+    Attributes
+    ----------
+    metrics_dir : str
+        directory shared by the worker processes, None for a single process
+    flush_interval : float
+        seconds between two writes of the values of this process
+
+    Methods
+    -------
+    install(self, app):
+        record the requests of a flask app
+    record_request(self, endpoint, method, status, seconds, size, queries, db_seconds):
+        record a handled request
+    flush(self, pool):
+        write the values of this process to the metrics directory
+    render(self, pool=None):
+        get the metrics of every process in the Prometheus text format
+    '''
+
+    def __init__(self, metrics_dir=None, flush_interval=1.0):
+        self.metrics_dir = metrics_dir or None
+        self.flush_interval = flush_interval
+        self.duration = Histogram(
+            'trivia_http_request_duration_seconds',
+            'Time spent handling requests by endpoint and method.',
+            ('endpoint', 'method'), LATENCY_BUCKETS)
+        self.size = Histogram(
+            'trivia_http_response_size_bytes',
+            'Size of response bodies by endpoint.',
+            ('endpoint',), SIZE_BUCKETS)
+        self.requests = Counter(
+            'trivia_http_requests_total',
+            'Requests handled by endpoint, method and status code.',
+            ('endpoint', 'method', 'status'))
+        self.queries = Counter(
+            'trivia_db_queries_total',
+            'SQL statements run while handling requests, by endpoint.',
+            ('endpoint',))
+        self.db_seconds = Counter(
+            'trivia_db_seconds_total',
+            'Time spent running SQL statements while handling requests, by endpoint.',
+            ('endpoint',))
+        self.pool = {
+            name: Gauge(f'trivia_db_pool_{name}', f'Connection pool {name.replace("_", " ")}.')
+            for name in POOL_GAUGES
+        }
+        self.pool.update({
+            name: Counter(
+                f'trivia_db_pool_{name}_total', f'Connection pool {name.replace("_", " ")}.')
+            for name in POOL_COUNTERS
+        })
+        self._metrics = (self.duration, self.size, self.requests, self.queries, self.db_seconds)
+        self._values = {metric.name: {} for metric in self._metrics}
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+
+    def install(self, app):
+        '''
+        Records the requests of a flask app and the queries they run
+            Parameters:
+                app (flask.Flask): the app to instrument
+            Returns:
+                None
+        '''
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_cursor_error)
+
+        @app.before_request
+        def start_request_metrics():
+            g.metrics_started_at = time.perf_counter()
+            g.db_queries = 0
+            g.db_seconds = 0.0
+
+        # Registered before the other after_request hooks, so it runs last
+        # and measures the compressed body
+        @app.after_request
+        def record_request_metrics(response):
+            started_at = g.get('metrics_started_at')
+            if started_at is None:
+                return response
+            self.record_request(
+                request.endpoint or 'unmatched',
+                request.method,
+                response.status_code,
+                time.perf_counter() - started_at,
+                response.calculate_content_length(),
+                g.db_queries,
+                g.db_seconds
+            )
+            if self.metrics_dir and time.monotonic() - self._flushed_at >= self.flush_interval:
+                self.flush(app.extensions['sqlalchemy'].db.engine.pool)
+            return response
+
+    def record_request(self, endpoint, method, status, seconds, size, queries, db_seconds):
+        '''
+        Records a handled request
+            Parameters:
+                endpoint (str): endpoint of the request, "unmatched" for unknown URLs
+                method (str): HTTP method of the request
+                status (int): status code of the response
+                seconds (float): time spent handling the request
+                size (int): size of the response body, None if it is streamed
+                queries (int): SQL statements run by the request
+                db_seconds (float): time spent running them
+            Returns:
+                None
+        '''
+        name = endpoint
+        with self._lock:
+            values = self._values
+            self.duration.observe(
+                values[self.duration.name].setdefault(
+                    (name, method), self.duration.new_value()),
+                seconds)
+            if size is not None:
+                self.size.observe(
+                    values[self.size.name].setdefault((name,), self.size.new_value()), size)
+            requests = values[self.requests.name]
+            requests[(name, method, str(status))] = (
+                requests.get((name, method, str(status)), 0) + 1)
+            for metric, amount in ((self.queries, queries), (self.db_seconds, db_seconds)):
+                totals = values[metric.name]
+                totals[(name,)] = totals.get((name,), 0) + amount
+
+    def snapshot(self, pool=None):
+        '''
+        Returns a copy of the values of this process, with the pool state
+            Parameters:
+                pool (dict): pool_metrics() of the engine of this process
+            Returns:
+                snapshot (dict): values by label set by metric name
+        '''
+        with self._lock:
+            snapshot = {
+                name: {labels: list(value) if isinstance(value, list) else value
+                       for labels, value in values.items()}
+                for name, values in self._values.items()
+            }
+        for name, metric in self.pool.items():
+            if pool is not None and name in pool:
+                snapshot[metric.name] = {(): pool[name]}
+        return snapshot
+
+    def flush(self, pool):
+        '''
+        Writes the values of this process to its file of the metrics directory
+            Parameters:
+                pool (sqlalchemy.pool.Pool): pool of the engine of this process
+            Returns:
+                None
+        '''
+        snapshot = self.snapshot(pool_metrics(pool) if pool is not None else None)
+        document = {
+            name: [[list(labels), value] for labels, value in values.items()]
+            for name, values in snapshot.items()
+        }
+        path = os.path.join(self.metrics_dir, f'metrics-{os.getpid()}.json')
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as output:
+            json.dump(document, output)
+        # Readers never see a partly written file
+        os.replace(temporary, path)
+        self._flushed_at = time.monotonic()
+
+    def collect(self, pool=None):
+        '''
+        Returns the values of every process, summed by label set
+            Parameters:
+                pool (sqlalchemy.pool.Pool): pool of the engine of this process
+            Returns:
+                values (dict): values by label set by metric name
+        '''
+        if not self.metrics_dir:
+            return self.snapshot(pool_metrics(pool) if pool is not None else None)
+
+        self.flush(pool)
+        metrics = {metric.name: metric for metric in self._metrics + tuple(self.pool.values())}
+        values = {name: {} for name in metrics}
+        for path in glob.glob(os.path.join(self.metrics_dir, 'metrics-*.json')):
+            try:
+                with open(path, encoding='utf-8') as source:
+                    document = json.load(source)
+            except (OSError, ValueError):
+                continue
+            for name, pairs in document.items():
+                if name in metrics:
+                    metrics[name].merge(
+                        values[name], {tuple(labels): value for labels, value in pairs})
+        return values
+
+    def render(self, pool=None):
+        '''
+        Returns the metrics of every process in the Prometheus text format
+            Parameters:
+                pool (sqlalchemy.pool.Pool): pool of the engine of this process
+            Returns:
+                text (str): the exposition of every metric
+        '''
+        values = self.collect(pool)
+        lines = []
+        for metric in self._metrics + tuple(self.pool.values()):
+            if values.get(metric.name):
+                lines.extend(metric.render(values[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    '''
+    Notes the start time of a SQL statement run while handling a request
+    '''
+    if has_request_context():
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    '''
+    Adds a SQL statement and the time it took to the current request
+    '''
+    record_query(conn)
+
+
+def handle_cursor_error(exception_context):
+    '''
+    Adds a failed SQL statement to the current request, after_cursor_execute is
+    not called for it and its start time would stay on the connection
+    '''
+    if exception_context.connection is not None:
+        record_query(exception_context.connection)
+
+
+def record_query(conn):
+    '''
+    Pops the start time of the last statement of a connection and adds the
+    statement and the time it took to the current request
+        Parameters:
+            conn (sqlalchemy.engine.Connection): connection that ran the statement
+        Returns:
+            None
+    '''
+    started = conn.info.get('query_started_at')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_seconds = g.get('db_seconds', 0.0) + seconds
@@ -0,0 +1,216 @@
+'''
+This file contains the versioned schema migrations and the flask migrate command
+'''
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, select, text
+
+from models import db, SchemaMigration, PGBOUNCER_MODE
+from .search import SEARCH_LANGUAGE, create_search_index
+
+# Key of the PostgreSQL advisory lock held while migrating, so that workers
+# starting together do not apply the same migration twice. The lock belongs to
+# a server session, so it is not taken through PgBouncer transaction pooling.
+MIGRATION_LOCK_KEY = 7254311
+BACKFILL_BATCH_SIZE = 5000
+
+MIGRATIONS = {}
+
+
+def migration(version, description):
+    '''
+    Registers a migration function under a version number.
+    Migrations run on an autocommit connection where every statement commits
+    on its own, so they must be safe to run again after failing halfway.
+        Parameters:
+            version (int): number of the migration, migrations run in increasing order
+            description (str): what the migration changes
+        Returns:
+            decorator (function): registers the decorated function
+    '''
+    def register(upgrade):
+        MIGRATIONS[version] = (description, upgrade)
+        return upgrade
+    return register
+
+
+def create_index(connection, name, table, columns, method=None):
+    '''
+    Creates an index if it does not exist, without blocking writes on PostgreSQL
+        Parameters:
+            connection (sqlalchemy.engine.Connection): an autocommit connection
+            name (str): name of the index
+            table (str): name of the indexed table
+            columns (tuple): names of the indexed columns
+            method (str): index method such as GIN, the default method if None
+        Returns:
+            None
+    '''
+    if connection.dialect.name == 'postgresql':
+        # A failed concurrent build leaves an invalid index behind, build it again
+        invalid = connection.execute(text(
+            'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'
+        ), {'name': name}).first()
+        if invalid:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY {name}'))
+        concurrently = 'CONCURRENTLY '
+    else:
+        concurrently = ''
+
+    using = f'USING {method} ' if method else ''
+    connection.execute(text(
+        f"CREATE INDEX {concurrently}IF NOT EXISTS {name} "
+        f"ON {table} {using}({', '.join(columns)})"
+    ))
+
+
+@migration(1, 'Count rating votes')
+def add_rating_votes(connection):
+    '''
+    Adds the rating_count and rating_sum columns, counting an existing rating as one vote.
+    The backfill commits every BACKFILL_BATCH_SIZE ids so no lock is held for long.
+    '''
+    columns = {column['name'] for column in inspect(connection).get_columns('questions')}
+    if 'rating_count' not in columns:
+        connection.execute(text(
+            'ALTER TABLE questions ADD COLUMN rating_count integer DEFAULT 0 NOT NULL'))
+    if 'rating_sum' not in columns:
+        connection.execute(text(
+            'ALTER TABLE questions ADD COLUMN rating_sum float DEFAULT 0 NOT NULL'))
+
+    max_id = connection.execute(text('SELECT max(id) FROM questions')).scalar() or 0
+    for start in range(0, max_id, BACKFILL_BATCH_SIZE):
+        connection.execute(text(
+            'UPDATE questions SET rating_count = 1, rating_sum = rating '
+            'WHERE id > :start AND id <= :end '
+            'AND rating IS NOT NULL AND rating_count = 0'
+        ), {'start': start, 'end': start + BACKFILL_BATCH_SIZE})
+
+
+@migration(2, 'Index questions by category')
+def index_question_categories(connection):
+    '''
+    Indexes the category filters of GET /categories/<id>/questions and POST /quizzes
+    '''
+    create_index(connection, 'ix_questions_category', 'questions', ('category',))
+    create_index(connection, 'ix_questions_category_id', 'questions', ('category', 'id'))
+    create_index(
+        connection, 'ix_questions_category_difficulty', 'questions', ('category', 'difficulty'))
+
+
+@migration(3, 'Reference categories from questions')
+def reference_categories(connection):
+    '''
+    Adds a foreign key from questions.category to categories.id on PostgreSQL.
+    The key is added NOT VALID, which only checks new rows, then validated
+    by a second statement that does not block reads or writes.
+    SQLite cannot add a constraint to an existing table, its databases get
+    the key from the model when they are created.
+    '''
+    if connection.dialect.name != 'postgresql':
+        return
+
+    foreign_keys = inspect(connection).get_foreign_keys('questions')
+    if any(key['constrained_columns'] == ['category'] for key in foreign_keys):
+        # Databases restored from trivia.psql already have one
+        return
+
+    connection.execute(text(
+        'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+        'FOREIGN KEY (category) REFERENCES categories (id) NOT VALID'
+    ))
+    connection.execute(text('ALTER TABLE questions VALIDATE CONSTRAINT questions_category_fkey'))
+
+
+@migration(4, 'Index question search')
+def index_question_search(connection):
+    '''
+    Adds the search structures of POST /questions searchTerm. On PostgreSQL a
+    tsvector column generated from questions.question, which rewrites the table
+    once, and its GIN index built concurrently. On SQLite an FTS5 table kept in
+    sync by triggers.
+    '''
+    if connection.dialect.name == 'postgresql':
+        columns = {column['name'] for column in inspect(connection).get_columns('questions')}
+        if 'search_vector' not in columns:
+            connection.execute(text(
+                'ALTER TABLE questions ADD COLUMN search_vector tsvector '
+                'GENERATED ALWAYS AS '
+                f"(to_tsvector('{SEARCH_LANGUAGE}', coalesce(question, ''))) STORED"
+            ))
+        create_index(
+            connection, 'ix_questions_search_vector', 'questions', ('search_vector',), 'GIN')
+        return
+
+    create_search_index(connection, SEARCH_LANGUAGE).install(connection)
+
+
+def applied_versions(connection):
+    '''
+    Returns the versions of the migrations applied to the database
+        Parameters:
+            connection (sqlalchemy.engine.Connection): a connection to the database
+        Returns:
+            versions (set): numbers of the applied migrations
+    '''
+    return set(connection.execute(select(SchemaMigration.version)).scalars())
+
+
+def run_migrations(engine):
+    '''
+    Applies the pending migrations in order and records each one in schema_migrations
+        Parameters:
+            engine (sqlalchemy.engine.Engine): engine of the questions database
+        Returns:
+            applied (list): (version, description) of the migrations applied
+    '''
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    applied = []
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        locked = connection.dialect.name == 'postgresql' and not PGBOUNCER_MODE
+        if locked:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        try:
+            done = applied_versions(connection)
+            for version in sorted(MIGRATIONS):
+                if version in done:
+                    continue
+                description, upgrade = MIGRATIONS[version]
+                upgrade(connection)
+                connection.execute(SchemaMigration.__table__.insert().values(
+                    version=version, description=description, applied_at=time.time()))
+                applied.append((version, description))
+        finally:
+            if locked:
+                connection.execute(
+                    text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+    return applied
+
+
+@click.command('migrate')
+@click.option('--status', is_flag=True, help='List the migrations without applying them.')
+@with_appcontext
+def migrate_command(status):
+    '''
+    Applies the pending schema migrations.
+    Indexes are built concurrently on PostgreSQL, so a live database keeps serving.
+    '''
+    if status:
+        SchemaMigration.__table__.create(db.engine, checkfirst=True)
+        with db.engine.connect() as connection:
+            done = applied_versions(connection)
+        for version in sorted(MIGRATIONS):
+            state = 'applied' if version in done else 'pending'
+            click.echo(f'{version:>4} {state:<8} {MIGRATIONS[version][0]}')
+        return
+
+    applied = run_migrations(db.engine)
+    for version, description in applied:
+        click.echo(f'Applied {version}: {description}')
+    click.echo(f'{len(applied)} migrations applied')
@@ -0,0 +1,365 @@
+'''
+This file contains the random question selection used by the quiz
+'''
+import random
+import threading
+import time
+from array import array
+
+from models import db, Question, QuizSession, category_versions
+
+from .storage import ByteCappedLRU
+
+# Memory counted per session of MemoryQuizSessionStore besides its token and seen ids
+SESSION_OVERHEAD = 200
+# Seconds between two deletions of expired sessions from the quiz_sessions table
+CLEANUP_INTERVAL = 60.0
+
+
+def parse_previous_questions(value):
+    '''
+    Returns the previous_questions of a quiz request as a set
+        Parameters:
+            value (object): the previous_questions of the JSON body
+        Returns:
+            seen (set): ids of the questions already sent to the player
+    '''
+    if not isinstance(value, list) or not all(
+            isinstance(question_id, int) and not isinstance(question_id, bool)
+            for question_id in value):
+        raise ValueError('previous_questions must be a list of question ids')
+    return set(value)
+
+
+def ids_version(category_id):
+    '''
+    Returns the name of the table version the question ids of a category follow
+        Parameters:
+            category_id (int): id of the quiz category, 0 for all categories
+        Returns:
+            name (str): question_ids for all categories, else the version of the category
+    '''
+    if category_id == 0:
+        return 'question_ids'
+    return category_versions([category_id])[0]
+
+
+class QuizSelector:
+    '''
+    A class to draw a random unseen question without loading the questions of a category.
+    The ids of each category are kept in memory and reloaded when the table version
+    of that category changes, or question_ids for all categories, so a write only
+    reloads the ids of its category. A candidate is drawn by rejection sampling
+    against the seen ids and only the drawn question is fetched from the database.
+    ...
+
+    Attributes
+    ----------
+    tracker : VersionTracker
+        source of the table versions of the categories
+    max_attempts : int
+        random draws tried before falling back to a scan of the category ids
+
+    Methods
+    -------
+    choose(self, category_id, seen):
+        get a random question of a category that is not in seen
+    invalidate(self):
+        drop the ids loaded for every category
+    '''
+
+    def __init__(self, tracker, max_attempts=32):
+        self.tracker = tracker
+        self.max_attempts = max_attempts
+        # (version, ids) by category id
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def choose(self, category_id, seen):
+        '''
+        Returns a random question of a category that has not been seen
+            Parameters:
+                category_id (int): id of the quiz category, 0 for all categories
+                seen (Container): ids of questions already sent to the player
+            Returns:
+                question (Question): a random unseen question or None if none is left
+        '''
+        for _ in range(2):
+            question_id = self._draw(self._category_ids(category_id), seen)
+            if question_id is None:
+                return None
+
+            question = db.session.get(Question, question_id)
+            if question is not None:
+                return question
+
+            # The question was deleted by another process since the ids were loaded
+            self.invalidate()
+        return None
+
+    def invalidate(self):
+        '''
+        Drops the ids loaded for every category
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        self._ids = {}
+
+    def _category_ids(self, category_id):
+        '''
+        Returns the ids of the questions in a category, loading them if they are stale
+            Parameters:
+                category_id (int): id of the quiz category, 0 for all categories
+            Returns:
+                ids (array): ids of the questions in the category
+        '''
+        version, ids = self._cached_ids(category_id)
+        if ids is None:
+            with self._lock:
+                query = db.session.query(Question.id)
+                if category_id != 0:
+                    query = query.filter(Question.category == category_id)
+                ids = array('q', (row.id for row in query))
+                self._ids[category_id] = (version, ids)
+        return ids
+
+    def _cached_ids(self, category_id):
+        '''
+        Returns the ids loaded for a category if its table version is unchanged
+            Parameters:
+                category_id (int): id of the quiz category, 0 for all categories
+            Returns:
+                version (int): current version of the ids of the category
+                ids (array): ids of the questions in the category, None if stale
+        '''
+        version = self.tracker.version(ids_version(category_id))
+        loaded = self._ids.get(category_id)
+        if loaded is None or loaded[0] != version:
+            return version, None
+        return version, loaded[1]
+
+    def _draw(self, ids, seen):
+        '''
+        Returns a random id that is not in seen
+            Parameters:
+                ids (array): ids to draw from
+                seen (Container): ids that must not be drawn
+            Returns:
+                question_id (int): an unseen id or None if every id was seen
+        '''
+        if not ids:
+            return None
+
+        if len(seen) < len(ids):
+            for _ in range(self.max_attempts):
+                question_id = ids[random.randrange(len(ids))]
+                if question_id not in seen:
+                    return question_id
+
+        # Most ids were seen, pick from the ones left
+        remaining = [question_id for question_id in ids if question_id not in seen]
+        return random.choice(remaining) if remaining else None
+
+
+class SeenSet:
+    '''
+    A class to represent the question ids sent to a player. Its bytes are the
+    sorted ids as varint encoded gaps, a few bytes per seen question whatever
+    the size of the ids.
+    ...
+
+    Methods
+    -------
+    add(self, question_id):
+        mark a question id as seen
+    to_bytes(self):
+        get the seen ids as bytes
+    '''
+
+    def __init__(self, data=b''):
+        self._ids = set(decode_seen(data))
+
+    def __contains__(self, question_id):
+        return question_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, question_id):
+        '''
+        Marks a question id as seen
+            Parameters:
+                question_id (int): id of a question sent to the player
+            Returns:
+                None
+        '''
+        self._ids.add(question_id)
+
+    def to_bytes(self):
+        '''
+        Returns the seen ids as bytes
+            Parameters:
+                None
+            Returns:
+                data (bytes): the encoded ids, readable by SeenSet(data)
+        '''
+        data = bytearray()
+        previous = 0
+        for question_id in sorted(self._ids):
+            gap = question_id - previous
+            previous = question_id
+            while gap >= 0x80:
+                data.append(gap & 0x7F | 0x80)
+                gap >>= 7
+            data.append(gap)
+        return bytes(data)
+
+
+def decode_seen(data):
+    '''
+    Returns the ids encoded by SeenSet.to_bytes
+        Parameters:
+            data (bytes): the encoded ids
+        Returns:
+            ids (list): the seen question ids
+    '''
+    ids = []
+    question_id, gap, shift = 0, 0, 0
+    for byte in data:
+        gap |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        question_id += gap
+        ids.append(question_id)
+        gap, shift = 0, 0
+    return ids
+
+
+class MemoryQuizSessionStore:
+    '''
+    A class to keep quiz sessions in process memory as encoded bytes,
+    evicting the least recently used sessions beyond max_bytes
+    ...
+
+    Attributes
+    ----------
+    max_bytes : int
+        maximum total size of the sessions kept
+    ttl : float
+        seconds a session is kept after its last question
+
+    Methods
+    -------
+    load(self, token):
+        get the category and seen set of a session
+    save(self, token, category_id, seen):
+        store the category and seen set of a session
+    '''
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions = ByteCappedLRU(max_bytes)
+
+    def load(self, token):
+        '''
+        Returns the category and seen set of a session
+            Parameters:
+                token (str): token of the quiz session
+            Returns:
+                quiz_session (tuple): (category_id, seen) or None if unknown or expired
+        '''
+        entry = self._sessions.get(token)
+        if entry is None:
+            return None
+        category_id, data, last_used = entry
+        if last_used + self.ttl < time.time():
+            self._sessions.discard(token, entry)
+            return None
+        return category_id, SeenSet(data)
+
+    def save(self, token, category_id, seen):
+        '''
+        Stores the category and seen set of a session
+            Parameters:
+                token (str): token of the quiz session
+                category_id (int): id of the quiz category, 0 for all categories
+                seen (SeenSet): ids of questions already sent to the player
+            Returns:
+                None
+        '''
+        data = seen.to_bytes()
+        self._sessions.set(token, (category_id, data, time.time()), session_size(token, data))
+
+
+def session_size(token, data):
+    '''
+    Returns the memory counted for a session of MemoryQuizSessionStore
+        Parameters:
+            token (str): token of the quiz session
+            data (bytes): the encoded seen ids
+        Returns:
+            size (int): bytes of the token and seen ids and the fixed cost of an entry
+    '''
+    return len(token) + len(data) + SESSION_OVERHEAD
+
+
+class DatabaseQuizSessionStore:
+    '''
+    A class to keep quiz sessions in the quiz_sessions table, shared by all processes
+    ...
+
+    Attributes
+    ----------
+    ttl : float
+        seconds a session is kept after its last question
+    cleanup_interval : float
+        seconds between two deletions of the expired sessions by this process
+
+    Methods
+    -------
+    load(self, token):
+        get the category and seen set of a session
+    save(self, token, category_id, seen):
+        store the category and seen set of a session
+    '''
+
+    def __init__(self, ttl, cleanup_interval=CLEANUP_INTERVAL):
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._cleaned_at = time.monotonic()
+
+    def load(self, token):
+        quiz_session = db.session.get(QuizSession, token)
+        if quiz_session is None or quiz_session.last_used + self.ttl < time.time():
+            return None
+        return quiz_session.category, SeenSet(quiz_session.seen)
+
+    def save(self, token, category_id, seen):
+        now = time.time()
+        db.session.merge(QuizSession(token, category_id, seen.to_bytes(), now))
+        # Expired sessions are removed by one save per interval, load ignores them until then
+        if time.monotonic() - self._cleaned_at >= self.cleanup_interval:
+            self._cleaned_at = time.monotonic()
+            QuizSession.query.filter(QuizSession.last_used < now - self.ttl).delete()
+        db.session.commit()
+
+
+def create_quiz_session_store(kind, max_bytes, ttl):
+    '''
+    Returns the quiz session store selected by configuration
+        Parameters:
+            kind (str): "memory" or "database"
+            max_bytes (int): maximum total size of the sessions kept in memory
+            ttl (float): seconds a session is kept after its last question
+        Returns:
+            store (MemoryQuizSessionStore or DatabaseQuizSessionStore): a quiz session store
+    '''
+    if kind == 'database':
+        return DatabaseQuizSessionStore(ttl)
+    if kind == 'memory':
+        return MemoryQuizSessionStore(max_bytes, ttl)
+    raise ValueError(f'Unknown quiz session store: {kind}')
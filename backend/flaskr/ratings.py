@@ -0,0 +1,203 @@
+'''
+This file contains the buffer that coalesces rating votes before they are written
+'''
+import atexit
+import threading
+import weakref
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.exc import DataError, IntegrityError
+
+from models import db, Question, TableVersion, category_versions
+
+# Every buffer of the process, flushed once at exit without keeping their apps alive
+buffers = weakref.WeakSet()
+
+
+class RatingBuffer:
+    '''
+    A class to collect rating votes in memory, summed per question, and write
+    them in one batched UPDATE when the buffer is full or on a timer
+    ...
+
+    Attributes
+    ----------
+    app : Flask
+        an instance of flask app, used to flush outside of a request
+    flush_interval : float
+        seconds a vote waits in the buffer at most
+    flush_size : int
+        number of buffered votes that triggers a flush
+
+    Methods
+    -------
+    vote(self, question_id, rating):
+        buffer a vote for a question and get the mean of all its votes
+    flush(self):
+        write the buffered votes to the database
+    '''
+
+    def __init__(self, app, flush_interval, flush_size):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._votes = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        # Voters read the committed votes while no flush writes, see vote()
+        self._changed = threading.Condition(self._lock)
+        self._voters = 0
+        self._flushing = False
+        self._flush_lock = threading.Lock()
+        buffers.add(self)
+
+    def vote(self, question_id, rating):
+        '''
+        Buffers a vote for a question. Its committed votes are read while no
+        flush is writing, so the mean counts every vote exactly once.
+            Parameters:
+                question_id (int): id of the rated question
+                rating (float): rating given by the vote
+            Returns:
+                question (Question): the rated question, None if it does not exist
+                mean (float): mean of the committed and buffered votes of the question
+        '''
+        with self._changed:
+            while self._flushing:
+                self._changed.wait()
+            self._voters += 1
+        question = None
+        try:
+            question = Question.query.filter(Question.id==question_id).one_or_none()
+        finally:
+            with self._changed:
+                self._voters -= 1
+                self._changed.notify_all()
+                if question is not None:
+                    votes, total = self._pending.get(question_id, (0, 0.0))
+                    votes, total = votes + 1, total + rating
+                    self._pending[question_id] = (votes, total)
+                    self._votes += 1
+                    full = self._votes >= self.flush_size
+                    if not full and self._timer is None:
+                        self._timer = threading.Timer(
+                            self.flush_interval, self._flush_in_app_context)
+                        self._timer.daemon = True
+                        self._timer.start()
+        if question is None:
+            return None, None
+
+        # Taken before a flush, whose commit expires the question
+        mean = (question.rating_sum + total) / (question.rating_count + votes)
+        if full:
+            self.flush()
+        return question, mean
+
+    def flush(self):
+        '''
+        Writes the buffered votes with one batched UPDATE and commits
+            Parameters:
+                None
+            Returns:
+                flushed (int): number of questions updated
+        '''
+        with self._flush_lock:
+            with self._changed:
+                # New voters wait until the votes taken here are committed
+                self._flushing = True
+                while self._voters:
+                    self._changed.wait()
+                pending, self._pending = self._pending, {}
+                self._votes = 0
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            try:
+                return self._write(pending)
+            finally:
+                with self._changed:
+                    self._flushing = False
+                    self._changed.notify_all()
+
+    def _write(self, pending):
+        '''
+        Writes votes taken from the buffer, they are put back if the database
+        could not be reached and dropped if it refused them
+            Parameters:
+                pending (dict): (votes, total) by question id
+            Returns:
+                flushed (int): number of questions updated
+        '''
+        if not pending:
+            return 0
+
+        table = Question.__table__
+        statement = update(table).where(table.c.id == bindparam('question_id')).values(
+            rating_count=table.c.rating_count + bindparam('votes'),
+            rating_sum=table.c.rating_sum + bindparam('total'),
+            rating=(table.c.rating_sum + bindparam('total'))
+            / (table.c.rating_count + bindparam('votes'))
+            )
+        # Rows are updated in id order so concurrent flushes cannot deadlock
+        rows = [
+            {'question_id': question_id, 'votes': votes, 'total': total}
+            for question_id, (votes, total) in sorted(pending.items())
+            ]
+
+        try:
+            db.session.execute(statement, rows)
+            # The category pages showing the new ratings are invalidated
+            names = ('questions',) + category_versions(db.session.scalars(
+                select(table.c.category).where(table.c.id.in_(list(pending))).distinct()))
+            TableVersion.bump(*names)
+            db.session.commit()
+        except (IntegrityError, DataError):
+            # Writing them again would fail again and hold back every later vote
+            db.session.rollback()
+            self.app.logger.exception('Dropped the rating votes of questions %s', sorted(pending))
+            return 0
+        except Exception:
+            db.session.rollback()
+            self._restore(pending)
+            raise
+        TableVersion.mark_committed(*names)
+        return len(rows)
+
+    def _restore(self, pending):
+        '''
+        Puts votes that could not be written back in the buffer
+            Parameters:
+                pending (dict): (votes, total) by question id
+            Returns:
+                None
+        '''
+        with self._lock:
+            for question_id, (votes, total) in pending.items():
+                buffered_votes, buffered_total = self._pending.get(question_id, (0, 0.0))
+                self._pending[question_id] = (buffered_votes + votes, buffered_total + total)
+                self._votes += votes
+
+    def _flush_in_app_context(self):
+        '''
+        Flushes the buffer from the timer thread or at exit
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        with self.app.app_context():
+            self.flush()
+
+
+@atexit.register
+def flush_buffers():
+    '''
+    Flushes every rating buffer of the process at exit
+        Parameters:
+            None
+        Returns:
+            None
+    '''
+    for buffer in list(buffers):
+        buffer._flush_in_app_context()
@@ -0,0 +1,64 @@
+'''
+This file contains the in-memory registry of question categories
+'''
+import threading
+
+from models import Category
+
+
+class CategoryRegistry:
+    '''
+    A class to serve the category map from memory, reloading it only when the
+    categories table version changes
+    ...
+
+    Attributes
+    ----------
+    tracker : VersionTracker
+        source of the categories table version
+
+    Methods
+    -------
+    get_map(self):
+        get a dictionary of categories with keys:<id> values: <type>
+    invalidate(self):
+        drop the loaded map so the next call reloads it
+    '''
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._map = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get_map(self):
+        '''
+        Returns the category map, loading it from the database if it is stale
+            Parameters:
+                None
+            Returns:
+                category_dict (dict): a dictionary of categories with keys:<id> values: <type>
+        '''
+        version = self.tracker.version('categories')
+        category_dict = self._map
+        if category_dict is not None and version == self._version:
+            return category_dict
+
+        with self._lock:
+            category_dict = {
+                str(category.id): category.type for category in
+                Category.query.order_by(Category.type).all()
+            }
+            self._map = category_dict
+            self._version = version
+        return category_dict
+
+    def invalidate(self):
+        '''
+        Drops the loaded category map
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        self._map = None
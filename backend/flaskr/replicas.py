@@ -0,0 +1,167 @@
+'''
+This file contains the read replicas that GET requests and quiz draws read from
+'''
+import itertools
+import math
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import engine_options
+
+
+class ReplicaSet:
+    '''
+    A class to hand out read replicas in turn, skipping the ones failing a health check.
+    Checks run on a background thread, so requests never wait for a replica to answer.
+    ...
+
+    Attributes
+    ----------
+    engines : list
+        an engine per replica, in the order of their uris
+    check_interval : float
+        seconds the result of a health check is trusted before replicas are checked again
+    timeout : float
+        seconds a replica has to connect and answer a health check
+
+    Methods
+    -------
+    choose(self):
+        get the engine of the next healthy replica
+    check(self, force=False):
+        run a health check of every replica if the last one is stale
+    dispose(self):
+        close the connections of every replica
+    '''
+
+    def __init__(self, uris, check_interval, timeout=2.0):
+        self.engines = [create_engine(uri, **replica_options(uri, timeout)) for uri in uris]
+        self.check_interval = check_interval
+        self.timeout = timeout
+        # Reads go to the primary until the first check has found healthy replicas
+        self._healthy = []
+        self._checked_at = None
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+        # Set until the background check started by choose is done
+        self._checking = False
+        self._checking_lock = threading.Lock()
+
+    def choose(self):
+        '''
+        Returns the engine of the next healthy replica, round-robin, and starts a
+        health check in the background when the last one is stale
+            Parameters:
+                None
+            Returns:
+                engine (sqlalchemy.engine.Engine): a replica, None if none is healthy
+        '''
+        healthy = self._healthy
+        if self.is_stale():
+            with self._checking_lock:
+                start, self._checking = not self._checking, True
+            if start:
+                threading.Thread(target=self._check_in_background, daemon=True).start()
+        if not healthy:
+            return None
+        return healthy[next(self._turns) % len(healthy)]
+
+    def is_stale(self):
+        '''
+        Returns True if the replicas were never checked or the last check is
+        older than the check interval
+            Parameters:
+                None
+            Returns:
+                stale (bool): True if the replicas must be checked again
+        '''
+        return (
+            self._checked_at is None
+            or time.monotonic() - self._checked_at >= self.check_interval
+        )
+
+    def check(self, force=False):
+        '''
+        Runs SELECT 1 on every replica when the last health check is older than
+        the check interval, replicas that fail are skipped until the next check
+            Parameters:
+                force (bool): check the replicas regardless of the last check,
+                    waiting for a check running on another thread
+            Returns:
+                None
+        '''
+        if not (force or self.is_stale()) or not self._lock.acquire(blocking=force):
+            # Another thread is checking, keep using the last result meanwhile
+            return
+
+        try:
+            self._healthy = [engine for engine in self.engines if self._answers(engine)]
+            self._checked_at = time.monotonic()
+        finally:
+            self._lock.release()
+
+    def _check_in_background(self):
+        '''
+        Runs the health check started by choose, so one check runs per stale window
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        try:
+            self.check()
+        finally:
+            self._checking = False
+
+    def _answers(self, engine):
+        '''
+        Returns True if a replica answers SELECT 1 within the timeout
+            Parameters:
+                engine (sqlalchemy.engine.Engine): engine of the replica
+            Returns:
+                healthy (bool): False if the replica failed or was too slow
+        '''
+        try:
+            with engine.connect() as connection, connection.begin():
+                if engine.dialect.name == 'postgresql':
+                    connection.exec_driver_sql(
+                        f'SET LOCAL statement_timeout = {int(self.timeout * 1000)}')
+                connection.execute(text('SELECT 1'))
+        except SQLAlchemyError:
+            return False
+        return True
+
+    def dispose(self):
+        '''
+        Closes the pooled connections of every replica
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        for engine in self.engines:
+            engine.dispose()
+
+
+def replica_options(uri, timeout):
+    '''
+    Returns the create_engine options of a replica, which gives up connecting
+    after timeout seconds
+        Parameters:
+            uri (str): database uri of the replica
+            timeout (float): seconds a connection attempt may take
+        Returns:
+            options (dict): keyword arguments of sqlalchemy.create_engine
+    '''
+    options = engine_options(uri)
+    if uri.startswith('postgres'):
+        connect_args = dict(options.get('connect_args', {}))
+        connect_args['connect_timeout'] = max(math.ceil(timeout), 1)
+        options['connect_args'] = connect_args
+    elif uri.startswith('sqlite'):
+        # Seconds a locked SQLite file is waited for
+        options['connect_args'] = {'timeout': timeout}
+    return options
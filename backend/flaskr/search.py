@@ -0,0 +1,211 @@
+'''
+This file contains the full-text search indexes used to search questions
+'''
+import re
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from sqlalchemy import Float, Integer, func, literal, literal_column, select, text
+from decouple import config
+
+from models import Question
+
+# Text search configuration of the PostgreSQL index, also read by migration 4
+SEARCH_LANGUAGE = config('SEARCH_LANGUAGE', default='english')
+SEARCH_TOKEN = re.compile(r'\w+')
+SQLITE_INSERT_TRIGGER = (
+    'CREATE TRIGGER IF NOT EXISTS questions_fts_insert AFTER INSERT ON questions BEGIN '
+    'INSERT INTO questions_fts(rowid, question) VALUES (new.id, new.question); '
+    'END'
+)
+
+
+def search_tokens(search_term):
+    '''
+    Returns the words of a search term, dropping any query syntax
+        Parameters:
+            search_term (str): a search term sent by the user
+        Returns:
+            tokens (list): a list of words in the search term
+    '''
+    return SEARCH_TOKEN.findall(str(search_term))
+
+
+def substring_matches(search_term):
+    '''
+    Returns a selectable of the questions containing a search term
+        Parameters:
+            search_term (str): a search term sent by the user
+        Returns:
+            matches (sqlalchemy.sql.Select): rows of (id, score), every score is 0
+    '''
+    return select(
+        Question.id.label('id'), literal(0.0).label('score')
+    ).where(Question.question.ilike(f'%{search_term}%'))
+
+
+class SearchIndex(ABC):
+    '''
+    A base class for question search indexes, subclasses implement matches
+    ...
+
+    Methods
+    -------
+    install(self, connection):
+        create the index structures if they do not exist
+    deferred(self, engine):
+        index the questions inserted inside the with block once at the end
+    matches(self, search_term):
+        get a selectable of (id, score) for questions matching a term,
+        a higher score is a better match
+    '''
+
+    def install(self, connection):
+        '''
+        Creates the index structures if they do not exist, run by migration 4
+        of flaskr/migrations.py
+            Parameters:
+                connection (sqlalchemy.engine.Connection): an autocommit connection
+            Returns:
+                None
+        '''
+
+    @contextmanager
+    def deferred(self, engine):
+        '''
+        Indexes the questions inserted inside the with block once at the end,
+        for bulk loads, the index is kept up to date on every write by default
+            Parameters:
+                engine (sqlalchemy.engine.Engine): engine of the questions database
+            Returns:
+                None
+        '''
+        yield
+
+    @abstractmethod
+    def matches(self, search_term):
+        '''
+        Returns a selectable of the questions matching a search term
+            Parameters:
+                search_term (str): a search term sent by the user
+            Returns:
+                matches (sqlalchemy.sql.Select): rows of (id, score)
+        '''
+
+
+class SubstringSearchIndex(SearchIndex):
+    '''
+    A class to match questions containing the search term as a substring.
+    It needs no index, so every search scans the questions table.
+    '''
+
+    def matches(self, search_term):
+        return substring_matches(search_term)
+
+
+class PostgresSearchIndex(SearchIndex):
+    '''
+    A class to match questions through a GIN indexed tsvector column.
+    The column is generated by PostgreSQL from questions.question, so
+    every write path, including bulk loads, keeps it in sync. Migration 4
+    adds the column and builds its index concurrently.
+    ...
+
+    Attributes
+    ----------
+    language : str
+        text search configuration used to parse questions and terms
+    '''
+
+    def __init__(self, language):
+        self.language = language
+
+    def matches(self, search_term):
+        tokens = search_tokens(search_term)
+        if not tokens:
+            # A term without words, such as an empty one, is matched as a substring
+            return substring_matches(search_term)
+
+        # Every word must match, the last one as a prefix of a longer word
+        query = func.to_tsquery(
+            self.language, ' & '.join(tokens[:-1] + [f'{tokens[-1]}:*']))
+        vector = literal_column('questions.search_vector')
+        return select(
+            Question.id.label('id'), func.ts_rank(vector, query).label('score')
+        ).where(vector.op('@@')(query))
+
+
+class SqliteSearchIndex(SearchIndex):
+    '''
+    A class to match questions through an external content FTS5 table.
+    Triggers on the questions table keep the FTS5 table in sync, a deferred
+    bulk load drops the insert trigger and rebuilds the table at the end.
+    '''
+
+    def install(self, connection):
+        # Every statement commits on its own, each one can be run again
+        connection.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING '
+            "fts5(question, content='questions', content_rowid='id')"
+        ))
+        connection.execute(text(SQLITE_INSERT_TRIGGER))
+        connection.execute(text(
+            'CREATE TRIGGER IF NOT EXISTS questions_fts_delete AFTER DELETE ON questions BEGIN '
+            "INSERT INTO questions_fts(questions_fts, rowid, question) "
+            "VALUES ('delete', old.id, old.question); "
+            'END'
+        ))
+        connection.execute(text(
+            'CREATE TRIGGER IF NOT EXISTS questions_fts_update '
+            'AFTER UPDATE OF question ON questions BEGIN '
+            "INSERT INTO questions_fts(questions_fts, rowid, question) "
+            "VALUES ('delete', old.id, old.question); "
+            'INSERT INTO questions_fts(rowid, question) VALUES (new.id, new.question); '
+            'END'
+        ))
+        # Index the questions that existed before the FTS5 table
+        connection.execute(text("INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')"))
+
+    @contextmanager
+    def deferred(self, engine):
+        # Rebuilding the FTS5 table once is several times faster than
+        # indexing every inserted row from the trigger
+        with engine.begin() as connection:
+            connection.execute(text('DROP TRIGGER IF EXISTS questions_fts_insert'))
+        try:
+            yield
+        finally:
+            with engine.begin() as connection:
+                connection.execute(text(SQLITE_INSERT_TRIGGER))
+                connection.execute(text(
+                    "INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')"
+                ))
+
+    def matches(self, search_term):
+        tokens = search_tokens(search_term)
+        if not tokens:
+            # A term without words, such as an empty one, is matched as a substring
+            return substring_matches(search_term)
+
+        # Quote every word so it is never read as FTS5 syntax
+        query = ' '.join(f'"{token}"' for token in tokens) + '*'
+        return text(
+            'SELECT rowid AS id, -bm25(questions_fts) AS score '
+            'FROM questions_fts WHERE questions_fts MATCH :query'
+        ).bindparams(query=query).columns(id=Integer, score=Float)
+
+
+def create_search_index(engine, language):
+    '''
+    Returns the search index suited to the database dialect
+        Parameters:
+            engine (sqlalchemy.engine.Engine): engine or connection of the questions database
+            language (str): text search configuration used on PostgreSQL
+        Returns:
+            search_index (SearchIndex): an index for the database
+    '''
+    if engine.dialect.name == 'postgresql':
+        return PostgresSearchIndex(language)
+    if engine.dialect.name == 'sqlite':
+        return SqliteSearchIndex()
+    return SubstringSearchIndex()
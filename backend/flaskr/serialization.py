@@ -0,0 +1,126 @@
+'''
+This file contains the fast JSON encoding used by the read endpoints
+'''
+import json
+import re
+
+from flask import current_app, jsonify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NON_ASCII = re.compile('[^\x00-\x7f]')
+# orjson and json.dumps write the same digits for floats in this range of
+# magnitudes, beyond it json.dumps writes exponents such as 1e-05 and 1e+16
+SAFE_FLOAT_MIN = 1e-4
+SAFE_FLOAT_MAX = 1e16
+
+
+def escape_non_ascii(match):
+    '''
+    Returns the JSON escape of a non ASCII character, as json.dumps writes it
+        Parameters:
+            match (re.Match): a match of a single non ASCII character
+        Returns:
+            escape (str): \\uXXXX, or a surrogate pair beyond the basic plane
+    '''
+    code = ord(match.group())
+    if code > 0xFFFF:
+        code -= 0x10000
+        return '\\u{:04x}\\u{:04x}'.format(0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return f'\\u{code:04x}'
+
+
+def has_unsafe_float(value):
+    '''
+    Returns True if a payload holds a float orjson writes differently from json.dumps
+        Parameters:
+            value (object): a JSON serializable object
+        Returns:
+            unsafe (bool): True for NaN, infinities and magnitudes out of the safe range
+    '''
+    if isinstance(value, float):
+        # NaN fails every comparison
+        return not (value == 0 or SAFE_FLOAT_MIN <= abs(value) < SAFE_FLOAT_MAX)
+    if isinstance(value, dict):
+        return any(has_unsafe_float(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_unsafe_float(item) for item in value)
+    return False
+
+
+def dumps(payload):
+    '''
+    Returns the compact JSON encoding of a payload, byte for byte the body jsonify
+    writes with the JSON_SORT_KEYS and JSON_AS_ASCII settings of the app.
+    Payloads must hold only str keys, str, int, float, bool and None values.
+    Payloads with a float orjson writes differently are encoded by json.dumps.
+        Parameters:
+            payload (dict): a JSON serializable object
+        Returns:
+            data (bytes): the encoded payload without a trailing newline
+    '''
+    sort_keys = current_app.config['JSON_SORT_KEYS']
+    ensure_ascii = current_app.config['JSON_AS_ASCII']
+
+    if orjson is None or has_unsafe_float(payload):
+        return json.dumps(
+            payload, sort_keys=sort_keys, ensure_ascii=ensure_ascii, separators=(',', ':')
+        ).encode('utf-8')
+
+    data = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    if ensure_ascii and not data.isascii():
+        data = NON_ASCII.sub(escape_non_ascii, data.decode('utf-8')).encode('ascii')
+    return data
+
+
+def dumps_lines(payloads):
+    '''
+    Returns the NDJSON encoding of payloads, each line as dumps encodes it.
+    The settings of the app are read once for all the payloads.
+        Parameters:
+            payloads (iterable): JSON serializable objects, as dumps accepts them
+        Returns:
+            data (bytes): one encoded payload per line, each ending with a newline
+    '''
+    sort_keys = current_app.config['JSON_SORT_KEYS']
+    ensure_ascii = current_app.config['JSON_AS_ASCII']
+
+    payloads = list(payloads)
+    if orjson is None or has_unsafe_float(payloads):
+        return b''.join(
+            json.dumps(
+                payload, sort_keys=sort_keys, ensure_ascii=ensure_ascii, separators=(',', ':')
+            ).encode('utf-8') + b'\n'
+            for payload in payloads
+        )
+
+    option = orjson.OPT_APPEND_NEWLINE | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    data = b''.join(orjson.dumps(payload, option=option) for payload in payloads)
+    if ensure_ascii and not data.isascii():
+        data = NON_ASCII.sub(escape_non_ascii, data.decode('utf-8')).encode('ascii')
+    return data
+
+
+def json_response(payload, status=200):
+    '''
+    Returns a JSON response identical to jsonify(payload) without its encoding cost
+        Parameters:
+            payload (dict): a JSON serializable object
+            status (int): status code of the response
+        Returns:
+            response (flask.Response): the JSON response
+    '''
+    # Pretty printed responses are left to jsonify
+    if current_app.debug or current_app.config['JSONIFY_PRETTYPRINT_REGULAR']:
+        response = jsonify(payload)
+        response.status_code = status
+        return response
+
+    return current_app.response_class(
+        dumps(payload) + b'\n',
+        status=status,
+        mimetype=current_app.config['JSONIFY_MIMETYPE']
+    )
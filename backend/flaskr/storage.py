@@ -0,0 +1,169 @@
+'''
+This file contains the storage shared by the in-process caches and the SQLite files
+shared by the workers of a host
+'''
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class ByteCappedLRU:
+    '''
+    A class to keep values in process memory up to a total size, evicting the
+    least recently used values beyond max_bytes
+    ...
+
+    Attributes
+    ----------
+    max_bytes : int
+        maximum total size of the values kept
+
+    Methods
+    -------
+    get(self, key):
+        get a value and mark it as recently used
+    set(self, key, value, size):
+        keep a value of a given size
+    discard(self, key, value):
+        drop a value unless it was replaced meanwhile
+    clear(self):
+        drop every value
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        Returns a value and marks it as the most recently used
+            Parameters:
+                key (hashable): key of the value
+            Returns:
+                value (object): the value or None if it is not kept
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        '''
+        Keeps a value, evicting the least recently used ones beyond max_bytes
+            Parameters:
+                key (hashable): key of the value
+                value (object): the value
+                size (int): bytes counted for the value
+            Returns:
+                None
+        '''
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            # A value larger than max_bytes is not kept, nor the value it replaces
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def discard(self, key, value):
+        '''
+        Drops a stale value, a value set by another thread since it was read is kept
+            Parameters:
+                key (hashable): key of the value
+                value (object): the value returned by get
+            Returns:
+                None
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is value:
+                del self._entries[key]
+                self._size -= entry[1]
+
+    def clear(self):
+        '''
+        Drops every value
+            Parameters:
+                None
+            Returns:
+                None
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class SQLiteFile:
+    '''
+    A class to open a SQLite file shared by the workers of a host, with one
+    connection per thread since sqlite3 connections are not shared. Times kept
+    in the file are wall clock times, the monotonic clocks of the workers do not agree.
+    ...
+
+    Attributes
+    ----------
+    path : str
+        path of the SQLite file
+    timeout : float
+        seconds a worker waits for the lock of the file
+
+    Methods
+    -------
+    connection(self):
+        get the connection of the current thread
+    transaction(self):
+        run statements in one immediate transaction
+    '''
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connection(self):
+        '''
+        Returns the connection of the current thread, opening it on first use
+            Parameters:
+                None
+            Returns:
+                connection (sqlite3.Connection): a connection in autocommit mode
+        '''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Runs the statements of the block in one immediate transaction, so the
+        workers writing the file run them one after the other
+            Parameters:
+                None
+            Returns:
+                connection (sqlite3.Connection): the connection of the current thread
+        '''
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
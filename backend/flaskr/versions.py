@@ -0,0 +1,106 @@
+'''
+This file contains the table version tracker shared by the in-process caches
+'''
+import threading
+import time
+
+from models import TableVersion, local_versions, replica_reads
+
+
+class VersionTracker:
+    '''
+    A class to read table versions from the database at most once per check interval
+    ...
+
+    Attributes
+    ----------
+    check_interval : float
+        seconds a fetched set of versions is trusted before it is read again
+
+    Methods
+    -------
+    version(self, name):
+        get the current version of a table
+    refresh(self, force=False):
+        read the table versions again if they may be stale
+    is_stale(self, force=False):
+        check if the table versions may be stale
+    store(self, versions, seen_local):
+        keep table versions read from the database
+    '''
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._versions = {}
+        self._seen_local = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def version(self, name):
+        '''
+        Returns the current version of a table
+            Parameters:
+                name (str): name of the versioned table
+            Returns:
+                version (int): version of the table, 0 if it was never written
+        '''
+        self.refresh()
+        return self._versions.get(name, 0)
+
+    def refresh(self, force=False):
+        '''
+        Reads table versions from the primary database when this process committed
+        a write since the last read or when the check interval has elapsed
+            Parameters:
+                force (bool): read the versions regardless of their age
+            Returns:
+                None
+        '''
+        if not self.is_stale(force):
+            return
+
+        # A lagging replica would hand out versions older than the cached data
+        with self._lock, replica_reads(False):
+            seen_local = dict(local_versions)
+            self.store(TableVersion.fetch_all(), seen_local)
+
+    def is_stale(self, force=False):
+        '''
+        Returns True if this process committed a write since the versions were
+        read or the check interval has elapsed
+            Parameters:
+                force (bool): consider the versions stale regardless of their age
+            Returns:
+                stale (bool): True if the versions must be read again
+        '''
+        return (
+            force
+            or self._seen_local != local_versions
+            or time.monotonic() - self._checked_at >= self.check_interval
+        )
+
+    def store(self, versions, seen_local):
+        '''
+        Keeps versions read from the database
+            Parameters:
+                versions (dict): table names mapped to their versions
+                seen_local (dict): copy of local_versions taken before the read
+            Returns:
+                None
+        '''
+        self._versions = versions
+        self._seen_local = seen_local
+        self._checked_at = time.monotonic()
+
+
+def table_etag(tracker, names):
+    '''
+    Returns an entity tag derived from the versions of tables, sent as a weak
+    ETag since the versions may be VERSION_CHECK_INTERVAL seconds old
+        Parameters:
+            tracker (VersionTracker): source of the table versions
+            names (tuple): names of the tables a response is built from
+        Returns:
+            etag (str): an entity tag that changes whenever one of the tables is written
+    '''
+    return '-'.join(f'{name}.{tracker.version(name)}' for name in names)
@@ -1,33 +1,311 @@
 '''
 This file contains all models of the TriviaAPI database
 '''
-from sqlalchemy import Column, Float, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import (
+    Column, Float, ForeignKey, Index, String, Integer, LargeBinary,
+    event, func, inspect, orm, select, update)
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from decouple import config
 
-DATABASE_URI = config('DATABASE_URI')
+# DATABASE_URI is read when an app is set up, so importing the models needs no database
+SQLALCHEMY_TRACK_MODIFICATIONS = config('SQLALCHEMY_TRACK_MODIFICATIONS', default=False, cast=bool)
+SQLALCHEMY_ECHO = config('SQLALCHEMY_ECHO', default=False, cast=bool)
+QUESTION_COUNT_TTL = config('QUESTION_COUNT_TTL', default=30, cast=float)
 
-SQLALCHEMY_TRACK_MODIFICATIONS = config('SQLALCHEMY_TRACK_MODIFICATIONS')
-SECRET_KEY = config('SECRET_KEY')
-SQLALCHEMY_ECHO = eval(config('SQLALCHEMY_ECHO'))
+# Connection pool, the sizing options are ignored by SQLite which opens a connection per checkout
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=5, cast=int)
+DB_MAX_OVERFLOW = config('DB_MAX_OVERFLOW', default=10, cast=int)
+DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', default=30, cast=float)
+DB_POOL_RECYCLE = config('DB_POOL_RECYCLE', default=1800, cast=int)
+DB_POOL_PRE_PING = config('DB_POOL_PRE_PING', default=True, cast=bool)
+# Milliseconds a PostgreSQL statement may run before it is cancelled, 0 for no limit
+DB_STATEMENT_TIMEOUT = config('DB_STATEMENT_TIMEOUT', default=0, cast=int)
+# Transaction pooling through PgBouncer, no session state is kept on server connections
+PGBOUNCER_MODE = config('PGBOUNCER_MODE', default=False, cast=bool)
+# Version of the last migration of flaskr/migrations.py, a database at this
+# version already has every table and index of the models
+SCHEMA_VERSION = 4
 
-db = SQLAlchemy()
+# URLs of the databases found at SCHEMA_VERSION by this process
+current_schemas = set()
 
-def setup_db(app, database_path=DATABASE_URI):
+
+class RoutingSession(SignallingSession):
+    '''
+    A session sending reads to a read replica while replica reads are on.
+    Writes go to the primary database, and once a session wrote all its
+    later reads go to the primary as well, so it reads its own writes.
+    Replicas are chosen by the ReplicaSet in app.extensions['replicas'].
+    '''
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        writing = self._flushing or isinstance(clause, UpdateBase)
+        if writing:
+            self.info['wrote'] = True
+        elif self.info.get('replica_reads') and not self.info.get('wrote'):
+            replicas = self.app.extensions.get('replicas')
+            replica = replicas.choose() if replicas is not None else None
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''
+    A SQLAlchemy service whose sessions route reads to read replicas
+    '''
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+@contextmanager
+def replica_reads(enabled=True):
     '''
-    Binds a flask application and a SQLAlchemy service
+    Turns replica reads of the current session on or off within a block
+        Parameters:
+            enabled (bool): True to read from replicas until the session writes
+        Returns:
+            context (contextmanager): restores the previous setting on exit
+    '''
+    info = db.session().info
+    previous = info.get('replica_reads', False)
+    info['replica_reads'] = enabled
+    try:
+        yield
+    finally:
+        info['replica_reads'] = previous
+
+# Number of writes committed by this process per table, lets in-process caches
+# notice their own writes without waiting for the next table_versions check
+local_versions = {}
+
+# Keys of a formatted question, in the order of Question.format()
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty', 'rating')
+
+def category_versions(category_ids):
+    '''
+    Returns the table version names of the questions of categories, bumped by
+    every write to a question of one of them
+        Parameters:
+            category_ids (iterable): ids of the categories written to
+        Returns:
+            names (tuple): one name per category, in increasing id order so
+                concurrent writers lock the version rows in the same order
+    '''
+    return tuple(
+        f'questions.category.{category_id}'
+        for category_id in sorted(
+            {int(category_id) for category_id in category_ids if category_id is not None}))
+
+
+def engine_options(database_path):
+    '''
+    Returns the create_engine options of the database, read from the DB_* settings
         Parameters:
-            app (Flask(__name__)): an instance of flask app
             database_path (str): database uri
+        Returns:
+            options (dict): keyword arguments of sqlalchemy.create_engine
+    '''
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+    if database_path.startswith('sqlite'):
+        return options
+
+    options.update(
+        poolclass=MeteredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE
+        )
+    if DB_STATEMENT_TIMEOUT and not PGBOUNCER_MODE:
+        # PgBouncer refuses startup options, its mode sets the timeout per transaction
+        options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'}
+    return options
+
+
+def set_local_statement_timeout(connection):
+    '''
+    Limits the statements of the transaction being opened to DB_STATEMENT_TIMEOUT
+        Parameters:
+            connection (sqlalchemy.engine.Connection): connection beginning a transaction
+        Returns:
+            None
+    '''
+    connection.exec_driver_sql(f'SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT}')
+
+
+def schema_is_current(engine):
+    '''
+    Returns True if the database has applied the migrations up to SCHEMA_VERSION.
+    A database found current is remembered, later calls run no query.
+        Parameters:
+            engine (sqlalchemy.engine.Engine): engine of the questions database
+        Returns:
+            current (bool): True if the schema needs neither creating nor migrating
+    '''
+    url = str(engine.url)
+    if url in current_schemas:
+        return True
+
+    try:
+        with engine.connect() as connection:
+            version = connection.execute(select(func.max(SchemaMigration.version))).scalar()
+    except SQLAlchemyError:
+        # No schema_migrations table, the database predates the migrations
+        return False
+
+    if version is None or version < SCHEMA_VERSION:
+        return False
+    current_schemas.add(url)
+    return True
+
+
+def setup_db(app, database_path=None):
+    '''
+    Binds a flask application and a SQLAlchemy service, creating the tables
+    unless the schema is already at SCHEMA_VERSION
+        Parameters:
+            app (Flask(__name__)): an instance of flask app
+            database_path (str): database uri, DATABASE_URI by default
         Returns:
             None
     '''
+    database_path = database_path or config('DATABASE_URI')
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = SQLALCHEMY_TRACK_MODIFICATIONS
     app.config["SQLALCHEMY_ECHO"] = SQLALCHEMY_ECHO
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+    engine = db.engine
+    if not schema_is_current(engine):
+        db.create_all()
+    if (PGBOUNCER_MODE and DB_STATEMENT_TIMEOUT and engine.dialect.name == 'postgresql'
+            and not event.contains(engine, 'begin', set_local_statement_timeout)):
+        event.listen(engine, 'begin', set_local_statement_timeout)
+
+
+class PoolStats:
+    '''
+    A class to count the checkouts of a connection pool and the time spent waiting for them
+    ...
+
+    Attributes
+    ----------
+    checkouts : int
+        number of connections handed out
+    wait_seconds : float
+        total time spent waiting for a connection
+    max_wait_seconds : float
+        longest wait for a connection
+    timeouts : int
+        number of checkouts that gave up after the pool timeout
+
+    Methods
+    -------
+    record(self, seconds, timed_out):
+        count a checkout and the time it waited
+    snapshot(self):
+        get a copy of the counters
+    '''
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, timed_out):
+        '''
+        Counts a checkout and the time it waited for a connection
+            Parameters:
+                seconds (float): time spent in the checkout
+                timed_out (bool): True if no connection was available in time
+            Returns:
+                None
+        '''
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def snapshot(self):
+        '''
+        Returns a copy of the counters
+            Parameters:
+                self
+            Returns:
+                stats (dict): the counters by attribute name
+        '''
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'timeouts': self.timeouts
+                }
+
+
+class MeteredQueuePool(QueuePool):
+    '''
+    A QueuePool recording in PoolStats how long each checkout waits for a connection.
+    The stats are handed over when the pool is recreated after a disconnect.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.stats.record(time.perf_counter() - started_at, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - started_at, timed_out=False)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def pool_metrics(pool):
+    '''
+    Returns the state of a connection pool and the PoolStats of a metered pool
+        Parameters:
+            pool (sqlalchemy.pool.Pool): pool of the database engine
+        Returns:
+            metrics (dict): pool class, sizes and counters
+    '''
+    metrics = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        metrics.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0)
+            )
+    if isinstance(pool, MeteredQueuePool):
+        metrics.update(pool.stats.snapshot())
+    return metrics
 
 
 class Question(db.Model):
@@ -50,15 +328,32 @@ class Question(db.Model):
         the section a question belongs to
     difficulty : Integer
         level of difficulty question belongs to
+    rating : Float
+        mean of the ratings voted for the question
+    rating_count : Integer
+        number of rating votes
+    rating_sum : Float
+        sum of the rating votes
     '''
     __tablename__ = 'questions'
+    # Also created on existing databases by migration 2 of flaskr/migrations.py
+    __table_args__ = (
+        Index('ix_questions_category', 'category'),
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+        )
 
     id = Column(Integer, primary_key=True)
     question = Column(String, nullable=False)
     answer = Column(String, nullable=False)
-    category = Column(Integer, nullable=False)
+    category = Column(Integer, ForeignKey('categories.id'), nullable=False)
     difficulty = Column(Integer, nullable=False)
     rating = Column(Float)
+    rating_count = Column(Integer, nullable=False, default=0, server_default='0')
+    rating_sum = Column(Float, nullable=False, default=0, server_default='0')
+
+    # Cached result of Question.count(), reset by writes made in this process
+    _count_cache = {'value': None, 'version': None, 'expires_at': 0.0}
 
     def __init__(self, question, answer, category, difficulty, rating):
         self.question = question
@@ -66,6 +361,9 @@ class Question(db.Model):
         self.category = category
         self.difficulty = difficulty
         self.rating = rating
+        # A rating given on creation is the first vote, as migration 1 counts it
+        self.rating_count = 0 if rating is None else 1
+        self.rating_sum = 0 if rating is None else rating
 
     def insert(self):
         '''
@@ -75,8 +373,12 @@ class Question(db.Model):
             Returns:
                 None
         '''
+        names = ('questions', 'question_ids') + category_versions([self.category])
         db.session.add(self)
+        TableVersion.bump(*names)
         db.session.commit()
+        TableVersion.mark_committed(*names)
+        Question.reset_count()
 
     def update(self):
         '''
@@ -86,7 +388,16 @@ class Question(db.Model):
             Returns:
                 None
         '''
+        # Moving a question to another category changes the ids served per category
+        history = inspect(self).attrs.category.history
+        if history.has_changes():
+            names = ('questions', 'question_ids') + category_versions(
+                list(history.deleted) + list(history.added))
+        else:
+            names = ('questions',) + category_versions([self.category])
+        TableVersion.bump(*names)
         db.session.commit()
+        TableVersion.mark_committed(*names)
 
     def delete(self):
         '''
@@ -96,8 +407,93 @@ class Question(db.Model):
             Returns:
                 None
         '''
+        names = ('questions', 'question_ids') + category_versions([self.category])
         db.session.delete(self)
+        TableVersion.bump(*names)
         db.session.commit()
+        TableVersion.mark_committed(*names)
+        Question.reset_count()
+
+    @classmethod
+    def count(cls, version=None):
+        '''
+        Returns the total number of questions, cached until the question_ids
+        version changes or for QUESTION_COUNT_TTL seconds
+            Parameters:
+                cls
+                version (int): current version of the question_ids table
+            Returns:
+                total <int> : count of all questions in the database
+        '''
+        total = cls.cached_count(version)
+        if total is None:
+            total = db.session.query(func.count(cls.id)).scalar()
+            cls.store_count(total, version)
+        return total
+
+    @classmethod
+    def cached_count(cls, version):
+        '''
+        Returns the cached number of questions if it is still valid
+            Parameters:
+                cls
+                version (int): current version of the question_ids table
+            Returns:
+                total <int> : cached count of all questions, None if stale
+        '''
+        cache = cls._count_cache
+        if (cache['value'] is None or cache['version'] != version
+                or cache['expires_at'] < time.monotonic()):
+            return None
+        return cache['value']
+
+    @classmethod
+    def store_count(cls, total, version):
+        '''
+        Caches the number of questions counted at a question_ids version
+            Parameters:
+                cls
+                total (int): count of all questions in the database
+                version (int): version of the question_ids table
+            Returns:
+                None
+        '''
+        cls._count_cache.update(
+            value=total, version=version, expires_at=time.monotonic() + QUESTION_COUNT_TTL)
+
+    @classmethod
+    def reset_count(cls):
+        '''
+        Drops the cached question count so the next count() hits the database
+            Parameters:
+                cls
+            Returns:
+                None
+        '''
+        cls._count_cache['value'] = None
+
+    @classmethod
+    def select_rows(cls):
+        '''
+        Returns a Core select of the formatted question columns, its rows skip
+        building ORM instances on read paths
+            Parameters:
+                cls
+            Returns:
+                statement <sqlalchemy.sql.Select> : select of the QUESTION_FIELDS columns
+        '''
+        return select(*[getattr(cls, field) for field in QUESTION_FIELDS])
+
+    @staticmethod
+    def format_row(row):
+        '''
+        Return the attributes of a row of Question.select_rows() like format()
+            Parameters:
+                row (sqlalchemy.engine.Row): a row of Question.select_rows()
+            Returns:
+                question <dict> : question attributes by QUESTION_FIELDS key
+        '''
+        return dict(zip(QUESTION_FIELDS, row))
 
     def format(self):
         '''
@@ -146,7 +542,9 @@ class Category(db.Model):
                 None
         '''
         db.session.add(self)
+        TableVersion.bump('categories')
         db.session.commit()
+        TableVersion.mark_committed('categories')
 
     def format(self):
         '''
@@ -161,3 +559,124 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
             }
+
+class TableVersion(db.Model):
+    '''
+    A class to create model for table_versions table, a version stamp
+    per table shared by all processes using the database
+    ...
+    Parameters
+    ----------
+    db.Model (SQLAlchemy) : SQLAlchemy object
+
+    Attributes
+    ----------
+    name : String
+        name of the versioned table
+    version : Integer
+        incremented by every committed write to the table
+    '''
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+
+    @classmethod
+    def bump(cls, *names):
+        '''
+        Increments the versions of tables within the current transaction
+            Parameters:
+                names (str): names of the versioned tables
+            Returns:
+                None
+        '''
+        for name in names:
+            result = db.session.execute(
+                update(cls.__table__).where(cls.name == name).values(version=cls.version + 1)
+            )
+            if result.rowcount == 0:
+                db.session.add(cls(name, 1))
+
+    @staticmethod
+    def mark_committed(*names):
+        '''
+        Records a committed write to tables made by this process
+            Parameters:
+                names (str): names of the versioned tables
+            Returns:
+                None
+        '''
+        for name in names:
+            local_versions[name] = local_versions.get(name, 0) + 1
+
+    @classmethod
+    def fetch_all(cls):
+        '''
+        Returns the versions of all tables
+            Parameters:
+                cls
+            Returns:
+                versions <dict> : table names mapped to their versions
+        '''
+        return dict(db.session.query(cls.name, cls.version).all())
+
+class QuizSession(db.Model):
+    '''
+    A class to create model for quiz_sessions table, the questions already
+    sent to a player of a server side quiz
+    ...
+    Parameters
+    ----------
+    db.Model (SQLAlchemy) : SQLAlchemy object
+
+    Attributes
+    ----------
+    token : String
+        token identifying the quiz session
+    category : Integer
+        the quiz category, 0 for all categories
+    seen : LargeBinary
+        varint encoded gaps of the sorted question ids already sent to the player
+    last_used : Float
+        unix time of the last question sent to the player
+    '''
+    __tablename__ = 'quiz_sessions'
+
+    token = Column(String, primary_key=True)
+    category = Column(Integer, nullable=False)
+    seen = Column(LargeBinary, nullable=False)
+    last_used = Column(Float, nullable=False, index=True)
+
+    def __init__(self, token, category, seen, last_used):
+        self.token = token
+        self.category = category
+        self.seen = seen
+        self.last_used = last_used
+
+class SchemaMigration(db.Model):
+    '''
+    A class to create model for schema_migrations table, the migrations
+    of flaskr/migrations.py already applied to the database
+    ...
+    Parameters
+    ----------
+    db.Model (SQLAlchemy) : SQLAlchemy object
+
+    Attributes
+    ----------
+    version : Integer
+        number of the migration
+    description : String
+        what the migration changes
+    applied_at : Float
+        unix time the migration was applied
+    '''
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String, nullable=False)
+    applied_at = Column(Float, nullable=False)
@@ -1,16 +1,179 @@
 '''
 This file contains the endpoint testing of the Trivia app
 '''
+import asyncio
+import gzip
+import importlib.util
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
 import unittest
-from flask_sqlalchemy import SQLAlchemy
+from contextlib import contextmanager
+from flask import g, jsonify
+from sqlalchemy import create_engine, event, inspect, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
 from decouple import config
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import create_app, load_settings
+from flaskr.migrations import MIGRATIONS, run_migrations
+from flaskr.replicas import ReplicaSet
+from flaskr.metrics import RequestMetrics
+from flaskr.limits import MemoryRateLimitStore, SQLiteRateLimitStore
+from flaskr.cache import MemoryResponseCache, SQLiteResponseCache
+from flaskr.quiz import MemoryQuizSessionStore, SeenSet, session_size
+from flaskr.serialization import json_response
+try:
+    from flaskr.aio import async_database_uri, create_async_app
+except ImportError:
+    create_async_app = None
+from models import (
+    db, pool_metrics, MeteredQueuePool, Question, Category, SchemaMigration,
+    SCHEMA_VERSION, schema_is_current)
 
 TEST_DATABASE_NAME = config('TEST_DATABASE_NAME')
 TEST_DATABASE_URI = config('TEST_DATABASE_URI')
 
+# Most SQL statements a warm request to each endpoint may run, so that an
+# endpoint turning into one query per row or per category fails the build
+QUERY_BUDGETS = {
+    'GET /questions': 2,
+    'POST /questions searchTerm': 2,
+    'POST /quizzes': 1,
+    # Served from the response cache of the category pages
+    'GET /categories/<id>/questions': 0,
+}
+TRANSACTION_STATEMENTS = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+@contextmanager
+def count_queries(engine):
+    '''
+    Records the SQL statements run on an engine inside the with block
+        Parameters:
+            engine (sqlalchemy.engine.Engine): the engine to watch
+        Returns:
+            statements (list): the statements run so far, filled as they run
+    '''
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # Savepoints are opened and released by the test transaction, not the app
+        if not statement.startswith(TRANSACTION_STATEMENTS):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def committed(test):
+    '''
+    Runs a test on the test database itself instead of in a transaction rolled
+    back after the test, for tests using other connections or threads
+        Parameters:
+            test (function): a test method of TriviaTestCase
+        Returns:
+            test (function): the marked test method
+    '''
+    test.committed = True
+    return test
+
+
+def enable_sqlite_savepoints(connection):
+    '''
+    Lets SQLAlchemy emit BEGIN on a pysqlite connection, as pysqlite emits its
+    own BEGIN too late for savepoints to work
+        Parameters:
+            connection (sqlalchemy.engine.Connection): a SQLite connection, before its first transaction
+        Returns:
+            None
+    '''
+    connection.connection.dbapi_connection.isolation_level = None
+
+    @event.listens_for(connection, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+
+def copy_database(template):
+    '''
+    Creates a copy of a database, next to a SQLite file or from a PostgreSQL template
+        Parameters:
+            template (str): uri of the database to copy, nobody may be connected to it
+        Returns:
+            uri (str): uri of the copy
+    '''
+    url = make_url(template)
+    if url.get_backend_name() == 'sqlite':
+        path = os.path.join(os.path.dirname(url.database), 'scenario.db')
+        shutil.copyfile(url.database, path)
+        return url.set(database=path).render_as_string(hide_password=False)
+
+    name = f'{url.database}_scenario'
+    engine = create_engine(url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f'DROP DATABASE IF EXISTS "{name}"')
+        connection.exec_driver_sql(f'CREATE DATABASE "{name}" TEMPLATE "{url.database}"')
+    engine.dispose()
+    return url.set(database=name).render_as_string(hide_password=False)
+
+
+def drop_database(uri):
+    '''
+    Deletes a copy made by copy_database
+        Parameters:
+            uri (str): uri of the copy
+        Returns:
+            None
+    '''
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        os.remove(url.database)
+        return
+
+    engine = create_engine(url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f'DROP DATABASE IF EXISTS "{url.database}"')
+    engine.dispose()
+
+
+class AsyncTestResponse:
+    '''
+    A class to hold a response of the Quart test client once its body is read,
+    so the scenarios read it like a response of the Flask test client
+    ...
+
+    Attributes
+    ----------
+    status_code : int
+        the status code of the response
+    headers : Headers
+        the headers of the response
+    data : bytes
+        the body of the response
+
+    Methods
+    -------
+    get_json(self):
+        get the decoded JSON body
+    '''
+
+    def __init__(self, status_code, headers, data, json_body):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+        self._json = json_body
+
+    def get_json(self):
+        return self._json
+
 
 class SequentialTestLoader(unittest.TestLoader):
     '''
@@ -26,38 +189,36 @@ class SequentialTestLoader(unittest.TestLoader):
     '''
     def getTestCaseNames(self, testCaseClass):
         testcase_names = super().getTestCaseNames(testCaseClass)
-        testcase_methods = list(testCaseClass.__dict__.keys())
+        # Inherited scenarios first, in the order of the classes defining them
+        testcase_methods = [
+            name for cls in reversed(testCaseClass.__mro__) for name in cls.__dict__]
         testcase_names.sort(key=testcase_methods.index)
         return testcase_names
 
-class TriviaTestCase(unittest.TestCase):
+class TriviaScenarios:
     '''
-    A class to represent the trivia test case
+    A class holding the scenarios run against both the Flask app and the async app.
+    The test case mixing it in defines send(method, path, **kwargs), sending a
+    request to its app, and stored_rating(question_id), reading a rating back
+    from its database, and runs every scenario on data no other scenario wrote
     ...
 
-    Attributes
-    ----------
-    app : Flask
-        an instance of flask app
-    client : FlaskClient
-        an instance of flask client
-    database_name : str
-        name of test database
-    database_path : str
-        URI of database path
-
     Methods
     -------
     setUp(self):
-        define test variables and initialize app.
-    tearDown(self):
-        executes after test cases
+        define the test variables of the scenarios
     test_get_categories(self):
         test the get_cateories route
     test_get_questions(self):
         test the get_questions route
-    test_get_by_category(self):
+    test_get_paginated_questions(self)
+        test the second page of questions
+    test_404_sent_requesting_beyond_valid_page(self)
+        test if question page is beyond the questions
+    test_get_questions_by_category(self):
         test the get_by_category route
+    test_404_if_category_does_not_exist(self)
+        test if category does not exist
     test_delete_question(self):
         test the route to delete a question
     test_404_if_question_to_delete_does_not_exist(self):
@@ -66,16 +227,26 @@ class TriviaTestCase(unittest.TestCase):
         test to create question
     test_400_if_question_cannot_be_created(self)
         test if question cannot be created
+    test_400_if_question_has_unknown_or_malformed_keys(self)
+        test if question has an unknown key or a malformed field
     test_get_questions_search_with_results(self)
         test to get question search results
     test_404_search_term_cannot_be_found(self)
         test if search term does not exist
+    test_empty_search_term_matches_every_question(self)
+        test an empty search term lists every question
     test_get_quizzes_from_random_questions_first_request(self)
         test to get quizzes at first request
     test_get_quizzes_from_random_questions_second_request(self)
         test to get quizzes at second request
     test_404_no_questions_left_for_quiz(self)
         test if questions no longer exist under category
+    test_400_if_previous_questions_are_not_ids(self)
+        test if previous questions are not a list of ids
+    test_quiz_session_tracks_previous_questions(self)
+        test a server side quiz session never repeats a question
+    test_404_if_quiz_session_does_not_exist(self)
+        test if quiz session token is unknown
     test_update_question_rating(self)
         test to update rating in question
     test_400_for_failed_rating_update(self)
@@ -84,18 +255,14 @@ class TriviaTestCase(unittest.TestCase):
         test a create category route
     test_400_if_category_cannot_be_created(self)
         test if category cannot be created
+    test_304_if_questions_not_modified(self)
+        test conditional GET of questions with an ETag
     '''
 
     def setUp(self):
         '''
-        Define test variables and initialize app
+        Define test variables
         '''
-        self.app = create_app()
-        self.client = self.app.test_client
-        self.database_name = TEST_DATABASE_NAME
-        self.database_path = TEST_DATABASE_URI
-        setup_db(self.app, self.database_path)
-
         self.new_question = {
             'question': 'Who are the facilitators of Udacity Fullstack Web-development programme ?',
             'answer': 'ALX-T',
@@ -116,17 +283,6 @@ class TriviaTestCase(unittest.TestCase):
             'type': 'Astronomy'
         }
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
-    def tearDown(self):
-        '''Executed after each test'''
-        pass
-
     """
     TODO
     Write at least one test for each test for successful operation and for expected errors.
@@ -135,11 +291,11 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests a returned response of categories
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().get('/categories')
+        response = self.send('GET', '/categories')
         data = response.get_json()
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(data['categories'].keys()), 6)
@@ -150,41 +306,43 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests a returned response object of paginated questions
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().get('/questions')
+        response = self.send('GET', '/questions')
         data = response.get_json()
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['questions']), 10)
+        self.assertEqual(data['total_questions'], 19)
         self.assertIsInstance(data['categories'], dict)
 
     def test_get_paginated_questions(self):
         '''
         Tests a returned response object of paginated questions
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().get('/questions?page=2')
+        response = self.send('GET', '/questions?page=2')
         data = response.get_json()
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['questions']), 9)
+        self.assertIsNone(data['next_cursor'])
         self.assertIsInstance(data['categories'], dict)
 
     def test_404_sent_requesting_beyond_valid_page(self):
         '''
         Tests a get question requests beyond valid page
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().get('/questions?page=500')
+        response = self.send('GET', '/questions?page=500')
         data = response.get_json()
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data['success'], False)
@@ -194,11 +352,11 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests a returned response object of questions in a particular catgeory
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().get('/categories/1/questions')
+        response = self.send('GET', '/categories/1/questions')
         data = response.get_json()
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
@@ -209,11 +367,11 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests a returned error 404 response object if category does not exist
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().get('/categories/20/questions')
+        response = self.send('GET', '/categories/20/questions')
         data = response.get_json()
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data['success'], False)
@@ -224,27 +382,27 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests delete a question route
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().delete('/questions/19')
+        response = self.send('DELETE', '/questions/19')
         data = response.get_json()
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(data['id'], 19)
         self.assertEqual(data['message'], 'Question ID: 19 deleted successfully')
 
-
     def test_404_if_question_to_delete_does_not_exist(self):
         '''
         Tests if question to delete does not exists
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().delete('/questions/19')
+        self.assertEqual(self.send('DELETE', '/questions/19').status_code, 200)
+        response = self.send('DELETE', '/questions/19')
         data = response.get_json()
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data['success'], False)
@@ -254,11 +412,11 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests create a question route
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().post('/questions', json=self.new_question)
+        response = self.send('POST', '/questions', json=self.new_question)
 
         data = response.get_json()
         self.assertEqual(response.status_code, 201)
@@ -269,25 +427,47 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests if question cannot be be created
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().post('/questions', json=self.errored_question)
+        response = self.send('POST', '/questions', json=self.errored_question)
         data = response.get_json()
         self.assertEqual(response.status_code, 400)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Bad request')
 
+    def test_400_if_question_has_unknown_or_malformed_keys(self):
+        '''
+        Tests a question with an unknown key, an empty answer, a category that is
+        not an integer or a category that does not exist is refused and not stored
+            Parameters:
+                self: TriviaScenarios
+            Returns:
+                None
+        '''
+        before = self.send('GET', '/questions').get_json()['total_questions']
+        statuses = [
+            self.send('POST', '/questions', json=body).status_code
+            for body in (
+                dict(self.new_question, author='ALX-T'),
+                dict(self.new_question, answer=''),
+                dict(self.new_question, category='Science'),
+                dict(self.new_question, category=20))]
+        after = self.send('GET', '/questions').get_json()['total_questions']
+
+        self.assertEqual(statuses, [400] * 4)
+        self.assertEqual(after, before)
+
     def test_get_questions_search_with_results(self):
         '''
         Tests to get question search results
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().post('/questions', json={'searchTerm': 'Dutch'})
+        response = self.send('POST', '/questions', json={'searchTerm': 'Dutch'})
         data = response.get_json()
         self.assertEqual(response.status_code, 200)
         self.assertIsInstance(data, dict)
@@ -298,26 +478,44 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Test if search term does not exist
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().post('/questions', json={'searchTerm': 19782})
+        response = self.send('POST', '/questions', json={'searchTerm': 19782})
         data = response.get_json()
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data['message'], 'Question with this term does not exist')
 
+    def test_empty_search_term_matches_every_question(self):
+        '''
+        Tests an empty search term matches every question, through the search
+        index as through the substring search
+            Parameters:
+                self: TriviaScenarios
+            Returns:
+                None
+        '''
+        totals = [
+            sum(category['total_questions']
+                for category in self.send('POST', '/questions', json={
+                    'searchTerm': '', 'substring': substring}).get_json().values())
+            for substring in (False, True)]
+        total_questions = self.send('GET', '/questions').get_json()['total_questions']
+
+        self.assertEqual(totals, [total_questions] * 2)
+
     def test_get_quizzes_from_random_questions_first_request(self):
         '''
         Tests to get quizzes at first requests
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
         # Category id =1 type= science has questions with id=20,21,22
         previous_questions = [20]
-        response = self.client().post('/quizzes', json={
+        response = self.send('POST', '/quizzes', json={
             'previous_questions': previous_questions, 'quiz_category':{'id': 1, 'type':'Science'}
             })
         data = response.get_json()
@@ -330,13 +528,13 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests to get quizzes at second request
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
         # Category id =1 type= science has questions with id=20,21,22
         previous_questions = [20,21]
-        response = self.client().post('/quizzes', json={
+        response = self.send('POST', '/quizzes', json={
             'previous_questions': previous_questions, 'quiz_category':{'id': 1, 'type':'Science'}
             })
         data = response.get_json()
@@ -349,13 +547,13 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Test if questions no longer exists under category
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
         # Category id =1 type= science has questions with id=20,21,22
         previous_questions = [20,21, 22]
-        response = self.client().post('/quizzes', json={
+        response = self.send('POST', '/quizzes', json={
             'previous_questions': previous_questions, 'quiz_category':{'id': 1, 'type':'Science'}
             })
         data = response.get_json()
@@ -364,31 +562,92 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['error'], 404)
         self.assertEqual(data['message'],'Questions no longer exist in this category')
 
+    def test_400_if_previous_questions_are_not_ids(self):
+        '''
+        Tests a quiz request whose previous_questions is not a list of ids is refused
+            Parameters:
+                self: TriviaScenarios
+            Returns:
+                None
+        '''
+        statuses = [
+            self.send('POST', '/quizzes', json={
+                'previous_questions': previous_questions,
+                'quiz_category': {'id': 1, 'type': 'Science'}}).status_code
+            for previous_questions in ([[20]], [20, 'a'], {'20': 1}, 20)]
+
+        self.assertEqual(statuses, [400] * 4)
+
+    def test_quiz_session_tracks_previous_questions(self):
+        '''
+        Tests a server side quiz session never repeats a question
+            Parameters:
+                self: TriviaScenarios
+            Returns:
+                None
+        '''
+        response = self.send('POST', '/quizzes', json={
+            'quiz_session': None, 'quiz_category':{'id': 1, 'type':'Science'}
+            })
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        token = data['quiz_session']
+        served = [data['question']]
+
+        # Answer every question of the category until the session runs out
+        while response.status_code == 200:
+            response = self.send('POST', '/quizzes', json={'quiz_session': token})
+            data = response.get_json()
+            if response.status_code == 200:
+                self.assertEqual(data['quiz_session'], token)
+                served.append(data['question'])
+
+        served_ids = [question['id'] for question in served]
+        self.assertEqual(len(served_ids), len(set(served_ids)))
+        self.assertTrue({20, 21, 22}.issubset(served_ids))
+        self.assertTrue(all(question['category'] == 1 for question in served))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['message'], 'Questions no longer exist in this category')
+
+    def test_404_if_quiz_session_does_not_exist(self):
+        '''
+        Tests if quiz session token is unknown
+            Parameters:
+                self: TriviaScenarios
+            Returns:
+                None
+        '''
+        response = self.send('POST', '/quizzes', json={'quiz_session': 'unknown'})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Resource not found')
+
     def test_update_question_rating(self):
         '''
         Test to update rating in question
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().patch('/questions/2', json={'rating': 3})
+        response = self.send('PATCH', '/questions/2', json={'rating': 3})
         data = response.get_json()
-        question = Question.query.filter(Question.id == 2).one_or_none()
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
-        self.assertEqual(question.format()["rating"], 3)
+        self.assertEqual(data['question']['rating'], 3)
+        self.assertEqual(self.stored_rating(2), 3)
 
     def test_400_for_failed_rating_update(self):
         '''
         Test for failed update rating in question
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().patch('/questions/2')
+        response = self.send('PATCH', '/questions/2')
         data = response.get_json()
 
         self.assertEqual(response.status_code, 400)
@@ -399,31 +658,1456 @@ class TriviaTestCase(unittest.TestCase):
         '''
         Tests create a category route
             Parameters:
-                self: TriviaTestCase
+                self: TriviaScenarios
             Returns:
                 None
         '''
-        response = self.client().post('/categories', json=self.new_category)
+        response = self.send('POST', '/categories', json=self.new_category)
 
         data = response.get_json()
         self.assertEqual(response.status_code, 201)
         self.assertTrue(data['success'])
         self.assertEqual(data['message'], 'Category was successfully created')
+        self.assertIn(self.new_category['type'], data['categories'].values())
 
     def test_400_if_category_cannot_be_created(self):
         '''
         Tests if category cannot be be created
+            Parameters:
+                self: TriviaScenarios
+            Returns:
+                None
+        '''
+        response = self.send('POST', '/categories')
+        data = response.get_json()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
+    def test_304_if_questions_not_modified(self):
+        '''
+        Tests conditional GET of questions answers 304 while nothing changed
+            Parameters:
+                self: TriviaScenarios
+            Returns:
+                None
+        '''
+        response = self.send('GET', '/questions')
+        etag = response.headers['ETag']
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(etag.startswith('W/"'))
+
+        response = self.send('GET', '/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data, b'')
+
+
+class TriviaTestCase(TriviaScenarios, unittest.TestCase):
+    '''
+    A class to represent the trivia test case
+    ...
+
+    Attributes
+    ----------
+    app : Flask
+        an instance of flask app
+    client : FlaskClient
+        an instance of flask client
+    database_name : str
+        name of test database
+    database_path : str
+        URI of database path
+
+    Methods
+    -------
+    setUp(self):
+        define test variables and initialize app.
+    tearDown(self):
+        executes after test cases
+    send(self, method, path, **kwargs):
+        send a request of a scenario to the Flask app
+    stored_rating(self, question_id):
+        get the rating of a question once its buffered votes are written
+    delete_loaded_questions(self):
+        delete the questions committed by the load-questions test
+    test_get_questions_with_cursor(self)
+        test keyset pagination of questions
+    test_400_if_cursor_is_malformed(self)
+        test if question cursor cannot be decoded
+    test_created_category_is_served_from_registry(self)
+        test the category registry is refreshed after a new category
+    test_search_finds_created_question(self)
+        test the search index is kept in sync with new questions
+    test_search_substring_flag(self)
+        test substring search behind the substring flag
+    test_search_page_beyond_matches_keeps_totals(self)
+        test search pages are windowed per category
+    test_quiz_serves_question_created_after_warm_up(self)
+        test the quiz selector reloads ids after a new question
+    test_quiz_sessions_are_compact(self)
+        test seen ids are stored sparsely and memory sessions are capped by bytes
+    test_bulk_create_questions(self)
+        test to create questions from a JSON array
+    test_bulk_create_questions_from_ndjson(self)
+        test to create questions from a NDJSON body
+    test_422_if_no_bulk_question_is_valid(self)
+        test if no question of a bulk request can be created
+    test_bulk_update_ratings(self)
+        test to update the rating of many questions by id
+    test_bulk_delete_questions(self)
+        test to delete many questions by id and by filter
+    test_400_if_bulk_delete_has_no_target(self)
+        test if bulk delete has neither ids nor filter
+    test_rating_votes_are_averaged(self)
+        test buffered rating votes are written as a mean
+    test_400_if_rating_is_not_a_star_rating(self)
+        test ratings that are not finite or outside the stars are refused
+    test_rating_buffer_drops_refused_votes(self)
+        test votes refused by the database do not hold back later votes
+    test_supplied_rating_counts_as_first_vote(self)
+        test a rating given on creation is averaged with later votes
+    test_export_questions_as_ndjson(self)
+        test to stream questions of a category as NDJSON
+    test_export_questions_as_csv(self)
+        test to stream a range of questions as CSV
+    test_load_questions_command(self)
+        test the load-questions command with a CSV file
+    test_etag_changes_after_write(self)
+        test the ETag of a category changes after a new question
+    test_gzip_compressed_questions(self)
+        test negotiated gzip compression of questions
+    test_fast_json_matches_jsonify(self)
+        test the fast JSON encoder writes the body of jsonify
+    test_migrations_index_categories(self)
+        test the migrations are applied once and index question categories
+    test_get_pool_metrics(self)
+        test the connection pool metrics endpoint
+    test_metered_pool_counts_timeouts(self)
+        test the metered pool counts checkouts and timeouts
+    test_reads_routed_to_replica(self)
+        test GET requests read a replica and writes the primary
+    test_replicas_checked_once_per_stale_window(self)
+        test requests arriving during a check do not start another one
+    test_get_metrics(self)
+        test request and query metrics in Prometheus text format
+    test_failed_query_metrics(self)
+        test a failed statement is counted and its start time dropped
+    test_query_budgets(self)
+        test warm requests stay within the query budget of their endpoint
+    test_benchmark_command(self)
+        test the benchmark reports latency percentiles in a result file
+    test_benchmark_refuses_empty_runs(self)
+        test the benchmark refuses to send no requests or use no threads
+    test_generate_questions_command(self)
+        test generated question files are reproducible and loadable
+    test_429_if_client_exceeds_rate_limit(self)
+        test a client out of tokens is refused with Retry-After
+    test_sqlite_rate_limit_store(self)
+        test the SQLite token buckets are shared by every store on the file
+    test_503_if_requests_exceed_admission(self)
+        test requests beyond MAX_IN_FLIGHT are shed with Retry-After
+    test_category_pages_cached_until_category_written(self)
+        test category pages are served from cache until one of their questions is written
+    test_response_cache_eviction(self)
+        test the response caches evict by size, version and age
+    test_settings_read_when_app_created(self)
+        test settings are read from the environment when called and overridden per app
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        '''
+        Build the app and its engine once for every test
+        '''
+        # Tests flush rating votes themselves, the timer must not flush them from another
+        # thread. Every test request comes from the same address, the limiter is tested on its own
+        cls.app = create_app(
+            TEST_DATABASE_URI, {'RATING_FLUSH_INTERVAL': 3600, 'RATE_LIMIT_ENABLED': False})
+        cls.client = cls.app.test_client
+        cls.database_name = TEST_DATABASE_NAME
+        cls.database_path = TEST_DATABASE_URI
+        with cls.app.app_context():
+            cls.engine = db.engine
+
+    def setUp(self):
+        '''
+        Define test variables and open the transaction rolled back after the test
+        '''
+        super().setUp()
+        self.connection = None
+        if getattr(getattr(self, self._testMethodName), 'committed', False):
+            return
+
+        # The app commits into a savepoint, restarted after every commit or
+        # rollback, inside a transaction that is never committed
+        self.connection = self.engine.connect()
+        if self.engine.dialect.name == 'sqlite':
+            enable_sqlite_savepoints(self.connection)
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self.app_session = db.session
+        db.session = db.create_scoped_session({'bind': self.connection, 'binds': {}})
+
+        def restart_savepoint(session, transaction):
+            if not self.savepoint.is_active:
+                self.savepoint = self.connection.begin_nested()
+
+        event.listen(db.session.session_factory, 'after_transaction_end', restart_savepoint)
+
+    def tearDown(self):
+        '''
+        Roll back the writes of the test and drop the caches that saw them
+        '''
+        if self.connection is None:
+            return
+
+        self.app.extensions['rating_buffer'].flush()
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+
+        # Table versions go back with the rollback, so the next test could
+        # write the same versions, drop everything cached under them
+        self.app.extensions['table_versions'].refresh(force=True)
+        db.session.remove()
+        self.app.extensions['category_registry'].invalidate()
+        self.app.extensions['quiz_selector'].invalidate()
+        self.app.extensions['compressed_bodies'].clear()
+        self.app.extensions['category_pages'].clear()
+        Question.reset_count()
+
+    def send(self, method, path, **kwargs):
+        '''
+        Sends a request to the Flask app
+            Parameters:
+                method (str): HTTP method of the request
+                path (str): path and query string of the request
+                kwargs (dict): json or headers of the request
+            Returns:
+                response (TestResponse): the response of the app
+        '''
+        return self.client().open(path, method=method, **kwargs)
+
+    def stored_rating(self, question_id):
+        '''
+        Returns the rating of a question once its buffered votes are written
+            Parameters:
+                question_id (int): id of the question
+            Returns:
+                rating (float): the stored rating
+        '''
+        self.app.extensions['rating_buffer'].flush()
+        return Question.query.filter(Question.id == question_id).one().rating
+
+    def test_get_questions_with_cursor(self):
+        '''
+        Tests a returned response object of questions paginated with a cursor
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        first_page = self.client().get('/questions').get_json()
+        self.assertIsNotNone(first_page['next_cursor'])
+
+        response = self.client().get(f"/questions?cursor={first_page['next_cursor']}")
+        data = response.get_json()
+        last_id = first_page['questions'][-1]['id']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], first_page['total_questions'])
+        self.assertTrue(all(question['id'] > last_id for question in data['questions']))
+        self.assertEqual(
+            data['questions'], self.client().get('/questions?page=2').get_json()['questions'])
+
+    def test_400_if_cursor_is_malformed(self):
+        '''
+        Tests if a question cursor cannot be decoded
             Parameters:
                 self: TriviaTestCase
             Returns:
                 None
         '''
-        response = self.client().post('/categories')
+        response = self.client().get('/questions?cursor=not-a-cursor')
         data = response.get_json()
         self.assertEqual(response.status_code, 400)
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Bad request')
 
+    def test_created_category_is_served_from_registry(self):
+        '''
+        Tests the category map cached in memory is refreshed after a new category
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        categories = self.client().get('/categories').get_json()['categories']
+        self.assertNotIn('Geology', categories.values())
+
+        self.client().post('/categories', json={'type': 'Geology'})
+
+        response = self.client().get('/categories')
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Geology', data['categories'].values())
+        self.assertEqual(
+            data['categories'], self.client().get('/questions').get_json()['categories'])
+
+    def test_search_finds_created_question(self):
+        '''
+        Tests a created question can be found through the search index
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        self.client().post('/questions', json={
+            'question': 'Which planet has the Olympus Mons volcano ?',
+            'answer': 'Mars',
+            'category': 1,
+            'difficulty': 2,
+            'rating': 4
+            })
+
+        response = self.client().post('/questions', json={'searchTerm': 'olympus volc'})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['1']['total_questions'], 1)
+        self.assertEqual(data['1']['questions'][0]['answer'], 'Mars')
+
+    def test_search_substring_flag(self):
+        '''
+        Tests the substring flag matches terms inside words
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().post('/questions', json={'searchTerm': 'utch'})
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client().post('/questions', json={'searchTerm': 'utch', 'substring': True})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['2']['total_questions'], 1)
+
+    def test_search_page_beyond_matches_keeps_totals(self):
+        '''
+        Tests a search page past the matches of a category keeps its total
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().post('/questions?page=2', json={'searchTerm': 'Dutch'})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['2']['total_questions'], 1)
+        self.assertEqual(data['2']['questions'], [])
+        self.assertEqual(data['1']['total_questions'], 0)
+
+    def test_quiz_serves_question_created_after_warm_up(self):
+        '''
+        Tests the ids cached by the quiz selector are reloaded after a new question,
+        for its category only
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        quiz_selector = self.app.extensions['quiz_selector']
+        # Category id =6 type= Sports has questions with id=10,11
+        quiz = {'previous_questions': [10, 11], 'quiz_category': {'id': 6, 'type': 'Sports'}}
+        response = self.client().post('/quizzes', json=quiz)
+        self.assertEqual(response.status_code, 404)
+        for category_id in (0, 1):
+            self.client().post('/quizzes', json={
+                'previous_questions': [], 'quiz_category': {'id': category_id, 'type': 'Any'}})
+        science_ids = quiz_selector._ids[1]
+
+        self.client().post('/questions', json={
+            'question': 'How many players are on a volleyball team on court ?',
+            'answer': 'Six',
+            'category': 6,
+            'difficulty': 1,
+            'rating': 3
+            })
+
+        response = self.client().post('/quizzes', json=quiz)
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['question']['answer'], 'Six')
+        # Only the ids of the written category and of all categories are reloaded
+        self.assertIs(quiz_selector._ids[1], science_ids)
+        with self.app.app_context():
+            self.assertIsNone(quiz_selector._cached_ids(0)[1])
+
+    def test_quiz_sessions_are_compact(self):
+        '''
+        Tests the seen ids of a session take a few bytes each whatever their size,
+        and the memory store evicts the least recently used sessions beyond its
+        size and drops a session that outgrows it
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        seen = SeenSet()
+        for question_id in (1_000_000, 5, 1_000_001, 130):
+            seen.add(question_id)
+        data = seen.to_bytes()
+
+        store = MemoryQuizSessionStore(3 * session_size('token-1', data), 60)
+        for token in ('token-1', 'token-2', 'token-3'):
+            store.save(token, 1, seen)
+        store.load('token-1')
+        store.save('token-4', 1, seen)
+
+        self.assertLessEqual(len(data), 10)
+        restored = SeenSet(data)
+        self.assertEqual(len(restored), 4)
+        self.assertTrue(all(question_id in restored for question_id in (5, 130, 1_000_001)))
+        self.assertNotIn(6, restored)
+        self.assertIsNone(store.load('token-2'))
+        self.assertEqual(store.load('token-1')[1].to_bytes(), data)
+        self.assertIsNotNone(store.load('token-4'))
+
+        grown = SeenSet(data)
+        for question_id in range(0, 100_000, 97):
+            grown.add(question_id)
+        store.save('token-4', 1, grown)
+        self.assertIsNone(store.load('token-4'))
+
+    def test_bulk_create_questions(self):
+        '''
+        Tests create questions from a JSON array, reporting invalid rows
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        total_questions = self.client().get('/questions').get_json()['total_questions']
+        rows = [dict(self.new_question, question=f'Bulk question {number} ?') for number in range(5)]
+        rows.insert(2, self.errored_question)
+
+        response = self.client().post('/questions/bulk?batch_size=2', json=rows)
+        data = response.get_json()
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['inserted'], 5)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['row'], 3)
+        self.assertEqual(
+            self.client().get('/questions').get_json()['total_questions'], total_questions + 5)
+
+    def test_bulk_create_questions_from_ndjson(self):
+        '''
+        Tests create questions from a NDJSON body
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        body = '\n'.join([
+            json.dumps(dict(self.new_question, question='First NDJSON question ?')),
+            'not json',
+            json.dumps(dict(self.new_question, question='Second NDJSON question ?')),
+            ])
+        response = self.client().post(
+            '/questions/bulk', data=body, content_type='application/x-ndjson')
+        data = response.get_json()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['errors'], [{'row': 2, 'error': 'Question must be an object'}])
+
+    def test_422_if_no_bulk_question_is_valid(self):
+        '''
+        Tests if no question of a bulk request can be created
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().post('/questions/bulk', json=[self.errored_question])
+        data = response.get_json()
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual(data['failed'], 1)
+
+    def test_bulk_update_ratings(self):
+        '''
+        Tests update the rating of many questions by id
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().patch('/questions/bulk', json={'ratings': [
+            {'id': 5, 'rating': 1}, {'id': 9, 'rating': 4.5}, {'id': 1000, 'rating': 2}
+            ]})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(data['ids']), [5, 9])
+        self.assertEqual(data['total_updated'], 2)
+        self.assertEqual(Question.query.get(9).rating, 4.5)
+
+    def test_bulk_delete_questions(self):
+        '''
+        Tests delete many questions by id and by filter
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        rows = [dict(self.new_question, category=3, rating=0.5) for _ in range(3)]
+        self.client().post('/questions/bulk', json=rows)
+        created_ids = [
+            question.id for question in Question.query.filter(Question.rating == 0.5).all()]
+
+        response = self.client().delete('/questions/bulk', json={'ids': created_ids[:1] + [1000]})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['ids'], created_ids[:1])
+        self.assertEqual(data['total_deleted'], 1)
+
+        response = self.client().delete('/questions/bulk', json={
+            'filter': {'category': 3, 'rating_below': 1}})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(data['ids']), created_ids[1:])
+        self.assertEqual(Question.query.filter(Question.rating == 0.5).count(), 0)
+
+    def test_400_if_bulk_delete_has_no_target(self):
+        '''
+        Tests if bulk delete has neither ids nor filter
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().delete('/questions/bulk', json={'filter': {}})
+        data = response.get_json()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
+    def test_rating_votes_are_averaged(self):
+        '''
+        Tests buffered rating votes are coalesced and written as a mean
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        rating_buffer = self.app.extensions['rating_buffer']
+        rating_buffer.flush()
+        question = Question.query.get(13)
+        votes, total = question.rating_count, question.rating_sum
+
+        for rating in (1, 2, 3, 5):
+            response = self.client().patch('/questions/13', json={'rating': rating})
+        data = response.get_json()
+        expected = (total + 11) / (votes + 4)
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(data['question']['rating'], expected)
+
+        self.assertEqual(rating_buffer.flush(), 1)
+        question = Question.query.filter(Question.id == 13).one_or_none()
+        self.assertEqual(question.rating_count, votes + 4)
+        self.assertAlmostEqual(question.rating, expected)
+
+    def test_400_if_rating_is_not_a_star_rating(self):
+        '''
+        Tests NaN, infinite and out of range ratings are refused by the rating,
+        bulk rating and creation endpoints
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        client = self.client()
+        statuses = [
+            client.patch('/questions/2', json={'rating': rating}).status_code
+            for rating in ('nan', 'inf', '-inf', 6, -1)]
+        bulk = client.patch('/questions/bulk', json={'ratings': [{'id': 2, 'rating': 'nan'}]})
+        created = client.post('/questions', json=dict(self.new_question, rating='nan'))
+
+        self.assertEqual(statuses, [400] * 5)
+        self.assertEqual(bulk.status_code, 400)
+        self.assertEqual(created.status_code, 400)
+        self.assertEqual(self.app.extensions['rating_buffer'].flush(), 0)
+
+    def test_rating_buffer_drops_refused_votes(self):
+        '''
+        Tests a batch of votes the database refuses is dropped rather than put
+        back, and a vote flushed by its own request is counted once
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        rating_buffer = self.app.extensions['rating_buffer']
+        flush_size = rating_buffer.flush_size
+        with self.app.test_request_context('/questions/2', method='PATCH'):
+            rating_buffer.vote(2, float('nan'))
+            with self.assertLogs(self.app.logger, 'ERROR'):
+                dropped = rating_buffer.flush()
+        question = db.session.get(Question, 2)
+        votes, total = question.rating_count, question.rating_sum
+
+        rating_buffer.flush_size = 1
+        try:
+            response = self.client().patch('/questions/2', json={'rating': 5})
+        finally:
+            rating_buffer.flush_size = flush_size
+        question = Question.query.filter(Question.id == 2).one()
+
+        self.assertEqual(dropped, 0)
+        self.assertEqual(rating_buffer.flush(), 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(response.get_json()['question']['rating'], (total + 5) / (votes + 1))
+        self.assertEqual(question.rating_count, votes + 1)
+
+    def test_supplied_rating_counts_as_first_vote(self):
+        '''
+        Tests the rating of a created, bulk created or bulk updated question is
+        averaged with the votes that follow it
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        self.assertEqual(self.client().post('/questions', json=self.new_question).status_code, 201)
+        bulk_question = dict(self.new_question, question='Bulk rated question ?', rating=4)
+        self.assertEqual(self.client().post('/questions/bulk', json=[bulk_question]).status_code, 201)
+        created_id = Question.query.filter_by(question=self.new_question['question']).one().id
+        bulk_id = Question.query.filter_by(question=bulk_question['question']).one().id
+        response = self.client().patch(
+            '/questions/bulk', json={'ratings': [{'id': created_id, 'rating': 2}]})
+        self.assertEqual(response.status_code, 200)
+
+        created = self.client().patch(f'/questions/{created_id}', json={'rating': 5}).get_json()
+        bulk = self.client().patch(f'/questions/{bulk_id}', json={'rating': 5}).get_json()
+        self.app.extensions['rating_buffer'].flush()
+
+        self.assertAlmostEqual(created['question']['rating'], 3.5)
+        self.assertAlmostEqual(bulk['question']['rating'], 4.5)
+        question = db.session.get(Question, created_id)
+        self.assertEqual((question.rating_count, question.rating_sum), (2, 7))
+
+    def test_export_questions_as_ndjson(self):
+        '''
+        Tests stream the questions of a category as NDJSON
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().get('/questions/export?category=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        questions = [json.loads(line) for line in response.data.decode().splitlines()]
+        expected = self.client().get('/categories/3/questions').get_json()['questions']
+        self.assertEqual(questions, sorted(expected, key=lambda question: question['id']))
+
+    def test_export_questions_as_csv(self):
+        '''
+        Tests stream a range of questions as CSV
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().get('/questions/export?format=csv&after_id=9&max_id=12')
+        lines = response.data.decode().splitlines()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty,rating')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], ['10', '11', '12'])
+
+    @committed
+    def test_load_questions_command(self):
+        '''
+        Tests the load-questions command loads valid rows of a CSV file
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'questions.csv')
+            with open(path, 'w', encoding='utf-8') as questions:
+                questions.write('question,answer,category,difficulty,rating\n')
+                questions.write('"Which gas do plants absorb, mostly ?",Carbon dioxide,1,1,\n')
+                questions.write('Which category is this ?,None,99,1,\n')
+
+            result = self.app.test_cli_runner().invoke(args=['load-questions', path])
+        self.addCleanup(self.delete_loaded_questions)
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('1 rows loaded, 1 skipped', result.output)
+        self.assertEqual(
+            Question.query.filter(Question.answer == 'Carbon dioxide').count(), 1)
+
+    def delete_loaded_questions(self):
+        '''
+        Deletes the questions committed by test_load_questions_command
+        '''
+        for question in Question.query.filter(Question.answer == 'Carbon dioxide'):
+            question.delete()
+
+    def test_etag_changes_after_write(self):
+        '''
+        Tests the ETag of a category changes after a new question
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        etag = self.client().get('/categories/4/questions').headers['ETag']
+
+        self.client().post('/questions', json=self.new_question)
+
+        response = self.client().get('/categories/4/questions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_gzip_compressed_questions(self):
+        '''
+        Tests negotiated gzip compression of questions, compressed once per ETag
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        plain = self.client().get('/questions')
+        response = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(response.headers['ETag'], plain.headers['ETag'][:-1] + '+gzip"')
+
+        cached = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(len(self.app.extensions['compressed_bodies']), 1)
+
+        response = self.client().get('/questions', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_fast_json_matches_jsonify(self):
+        '''
+        Tests the fast JSON encoder writes the body of jsonify, non ASCII text and
+        floats orjson writes differently included
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        payload = {
+            'success': True,
+            'questions': [{'id': 1, 'question': 'Which team won 1990– 🏆?', 'rating': 2.5}],
+            'total_questions': 1,
+            'next_cursor': None
+            }
+        response = self.client().get('/categories/3/questions')
+        with self.app.test_request_context():
+            self.assertEqual(json_response(payload).data, jsonify(payload).data)
+            self.assertEqual(json_response(payload, 201).status_code, 201)
+            self.assertEqual(response.data, jsonify(json.loads(response.data)).data)
+            for rating in (1e-5, 1e16, float('nan'), float('inf')):
+                rated = dict(payload, rating=rating)
+                self.assertEqual(json_response(rated).data, jsonify(rated).data)
+
+    def test_migrations_index_categories(self):
+        '''
+        Tests the migrations are recorded once applied and index question categories
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        with self.app.app_context():
+            indexes = {index['name'] for index in inspect(db.engine).get_indexes('questions')}
+            self.assertEqual(run_migrations(db.engine), [])
+            self.assertEqual(SchemaMigration.query.count(), len(MIGRATIONS))
+            self.assertTrue(schema_is_current(db.engine))
+            if db.engine.dialect.name == 'sqlite':
+                self.assertIn('questions_fts', inspect(db.engine).get_table_names())
+            else:
+                self.assertIn('ix_questions_search_vector', indexes)
+        # setup_db skips create_all only while models.py knows the latest migration
+        self.assertEqual(SCHEMA_VERSION, max(MIGRATIONS))
+        self.assertTrue({
+            'ix_questions_category',
+            'ix_questions_category_id',
+            'ix_questions_category_difficulty'
+            } <= indexes)
+
+        result = self.app.test_cli_runner().invoke(args=['migrate', '--status'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('applied  Index questions by category', result.output)
+        self.assertNotIn('pending', result.output)
+
+    def test_get_pool_metrics(self):
+        '''
+        Tests the connection pool metrics endpoint
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        response = self.client().get('/metrics/pool')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['success'])
+        with self.app.app_context():
+            self.assertEqual(data['pool']['pool'], type(db.engine.pool).__name__)
+
+    def test_metered_pool_counts_timeouts(self):
+        '''
+        Tests the metered pool counts checkouts and the checkouts timing out on a full pool
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(
+                f"sqlite:///{os.path.join(directory, 'pool.db')}",
+                poolclass=MeteredQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.05,
+                connect_args={'check_same_thread': False})
+            connection = engine.connect()
+            with self.assertRaises(PoolTimeoutError):
+                engine.connect()
+            connection.close()
+            engine.connect().close()
+
+            metrics = pool_metrics(engine.pool)
+            engine.dispose()
+
+        self.assertEqual(metrics['checkouts'], 2)
+        self.assertEqual(metrics['timeouts'], 1)
+        self.assertEqual(metrics['checked_out'], 0)
+        self.assertGreaterEqual(metrics['max_wait_seconds'], 0.05)
+
+    def test_reads_routed_to_replica(self):
+        '''
+        Tests GET requests read from a replica, other requests, sessions that
+        wrote and table versions read from the primary, and unhealthy or unchecked
+        replicas are skipped
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        answer = select(Question.answer).where(Question.id == 20)
+        with tempfile.TemporaryDirectory() as directory:
+            with self.app.app_context():
+                if db.engine.dialect.name != 'sqlite':
+                    self.skipTest('replicas are copied from a SQLite database file')
+                primary_answer = db.session.execute(answer).scalar()
+                replica_path = os.path.join(directory, 'replica.db')
+                shutil.copyfile(db.engine.url.database, replica_path)
+            with sqlite3.connect(replica_path) as replica:
+                replica.execute("UPDATE questions SET answer = 'Replica' WHERE id = 20")
+                replica.execute("INSERT INTO table_versions (name, version) VALUES ('replica', 1)")
+
+            replicas = ReplicaSet([
+                f'sqlite:///{replica_path}',
+                f"sqlite:///{os.path.join(directory, 'missing', 'replica.db')}"
+                ], 60)
+            # The primary serves reads until the background check is done
+            unchecked = replicas.choose()
+            replicas.check(force=True)
+            self.app.extensions['replicas'] = replicas
+
+            response = self.client().get('/categories/1/questions')
+            answers = {
+                question['id']: question['answer']
+                for question in json.loads(response.data)['questions']}
+            self.assertEqual(answers[20], 'Replica')
+
+            with self.app.test_request_context('/questions'):
+                self.app.preprocess_request()
+                self.app.extensions['table_versions'].refresh(force=True)
+                self.assertEqual(self.app.extensions['table_versions'].version('replica'), 0)
+                self.assertEqual(db.session.execute(answer).scalar(), 'Replica')
+                Category(type='Replicated').insert()
+                self.assertEqual(db.session.execute(answer).scalar(), primary_answer)
+
+            with self.app.test_request_context('/questions', method='POST'):
+                self.app.preprocess_request()
+                self.assertEqual(db.session.execute(answer).scalar(), primary_answer)
+
+            self.assertIsNone(unchecked)
+            self.assertEqual(len(replicas.engines), 2)
+            self.assertEqual({replicas.choose(), replicas.choose()}, {replicas.engines[0]})
+            replicas.dispose()
+            self.app.extensions['replicas'] = None
+
+    def test_replicas_checked_once_per_stale_window(self):
+        '''
+        Tests the requests choosing a replica while its health check runs do not
+        start another check
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        replicas = ReplicaSet(['sqlite://'], 60)
+        checks = []
+        check = replicas.check
+
+        def slow_check(force=False):
+            checks.append(force)
+            time.sleep(0.05)
+            check(force)
+        replicas.check = slow_check
+
+        for _ in range(20):
+            replicas.choose()
+        # Waits for the background check to be done
+        while replicas.is_stale():
+            time.sleep(0.01)
+
+        self.assertEqual(checks, [False])
+        self.assertEqual(replicas.choose(), replicas.engines[0])
+        replicas.dispose()
+
+    def test_get_metrics(self):
+        '''
+        Tests the metrics endpoint reports latency histograms and query counts by
+        endpoint, and sums the metrics written by several processes
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        client = self.client()
+        client.get('/questions')
+        client.get('/questions?page=1000')
+        response = client.get('/metrics')
+        body = response.data.decode()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE trivia_http_request_duration_seconds histogram', body)
+        self.assertIn(
+            'trivia_http_request_duration_seconds_bucket'
+            '{endpoint="get_questions",method="GET",le="+Inf"}', body)
+        self.assertIn(
+            'trivia_http_requests_total{endpoint="get_questions",method="GET",status="404"}', body)
+        queries = [
+            line for line in body.splitlines()
+            if line.startswith('trivia_db_queries_total{endpoint="get_questions"}')]
+        self.assertEqual(len(queries), 1)
+        self.assertGreater(int(queries[0].split()[-1]), 0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            workers = [RequestMetrics(directory), RequestMetrics(directory)]
+            for worker in workers:
+                worker.record_request('get_questions', 'GET', 200, 0.02, 512, 2, 0.004)
+            # Both workers run in this process, so they share a file; write them apart
+            workers[0].flush(None)
+            os.replace(
+                os.path.join(directory, f'metrics-{os.getpid()}.json'),
+                os.path.join(directory, 'metrics-0.json'))
+            body = workers[1].render()
+
+        self.assertIn(
+            'trivia_http_request_duration_seconds_count'
+            '{endpoint="get_questions",method="GET"} 2', body)
+        self.assertIn('trivia_db_queries_total{endpoint="get_questions"} 4', body)
+
+    def test_failed_query_metrics(self):
+        '''
+        Tests a statement failing while a request is handled is counted, and its
+        start time is not left on the connection for the next statement
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        with self.app.test_request_context('/questions'):
+            self.app.preprocess_request()
+            with db.engine.connect() as connection:
+                with self.assertRaises(SQLAlchemyError):
+                    connection.execute(text('SELECT * FROM missing_table'))
+                started = list(connection.info.get('query_started_at', []))
+                connection.execute(text('SELECT 1'))
+            queries = g.db_queries
+
+        self.assertEqual(started, [])
+        self.assertEqual(queries, 2)
+
+    def test_query_budgets(self):
+        '''
+        Tests a warm request to each endpoint runs no more SQL statements than
+        QUERY_BUDGETS allows
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        client = self.client()
+        # Keep the table version check out of the counted requests
+        table_versions = self.app.extensions['table_versions']
+        self.addCleanup(setattr, table_versions, 'check_interval', table_versions.check_interval)
+        table_versions.check_interval = 3600
+        requests = {
+            'GET /questions': lambda: client.get('/questions'),
+            'POST /questions searchTerm': lambda: client.post(
+                '/questions', json={'searchTerm': 'title'}),
+            'POST /quizzes': lambda: client.post('/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'id': 1, 'type': 'Science'}
+                }),
+            'GET /categories/<id>/questions': lambda: client.get('/categories/1/questions'),
+        }
+        with self.app.app_context():
+            engine = db.engine
+
+        for name, send in requests.items():
+            with self.subTest(endpoint=name):
+                # The first request fills the category, count and version caches
+                send()
+                with count_queries(engine) as statements:
+                    response = send()
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(
+                    len(statements), QUERY_BUDGETS[name], '\n'.join(statements))
+
+
+    @committed
+    def test_benchmark_command(self):
+        '''
+        Tests the benchmark command measures the read scenarios, writes their
+        percentiles to a result file and compares it with an earlier run
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'benchmark.json')
+            arguments = [
+                'benchmark', '--questions', '0', '--categories', '0',
+                '--scenario', 'questions_page', '--scenario', 'search',
+                '--requests', '20', '--concurrency', '4', '--warmup', '0']
+            result = runner.invoke(args=arguments + ['--output', output])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(output, encoding='utf-8') as results_file:
+                report = json.load(results_file)
+
+            result = runner.invoke(args=arguments + [
+                '--output', os.path.join(directory, 'next.json'), '--compare', output])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Compared to', result.output)
+        self.assertEqual(report['dataset']['added'], 0)
+        self.assertEqual(set(report['scenarios']), {'questions_page', 'search'})
+        for scenario in report['scenarios'].values():
+            self.assertEqual(scenario['requests'], 20)
+            self.assertEqual(scenario['errors'], 0)
+            self.assertEqual(sum(scenario['statuses'].values()), 20)
+            self.assertLessEqual(scenario['p50_ms'], scenario['p95_ms'])
+            self.assertLessEqual(scenario['p95_ms'], scenario['p99_ms'])
+
+    def test_benchmark_refuses_empty_runs(self):
+        '''
+        Tests the benchmark refuses a run without requests or threads before
+        seeding or measuring anything
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        runner = self.app.test_cli_runner()
+        results = [
+            runner.invoke(args=['benchmark', option, '0'])
+            for option in ('--requests', '--concurrency')]
+
+        self.assertEqual([result.exit_code for result in results], [2, 2])
+        self.assertIn("Invalid value for '--requests'", results[0].output)
+
+    def test_generate_questions_command(self):
+        '''
+        Tests the generator writes the same NDJSON and CSV questions for the same
+        seed, in existing categories skewed towards the first one
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            files = {}
+            for name in ('first.ndjson', 'second.ndjson', 'third.csv'):
+                path = os.path.join(directory, name)
+                result = runner.invoke(args=[
+                    'generate-questions', '--count', '2000', '--categories', '0',
+                    '--seed', '7', '--output', path])
+                self.assertEqual(result.exit_code, 0, result.output)
+                with open(path, encoding='utf-8') as generated:
+                    files[name] = generated.read()
+
+        self.assertEqual(files['first.ndjson'], files['second.ndjson'])
+        questions = [json.loads(line) for line in files['first.ndjson'].splitlines()]
+        self.assertEqual(len(questions), 2000)
+        self.assertEqual(len(files['third.csv'].splitlines()), 2001)
+
+        with self.app.app_context():
+            category_ids = sorted(category_id for (category_id,) in db.session.query(Category.id))
+        sizes = {category_id: 0 for category_id in category_ids}
+        for question in questions:
+            sizes[question['category']] += 1
+        self.assertEqual(set(sizes), set(category_ids))
+        self.assertGreater(sizes[category_ids[0]], sizes[category_ids[-1]] * 2)
+        self.assertGreater(len({question['question'] for question in questions}), 1990)
+
+    def test_429_if_client_exceeds_rate_limit(self):
+        '''
+        Tests requests are refused with 429 and Retry-After once the bucket of
+        their client is empty, an export taking more tokens than a category list
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        rate_limiter = self.app.extensions['rate_limiter']
+        store, rate, burst = rate_limiter.store, rate_limiter.rate, rate_limiter.burst
+        rate_limiter.store = MemoryRateLimitStore(10)
+        rate_limiter.rate, rate_limiter.burst = 0.1, 20
+        rate_limiter.enabled = True
+        try:
+            categories = [self.client().get('/categories').status_code for _ in range(20)]
+            res = self.client().get('/categories')
+            # Another client has its own bucket, emptied by a single export
+            exported = self.client().get(
+                '/questions/export?format=ndjson', headers={'X-API-Key': 'other'})
+            after_export = self.client().get('/categories', headers={'X-API-Key': 'other'})
+            metrics = self.client().get('/metrics')
+        finally:
+            rate_limiter.store, rate_limiter.rate, rate_limiter.burst = store, rate, burst
+            rate_limiter.enabled = False
+        data = json.loads(res.data)
+
+        self.assertEqual(categories, [200] * 20)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Too many requests')
+        self.assertEqual(res.headers['Retry-After'], '10')
+        self.assertEqual(exported.status_code, 200)
+        self.assertEqual(after_export.status_code, 429)
+        self.assertEqual(metrics.status_code, 200)
+
+    def test_sqlite_rate_limit_store(self):
+        '''
+        Tests the token buckets of a SQLite store are seen by another store on
+        the same file, as another worker would
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'limits.db')
+            first, second = SQLiteRateLimitStore(path), SQLiteRateLimitStore(path)
+            taken = [first.take('ip:127.0.0.1', 2, 1, 5), second.take('ip:127.0.0.1', 2, 1, 5)]
+            retry_after = first.take('ip:127.0.0.1', 2, 1, 5)
+            other = second.take('ip:10.0.0.1', 5, 1, 5)
+
+        self.assertEqual(taken, [0, 0])
+        self.assertAlmostEqual(retry_after, 1, delta=0.1)
+        self.assertEqual(other, 0)
+
+    def test_503_if_requests_exceed_admission(self):
+        '''
+        Tests a request arriving while MAX_IN_FLIGHT requests are handled is shed
+        with 503 and Retry-After without spending tokens, and is admitted again
+        once one is done
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        admission = self.app.extensions['admission']
+        rate_limiter = self.app.extensions['rate_limiter']
+        store, burst = rate_limiter.store, rate_limiter.burst
+        # A bucket holding a single request, emptied by a shed request if it took tokens
+        rate_limiter.store, rate_limiter.burst = MemoryRateLimitStore(10), 1
+        rate_limiter.enabled = True
+        timeout, admission.timeout = admission.timeout, 0
+        for _ in range(admission.max_in_flight):
+            self.assertTrue(admission.enter())
+        try:
+            res = self.client().get('/categories')
+            metrics = self.client().get('/metrics/pool')
+        finally:
+            for _ in range(admission.max_in_flight):
+                admission.leave()
+            admission.timeout = timeout
+        try:
+            admitted = self.client().get('/categories')
+        finally:
+            rate_limiter.store, rate_limiter.burst = store, burst
+            rate_limiter.enabled = False
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Service unavailable')
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(metrics.status_code, 200)
+        self.assertEqual(admitted.status_code, 200)
+
+    def test_category_pages_cached_until_category_written(self):
+        '''
+        Tests a category page is served without SQL, whatever its query string,
+        until a question of that category is created, rated or deleted, writes to
+        other categories keep it
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        client = self.client()
+        with self.app.app_context():
+            engine = db.engine
+        first = json.loads(client.get('/categories/1/questions').data)
+        with count_queries(engine) as cached:
+            client.get('/categories/1/questions')
+            client.get('/categories/1/questions?page=2&x=1')
+
+        other_question = dict(self.new_question, category=2)
+        self.assertEqual(client.post('/questions', json=other_question).status_code, 201)
+        with count_queries(engine) as after_other_write:
+            client.get('/categories/1/questions')
+
+        self.assertEqual(
+            client.post('/questions', json=dict(self.new_question, category=1)).status_code, 201)
+        created = json.loads(client.get('/categories/1/questions').data)
+        question_id = max(question['id'] for question in created['questions'])
+
+        client.patch(f'/questions/{question_id}', json={'rating': 5})
+        self.app.extensions['rating_buffer'].flush()
+        rated = json.loads(client.get('/categories/1/questions').data)
+        with self.app.app_context():
+            rating = db.session.get(Question, question_id).rating
+        client.delete(f'/questions/{question_id}')
+        deleted = json.loads(client.get('/categories/1/questions').data)
+
+        # The write to another category only reads the table versions again
+        self.assertNotIn('FROM questions', '\n'.join(cached + after_other_write))
+        self.assertEqual(created['total_questions'], first['total_questions'] + 1)
+        self.assertNotEqual(rating, self.new_question['rating'])
+        self.assertEqual(
+            {question['id']: question['rating'] for question in rated['questions']}[question_id],
+            rating)
+        self.assertEqual(deleted['total_questions'], first['total_questions'])
+
+    def test_response_cache_eviction(self):
+        '''
+        Tests the memory and SQLite response caches drop the least recently used
+        bodies beyond their size, and bodies of an older version or past their ttl,
+        and SQLite caches of other databases keep their own bodies
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        cache = MemoryResponseCache(10, 60)
+        cache.set('1?', 1, b'first')
+        cache.set('2?', 1, b'other')
+        cache.get('1?', 1)
+        cache.set('3?', 1, b'third')
+        kept = [cache.get(key, 1) for key in ('1?', '2?', '3?')]
+        stale = cache.get('1?', 2)
+        expiring = MemoryResponseCache(10, 0.01)
+        expiring.set('1?', 1, b'first')
+        time.sleep(0.02)
+        expired = expiring.get('1?', 1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            first, second = SQLiteResponseCache(path, 10, 60), SQLiteResponseCache(path, 10, 60)
+            first.set('1?', 1, b'first')
+            shared = second.get('1?', 1)
+            shared_stale = second.get('1?', 2)
+            after_stale = first.get('1?', 1)
+            first.set('1?', 1, b'first')
+            second.set('2?', 1, b'other')
+            first.get('1?', 1)
+            second.set('3?', 1, b'third')
+            second._evict()
+            shared_kept = [first.get(key, 1) for key in ('1?', '2?', '3?')]
+            other_database = SQLiteResponseCache(path, 10, 60, 'other:')
+            other_miss = other_database.get('1?', 1)
+            other_database.set('1?', 1, b'four')
+            other_database.clear()
+            first_kept = first.get('1?', 1)
+
+        self.assertEqual(kept, [b'first', None, b'third'])
+        self.assertIsNone(stale)
+        self.assertIsNone(expired)
+        self.assertEqual(shared, b'first')
+        self.assertIsNone(shared_stale)
+        self.assertIsNone(after_stale)
+        self.assertEqual(shared_kept, [b'first', None, b'third'])
+        self.assertIsNone(other_miss)
+        self.assertEqual(first_kept, b'first')
+
+    def test_settings_read_when_app_created(self):
+        '''
+        Tests the settings are read from the environment when an app is created,
+        not when flaskr is imported, and the settings given to create_app win
+            Parameters:
+                self: TriviaTestCase
+            Returns:
+                None
+        '''
+        level = os.environ.get('COMPRESS_LEVEL')
+        os.environ['COMPRESS_LEVEL'] = '1'
+        try:
+            from_environment = load_settings()
+            overridden = load_settings({'COMPRESS_LEVEL': 9})
+        finally:
+            if level is None:
+                del os.environ['COMPRESS_LEVEL']
+            else:
+                os.environ['COMPRESS_LEVEL'] = level
+
+        self.assertEqual(from_environment['COMPRESS_LEVEL'], 1)
+        self.assertEqual(overridden['COMPRESS_LEVEL'], 9)
+        self.assertEqual(self.app.config['RATE_LIMIT_ENABLED'], False)
+        self.assertEqual(self.app.extensions['rate_limiter'].enabled, False)
+        self.assertEqual(self.app.extensions['rating_buffer'].flush_interval, 3600)
+
+class AsyncTriviaTestCase(TriviaScenarios, unittest.TestCase):
+    '''
+    A class to run the trivia scenarios against the async (ASGI) app.
+    The scenarios write to the database, so each of them runs on its own copy
+    of ASYNC_TEST_DATABASE_URI, or of a SQLite test database, and they are
+    skipped without Quart or the async driver of the database.
+    ...
+
+    Attributes
+    ----------
+    app : Quart
+        an instance of the async app
+    client : QuartClient
+        an instance of quart client
+    loop : AbstractEventLoop
+        the event loop running the requests of a scenario
+    template : str
+        URI of the migrated database copied for every scenario
+    database_path : str
+        URI of the copy of the current scenario
+
+    Methods
+    -------
+    setUp(self):
+        copy the test database and initialize app
+    tearDown(self):
+        close the app and drop the copy of the test database
+    send(self, method, path, **kwargs):
+        send a request of a scenario to the async app
+    stored_rating(self, question_id):
+        get the rating of a question from the async engine
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        '''
+        Prepare the database copied for every scenario
+        '''
+        if create_async_app is None:
+            raise unittest.SkipTest('quart is not installed')
+
+        template = config('ASYNC_TEST_DATABASE_URI', default=None)
+        url = make_url(template or TEST_DATABASE_URI)
+        if template is None and url.get_backend_name() != 'sqlite':
+            raise unittest.SkipTest('ASYNC_TEST_DATABASE_URI is not set')
+        driver = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}.get(url.get_backend_name())
+        if driver and importlib.util.find_spec(driver) is None:
+            raise unittest.SkipTest(f'{driver} is not installed')
+
+        if template is None:
+            cls.directory = tempfile.TemporaryDirectory()
+            template = f"sqlite:///{os.path.join(cls.directory.name, 'trivia.db')}"
+            shutil.copyfile(url.database, make_url(template).database)
+        # The migrations of create_app(), search index included
+        app = create_app(template)
+        with app.app_context():
+            run_migrations(db.engine)
+            db.engine.dispose()
+        cls.template = template
+
+    @classmethod
+    def tearDownClass(cls):
+        '''
+        Remove the copy of the test database
+        '''
+        if hasattr(cls, 'directory'):
+            cls.directory.cleanup()
+
+    def setUp(self):
+        '''
+        Define test variables, copy the test database and initialize app
+        '''
+        super().setUp()
+        self.database_path = copy_database(self.template)
+        self.app = create_async_app(async_database_uri(self.database_path))
+        self.client = self.app.test_client()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        '''
+        Close the connections of the app and drop its copy of the test database
+        '''
+        self.loop.run_until_complete(self.app.extensions['engine'].dispose())
+        self.loop.close()
+        drop_database(self.database_path)
+
+    def send(self, method, path, **kwargs):
+        '''
+        Sends a request to the async app and reads its body
+            Parameters:
+                method (str): HTTP method of the request
+                path (str): path and query string of the request
+                kwargs (dict): json or headers of the request
+            Returns:
+                response (AsyncTestResponse): the response of the app
+        '''
+        async def read():
+            response = await self.client.open(path, method=method, **kwargs)
+            return AsyncTestResponse(
+                response.status_code, response.headers,
+                await response.get_data(), await response.get_json(silent=True))
+        return self.loop.run_until_complete(read())
+
+    def stored_rating(self, question_id):
+        '''
+        Returns the rating of a question read through the engine of the async app
+            Parameters:
+                question_id (int): id of the question
+            Returns:
+                rating (float): the stored rating
+        '''
+        async def read():
+            async with self.app.extensions['engine'].connect() as connection:
+                return await connection.scalar(
+                    select(Question.rating).where(Question.id == question_id))
+        return self.loop.run_until_complete(read())
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":